@@ -0,0 +1,233 @@
+"""Duraciones por carril (ciudad de origen → ciudad de destino) y ETA.
+
+Cada carril guarda agregados que se actualizan cuando se completa una ruta, sin
+volver a recorrer el historial:
+
+- cantidad, media y M2 (suma de cuadrados de las desviaciones), combinados con
+  la fórmula de Chan et al.; de ahí sale la desviación estándar;
+- mínimo, máximo y cuántas llegaron a tiempo (duración <= plazo del carril);
+- histograma en N_BINS bins de ancho logarítmico (BIN_MIN_S..BIN_MAX_S), del
+  que se interpolan los percentiles (error relativo menor a la mitad del ancho
+  de un bin, ~9%).
+
+Todas las funciones trabajan sobre arreglos: reconstruir 1M de rutas es un
+np.unique + bincount, y completar una ruta es el mismo cálculo con una fila.
+
+- ETA_VELOCIDAD_KMH: velocidad para estimar un carril sin historial (60).
+- ETA_PLAZO_KMH / ETA_HOLGURA_MIN: el plazo "a tiempo" de un carril es
+  distancia / ETA_PLAZO_KMH + ETA_HOLGURA_MIN (por defecto 50 km/h y 30 min).
+"""
+import json
+import os
+
+import numpy as np
+
+from despacho import haversine_km
+
+N_BINS = 80
+BIN_MIN_S = 1.0
+BIN_MAX_S = 14 * 86400.0  # más de dos semanas cae en el último bin
+BORDES = np.geomspace(BIN_MIN_S, BIN_MAX_S, N_BINS + 1)
+MIN_MUESTRAS_ETA = 5  # con menos, el ETA usa la distancia
+
+VELOCIDAD_KMH = float(os.environ.get('ETA_VELOCIDAD_KMH', 60))
+PLAZO_KMH = float(os.environ.get('ETA_PLAZO_KMH', 50))
+HOLGURA_S = float(os.environ.get('ETA_HOLGURA_MIN', 30)) * 60
+
+
+def distancia_km(origen, destino):
+    """Distancia haversine fila a fila entre `origen` y `destino` (n, 2) en (lat, lon)."""
+    origen = np.asarray(origen, dtype=float).reshape(-1, 2)
+    destino = np.asarray(destino, dtype=float).reshape(-1, 2)
+    return haversine_km(origen[:, 0], origen[:, 1], destino[:, 0], destino[:, 1])
+
+
+def coords_por_id(ciudades):
+    """Arreglo (max_id + 1, 2) con (lat, lon) de cada ciudad indexado por id (NaN donde no hay)."""
+    ciudades = list(ciudades)
+    coords = np.full((max((c.id for c in ciudades), default=0) + 1, 2), np.nan)
+    for c in ciudades:
+        coords[c.id] = (c.lat, c.lon)
+    return coords
+
+
+def muestras(filas, coords):
+    """(carriles (n, 2), duraciones, plazos) en segundos de filas de rutas completadas.
+
+    `filas`: (origin_city_id, destination_city_id, start_time, completed_at),
+    con tiempos datetime naive. Se descartan las que no tienen ciudades
+    conocidas o ambos tiempos, y las de duración negativa.
+    """
+    filas = [f for f in filas if None not in f[:4]]
+    if not filas:
+        return np.zeros((0, 2), dtype=np.int64), np.zeros(0), np.zeros(0)
+    carriles = np.array([f[:2] for f in filas], dtype=np.int64)
+    # La resta en Python es ~10x más rápida que convertir los datetime a datetime64
+    duraciones = np.fromiter(((f[3] - f[2]).total_seconds() for f in filas), dtype=float, count=len(filas))
+    conocidas = (carriles < len(coords)).all(axis=1) & (carriles >= 0).all(axis=1)
+    validas = conocidas.copy()
+    validas[conocidas] = ~np.isnan(coords[carriles[conocidas]]).any(axis=(1, 2))
+    validas &= duraciones >= 0
+    carriles, duraciones = carriles[validas], duraciones[validas]
+    km = distancia_km(coords[carriles[:, 0]], coords[carriles[:, 1]])
+    return carriles, duraciones, plazo_s(km)
+
+
+def plazo_s(km):
+    """Duración máxima "a tiempo" de un viaje de `km` kilómetros."""
+    return np.asarray(km, dtype=float) / PLAZO_KMH * 3600.0 + HOLGURA_S
+
+
+def bin_de(duraciones):
+    """Índice de bin de cada duración (en segundos); fuera de rango va al primer/último bin."""
+    return np.clip(np.searchsorted(BORDES, duraciones, side='right') - 1, 0, N_BINS - 1)
+
+
+def agregar(carriles, duraciones, plazos):
+    """Agregados por carril de un conjunto de rutas completadas.
+
+    `carriles`: (n, 2) enteros (origen, destino); `duraciones` y `plazos` en
+    segundos. Devuelve (claves (k, 2), dict de arreglos de largo k: n, media,
+    m2, minimo, maximo, a_tiempo, hist (k, N_BINS)).
+    """
+    carriles = np.asarray(carriles, dtype=np.int64).reshape(-1, 2)
+    duraciones = np.asarray(duraciones, dtype=float)
+    # Un entero por carril: np.unique 1-D es varias veces más rápido que con axis=0
+    unicas, grupo = np.unique(carriles[:, 0] << 32 | carriles[:, 1], return_inverse=True)
+    claves = np.stack([unicas >> 32, unicas & 0xFFFFFFFF], axis=1)
+    k = len(claves)
+    n = np.bincount(grupo, minlength=k)
+    media = np.bincount(grupo, weights=duraciones, minlength=k) / np.maximum(n, 1)
+    m2 = np.bincount(grupo, weights=(duraciones - media[grupo]) ** 2, minlength=k)
+    orden = np.argsort(grupo, kind='stable')
+    inicios = np.concatenate(([0], np.cumsum(n)[:-1])) if k else np.zeros(0, dtype=np.int64)
+    ordenadas = duraciones[orden]
+    hist = np.bincount(grupo * N_BINS + bin_de(duraciones), minlength=k * N_BINS).reshape(k, N_BINS)
+    return claves, {
+        'n': n,
+        'media': media,
+        'm2': m2,
+        'minimo': np.minimum.reduceat(ordenadas, inicios) if k else np.zeros(0),
+        'maximo': np.maximum.reduceat(ordenadas, inicios) if k else np.zeros(0),
+        'a_tiempo': np.bincount(grupo, weights=duraciones <= np.asarray(plazos, dtype=float),
+                                minlength=k).astype(np.int64),
+        'hist': hist,
+    }
+
+
+def combinar(a, b):
+    """Une dos juegos de agregados de los mismos carriles (arreglos alineados); `a` puede tener n = 0."""
+    n = a['n'] + b['n']
+    delta = b['media'] - a['media']
+    seguro = np.maximum(n, 1)
+    con_a = a['n'] > 0
+    return {
+        'n': n,
+        'media': a['media'] + delta * b['n'] / seguro,
+        'm2': a['m2'] + b['m2'] + delta ** 2 * a['n'] * b['n'] / seguro,
+        'minimo': np.where(con_a, np.minimum(a['minimo'], b['minimo']), b['minimo']),
+        'maximo': np.where(con_a, np.maximum(a['maximo'], b['maximo']), b['maximo']),
+        'a_tiempo': a['a_tiempo'] + b['a_tiempo'],
+        'hist': a['hist'] + b['hist'],
+    }
+
+
+def restar(total, parte):
+    """Inverso de `combinar`: los agregados de `total` sin los de `parte` (ya incluidos en él).
+
+    Devuelve (resto, recalcular). Mínimo y máximo no se pueden deshacer: quedan
+    los de `total`, y `recalcular` marca los carriles donde `parte` tenía uno
+    de ellos o donde no estaba contada entera (hay que leerlos del historial).
+    """
+    n = total['n'] - parte['n']
+    seguro = np.maximum(n, 1)
+    media = np.where(n > 0, (total['n'] * total['media'] - parte['n'] * parte['media']) / seguro, 0.0)
+    delta = parte['media'] - media
+    m2 = total['m2'] - parte['m2'] - delta ** 2 * n * parte['n'] / np.maximum(total['n'], 1)
+    hist = total['hist'] - parte['hist']
+    a_tiempo = total['a_tiempo'] - parte['a_tiempo']
+    recalcular = (n < 0) | (a_tiempo < 0) | (hist < 0).any(axis=1) | (
+        (n > 0) & ((parte['minimo'] <= total['minimo']) | (parte['maximo'] >= total['maximo'])))
+    con_resto = n > 0
+    resto = {
+        'n': np.maximum(n, 0),
+        'media': media,
+        'm2': np.where(n > 1, np.maximum(m2, 0.0), 0.0),  # el redondeo puede dejarlo apenas negativo
+        'minimo': np.where(con_resto, total['minimo'], 0.0),
+        'maximo': np.where(con_resto, total['maximo'], 0.0),
+        'a_tiempo': np.maximum(a_tiempo, 0),
+        'hist': np.maximum(hist, 0),
+    }
+    return resto, recalcular
+
+
+def vacios(k):
+    """Agregados en cero para `k` carriles sin historial."""
+    return {'n': np.zeros(k, dtype=np.int64), 'media': np.zeros(k), 'm2': np.zeros(k),
+            'minimo': np.zeros(k), 'maximo': np.zeros(k), 'a_tiempo': np.zeros(k, dtype=np.int64),
+            'hist': np.zeros((k, N_BINS), dtype=np.int64)}
+
+
+def percentiles(hist, qs):
+    """Percentiles (en segundos) de cada fila de `hist` (k, N_BINS) para las fracciones `qs`.
+
+    Dentro del bin se interpola en escala logarítmica. NaN donde no hay muestras.
+    """
+    hist = np.atleast_2d(np.asarray(hist, dtype=float))
+    qs = np.atleast_1d(np.asarray(qs, dtype=float))
+    acumulado = np.cumsum(hist, axis=1)
+    total = acumulado[:, -1:]
+    objetivo = qs[None, :] * total  # (k, q)
+    # Primer bin cuyo acumulado alcanza el objetivo
+    indice = np.minimum((acumulado[:, None, :] < objetivo[:, :, None]).sum(axis=2), N_BINS - 1)
+    filas = np.arange(len(hist))[:, None]
+    antes = np.where(indice > 0, acumulado[filas, indice - 1], 0.0)
+    en_bin = np.maximum(hist[filas, indice], 1.0)
+    fraccion = np.clip((objetivo - antes) / en_bin, 0.0, 1.0)
+    log_bordes = np.log(BORDES)
+    valor = np.exp(log_bordes[indice] + fraccion * (log_bordes[indice + 1] - log_bordes[indice]))
+    return np.where(total > 0, valor, np.nan)
+
+
+def resumen(fila):
+    """Métricas legibles (minutos) de los agregados de un carril (dict como el de `agregar`, escalares)."""
+    n = int(fila['n'])
+    if n == 0:
+        return {'n': 0}
+    p50, p90 = percentiles(fila['hist'], [0.5, 0.9])[0]
+    return {
+        'n': n,
+        'media_min': round(float(fila['media']) / 60, 1),
+        'desv_min': round(float(np.sqrt(fila['m2'] / (n - 1))) / 60, 1) if n > 1 else 0.0,
+        'p50_min': round(float(p50) / 60, 1),
+        'p90_min': round(float(p90) / 60, 1),
+        'min_min': round(float(fila['minimo']) / 60, 1),
+        'max_min': round(float(fila['maximo']) / 60, 1),
+        'a_tiempo_pct': round(100.0 * int(fila['a_tiempo']) / n, 1),
+    }
+
+
+def duracion_estimada(n, hist, km):
+    """(p50, p90) en segundos por carril; con menos de MIN_MUESTRAS_ETA viajes, por distancia a VELOCIDAD_KMH.
+
+    `n` (k,), `hist` (k, N_BINS) y `km` (k,) son arreglos alineados.
+    """
+    n = np.asarray(n)
+    base = np.asarray(km, dtype=float) / VELOCIDAD_KMH * 3600.0
+    p = percentiles(hist, [0.5, 0.9]) if len(n) else np.zeros((0, 2))
+    historial = n >= MIN_MUESTRAS_ETA
+    return np.where(historial, p[:, 0], base), np.where(historial, p[:, 1], base * 1.25)
+
+
+def hist_a_texto(hist):
+    """Histograma -> JSON compacto para la columna de texto (solo hasta el último bin no vacío)."""
+    valores = np.asarray(hist, dtype=np.int64)
+    ocupados = np.nonzero(valores)[0]
+    return json.dumps(valores[:ocupados[-1] + 1 if len(ocupados) else 0].tolist(), separators=(',', ':'))
+
+
+def hist_de_texto(texto):
+    valores = json.loads(texto) if texto else []
+    hist = np.zeros(N_BINS, dtype=np.int64)
+    hist[:len(valores)] = valores
+    return hist
@@ -0,0 +1,189 @@
+"""ETA por carril desde los agregados (LaneStat) frente a recorrer el historial.
+
+Siembra --historial rutas completadas (con inicio y término) repartidas en los
+carriles entre ciudades y --flota rutas en curso de un despachador. Mide:
+
+- reconstruir los agregados de todo el historial (`flask carriles rebuild`);
+- GET /analitica/eta con los agregados, contra calcular el mismo p50 por
+  carril leyendo todas las rutas completadas de esos carriles en cada request;
+- el costo extra de completar una ruta (mantener su carril) en POST
+  /update_route_status, contra el mismo endpoint sin la actualización.
+
+Al final completa rutas por los tres caminos (chofer, masivo, ORM), reabre y
+borra algunas, y verifica que los agregados incrementales coincidan con la
+reconstrucción.
+
+Uso: python benchmarks/bench_analitica.py [--historial 200000] [--flota 300] [--repeticiones 50]
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import comun
+import analitica
+import main
+from ciudades import indice as indice_ciudades
+from main import (app, db, User, Truck, Route, LaneStat, COORDS_CIUDADES, ESTADOS_EN_DESTINO,
+                  reconstruir_carriles, reconstruir_stats, verificar_carriles)
+
+
+def sembrar(n_historial, n_flota):
+    comun.reiniciar_db()
+    ciudades = list(indice_ciudades)[:30]
+    ahora = datetime.utcnow()
+    with app.app_context():
+        desp = User(username='desp', role='despachador', password=comun.PASSWORD_HASH)
+        db.session.add_all([desp, User(username='admin', role='admin', password=comun.PASSWORD_HASH)])
+        db.session.flush()
+        camiones = []
+        for i in range(50):
+            chofer = User(username=f'chofer{i}', role='chofer', password=comun.PASSWORD_HASH)
+            camiones.append(Truck(plate=f'ETA{i:03d}', status='en ruta', driver=chofer, dispatcher_id=desp.id))
+        db.session.add_all(camiones)
+        db.session.flush()
+        filas = []
+        for i in range(n_historial + n_flota):
+            origen, destino = random.sample(ciudades, 2)
+            km = float(analitica.distancia_km(origen.coords, destino.coords)[0])
+            inicio = ahora - timedelta(days=random.uniform(0, 365))
+            en_curso = i >= n_historial
+            filas.append({
+                'origin': origen.nombre, 'destination': destino.nombre,
+                'origin_city_id': origen.id, 'destination_city_id': destino.id,
+                'status': 'en_progreso' if en_curso else 'completada',
+                'truck_id': camiones[i % len(camiones)].id,
+                'start_time': ahora - timedelta(hours=random.uniform(0, 5)) if en_curso else inicio,
+                'completed_at': None if en_curso else
+                inicio + timedelta(hours=km / random.gauss(60, 8), minutes=random.expovariate(1 / 20)),
+            })
+        db.session.execute(db.insert(Route.__table__), filas)
+        db.session.commit()
+        reconstruir_stats()
+
+
+def eta_sin_agregados(despachador_id):
+    """Lo que haría un panel sin LaneStat: leer todas las duraciones de los carriles de la flota."""
+    en_curso = db.session.execute(
+        db.select(Route.id, Route.origin_city_id, Route.destination_city_id, Route.start_time)
+        .join(Truck, Route.truck_id == Truck.id)
+        .where(Truck.dispatcher_id == despachador_id, Route.status == 'en_progreso')).all()
+    pares = {(o, d) for _, o, d, _ in en_curso}
+    historial = db.session.execute(
+        db.select(Route.origin_city_id, Route.destination_city_id, Route.start_time, Route.completed_at)
+        .where(Route.status.in_(ESTADOS_EN_DESTINO), Route.completed_at.isnot(None),
+               db.tuple_(Route.origin_city_id, Route.destination_city_id).in_(pares))).all()
+    claves, agregados = analitica.agregar(*analitica.muestras(historial, COORDS_CIUDADES))
+    p50 = dict(zip(map(tuple, claves.tolist()), analitica.percentiles(agregados['hist'], [0.5])[:, 0]))
+    return {r: inicio + timedelta(seconds=float(p50.get((o, d), 0.0))) for r, o, d, inicio in en_curso}
+
+
+def medir_completar(client, route_ids):
+    tiempos = []
+    for route_id in route_ids:
+        t0 = time.perf_counter()
+        client.post(f'/update_route_status/{route_id}/completada')
+        tiempos.append((time.perf_counter() - t0) * 1000.0)
+    return comun.percentil(tiempos, 50)
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--historial', type=int, default=200000)
+    parser.add_argument('--flota', type=int, default=300)
+    parser.add_argument('--repeticiones', type=int, default=50)
+    args = parser.parse_args()
+
+    sembrar(args.historial, args.flota)
+    with app.app_context():
+        t0 = time.perf_counter()
+        n_carriles = reconstruir_carriles()
+        print(f"Reconstrucción: {args.historial:,} rutas -> {n_carriles} carriles en "
+              f"{time.perf_counter() - t0:.2f}s")
+        despachador_id = db.session.query(User.id).filter_by(username='desp').scalar()
+
+    client = app.test_client()
+    comun.login(client, 'desp')
+    with comun.contar_sql() as c:
+        tiempos = comun.cronometrar(lambda: client.get('/analitica/eta'), args.repeticiones)
+    con = comun.percentil(tiempos, 50), c[0] / args.repeticiones
+
+    def sin():
+        with app.app_context():
+            eta_sin_agregados(despachador_id)
+    tiempos = comun.cronometrar(sin, max(args.repeticiones // 10, 3))
+    sin_p50 = comun.percentil(tiempos, 50)
+    print(f"ETA de {args.flota} rutas en curso:")
+    print(f"  /analitica/eta (LaneStat):   {con[0]:8.1f}ms p50 ({con[1]:.1f} queries)")
+    print(f"  recorriendo el historial:    {sin_p50:8.1f}ms p50 -> {sin_p50 / con[0]:.0f}x")
+
+    # Completar rutas: con y sin mantener el carril (registrar_duraciones reemplazado por un no-op)
+    with app.app_context():
+        por_chofer = {}
+        for route_id, chofer in db.session.query(Route.id, User.username).join(Truck, Route.truck_id == Truck.id) \
+                .join(User, Truck.driver_id == User.id).filter(Route.status == 'en_progreso'):
+            por_chofer.setdefault(chofer, []).append(route_id)
+    chofer, rutas = max(por_chofer.items(), key=lambda par: len(par[1]))
+    chofer_client = app.test_client()
+    comun.login(chofer_client, chofer)
+    mitad = len(rutas) // 2
+    if mitad:
+        original = main.registrar_duraciones
+        main.registrar_duraciones = lambda conn, filas: 0
+        try:
+            sin_carril = medir_completar(chofer_client, rutas[:mitad])
+        finally:
+            main.registrar_duraciones = original
+        with app.app_context():
+            reconstruir_carriles()  # cuenta las completadas con el no-op
+        con_carril = medir_completar(chofer_client, rutas[mitad:])
+        print(f"Completar una ruta: {sin_carril:.2f}ms sin mantener el carril, {con_carril:.2f}ms manteniéndolo")
+    else:
+        # Flota chica: ningún chofer tiene dos rutas en curso para comparar
+        print(f"Completar una ruta: sin medir ({chofer} tiene {len(rutas)} ruta en curso; subir --flota)")
+
+    # Los tres caminos incrementales (el chofer recién, masivo y ORM) deben dar lo mismo que reconstruir
+    with app.app_context():
+        en_curso = [r for (r,) in db.session.query(Route.id).filter(Route.status == 'en_progreso')]
+    random.shuffle(en_curso)
+    mitad = len(en_curso) // 2
+    admin = app.test_client()
+    comun.login(admin, 'admin')
+    admin.post('/admin/routes/bulk', json={'accion': 'estado', 'status': 'completada', 'ids': en_curso[:mitad]})
+    with app.app_context():
+        for route_id in en_curso[mitad:]:
+            db.session.get(Route, route_id).status = 'completada'
+        db.session.commit()
+    # Reabrir descuenta: un tercio por el masivo, otro por el ORM y unas pocas se borran;
+    # la mitad de las reabiertas se vuelve a completar
+    tercio = len(en_curso) // 3
+    admin.post('/admin/routes/bulk', json={'accion': 'estado', 'status': 'en_progreso', 'ids': en_curso[:tercio]})
+    with app.app_context():
+        for route_id in en_curso[tercio:2 * tercio]:
+            db.session.get(Route, route_id).status = 'en_progreso'
+        for route_id in en_curso[-3:]:
+            db.session.delete(db.session.get(Route, route_id))
+        db.session.commit()
+    admin.post('/admin/routes/bulk', json={'accion': 'estado', 'status': 'completada',
+                                           'ids': en_curso[tercio // 2:tercio + tercio // 2]})
+
+    def agregados_guardados():
+        return {(f.origin_city_id, f.destination_city_id): (f.n, f.mean, f.m2, f.min_s, f.max_s, f.on_time, f.hist)
+                for f in LaneStat.query if f.n}
+    with app.app_context():
+        incremental = agregados_guardados()
+        diferencias = verificar_carriles()
+        reconstruir_carriles()
+        reconstruido = agregados_guardados()
+    iguales = incremental.keys() == reconstruido.keys() and all(
+        incremental[k][0] == reconstruido[k][0] and incremental[k][5:] == reconstruido[k][5:]
+        and np.allclose(incremental[k][1:5], reconstruido[k][1:5], rtol=1e-6, atol=1e-3) for k in reconstruido)
+    if diferencias or not iguales:
+        raise SystemExit(f"FALLA: agregados incrementales distintos de la reconstrucción {diferencias}")
+    print("OK: agregados incrementales = reconstrucción")
+
+
+if __name__ == '__main__':
+    main_bench()
@@ -0,0 +1,125 @@
+"""Asignación automática: tiempo del optimizador y calidad del voraz frente al óptimo.
+
+Parte 1 (solo NumPy): matrices de n camiones × n rutas con puntos uniformes en
+Chile (peor caso para el húngaro: casi sin empates) y con puntos en ciudades
+reales (el caso normal: muchos empates). Reporta ms y km en vacío de cada método.
+
+Parte 2 (de punta a punta): un despachador con --camiones camiones libres y
+--pendientes rutas pendientes; mide GET /despacho/auto y el POST que aplica la
+propuesta en una transacción.
+
+Uso: python benchmarks/bench_despacho.py [--tamanos 100,250,500,1000] [--camiones 300] [--pendientes 20000]
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+
+import comun
+import despacho
+from ciudades import indice as indice_ciudades
+from main import app, db, User, Truck, Route, Tracking, posiciones
+
+
+def puntos_uniformes(rng, n):
+    return np.column_stack([rng.uniform(-53.0, -18.5, n), rng.uniform(-73.5, -69.5, n)])
+
+
+def puntos_en_ciudades(rng, n):
+    ciudades = np.array([c.coords for c in indice_ciudades])
+    return ciudades[rng.integers(0, len(ciudades), n)]
+
+
+def parte_optimizador(tamanos, repeticiones):
+    rng = np.random.default_rng(42)
+    print(f"{'n×n':>10} {'puntos':>9} {'matriz ms':>10} {'húngaro ms':>11} {'voraz ms':>9} "
+          f"{'km óptimo':>10} {'km voraz':>9} {'brecha':>7}")
+    peor = 0.0
+    for n in tamanos:
+        for nombre, generar in (('uniforme', puntos_uniformes), ('ciudades', puntos_en_ciudades)):
+            camiones, rutas = generar(rng, n), generar(rng, n)
+            t_matriz, t_hungaro, t_voraz = [], [], []
+            for _ in range(repeticiones):
+                t0 = time.perf_counter()
+                costos = despacho.matriz_costos(camiones, rutas)
+                t_matriz.append((time.perf_counter() - t0) * 1000)
+                t0 = time.perf_counter()
+                f_h, c_h = despacho.hungaro(costos)
+                t_hungaro.append((time.perf_counter() - t0) * 1000)
+                t0 = time.perf_counter()
+                f_v, c_v = despacho.voraz(costos)
+                t_voraz.append((time.perf_counter() - t0) * 1000)
+            km_h, km_v = costos[f_h, c_h].sum(), costos[f_v, c_v].sum()
+            peor = max(peor, min(t_matriz) + min(t_hungaro))
+            print(f"{f'{n}×{n}':>10} {nombre:>9} {min(t_matriz):>10.1f} {min(t_hungaro):>11.1f} "
+                  f"{min(t_voraz):>9.1f} {km_h:>10.0f} {km_v:>9.0f} {100 * (km_v / km_h - 1):>6.1f}%")
+    return peor
+
+
+def sembrar(n_camiones, n_pendientes):
+    comun.reiniciar_db()
+    ciudades = list(indice_ciudades)
+    with app.app_context():
+        desp = User(username='desp', role='despachador', password=comun.PASSWORD_HASH)
+        db.session.add(desp)
+        db.session.flush()
+        for i in range(n_camiones):
+            chofer = User(username=f'chofer{i}', role='chofer', password=comun.PASSWORD_HASH)
+            truck = Truck(plate=f'DSP{i:05d}', status='disponible', driver=chofer, dispatcher_id=desp.id)
+            ciudad = random.choice(ciudades)
+            # Una ruta completada deja al camión en su destino
+            db.session.add(Route(origin=random.choice(ciudades).nombre, destination=ciudad.nombre,
+                                 status='completada', truck=truck))
+        db.session.commit()
+        filas = []
+        for _ in range(n_pendientes):
+            origen, destino = random.sample(ciudades, 2)
+            filas.append({'origin': origen.nombre, 'destination': destino.nombre,
+                          'origin_city_id': origen.id, 'destination_city_id': destino.id,
+                          'status': 'pendiente'})
+        db.session.execute(db.insert(Route.__table__), filas)
+        db.session.commit()
+        db.session.query(Tracking).delete()
+        db.session.commit()
+    posiciones.__init__()
+    posiciones.calentado = True
+
+
+def parte_http(n_camiones, n_pendientes):
+    sembrar(n_camiones, n_pendientes)
+    client = comun.app.test_client()
+    comun.login(client, 'desp')
+    with comun.contar_sql() as c:
+        t0 = time.perf_counter()
+        plan = client.get('/despacho/auto').get_json()
+        ms_plan = (time.perf_counter() - t0) * 1000
+    t0 = time.perf_counter()
+    resp = client.post('/despacho/auto/aplicar', json={'asignaciones': plan['asignaciones']}).get_json()
+    ms_aplicar = (time.perf_counter() - t0) * 1000
+    print(f"\n{n_camiones} camiones, {n_pendientes} pendientes -> {plan['rutas_candidatas']} candidatas, "
+          f"método {plan['metodo']}")
+    print(f"  GET /despacho/auto:          {ms_plan:7.1f} ms ({c[0]} queries, optimizador {plan['ms']} ms)")
+    print(f"  POST /despacho/auto/aplicar: {ms_aplicar:7.1f} ms ({len(resp['aplicadas'])} asignadas, "
+          f"{len(resp['rechazadas'])} rechazadas, {plan['km_vacio_total']} km en vacío)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tamanos', default='100,250,500,1000')
+    parser.add_argument('--repeticiones', type=int, default=3)
+    parser.add_argument('--camiones', type=int, default=300)
+    parser.add_argument('--pendientes', type=int, default=20000)
+    parser.add_argument('--limite-ms', type=float, default=1000.0,
+                        help='falla si matriz + húngaro del mayor tamaño supera esto')
+    args = parser.parse_args()
+
+    peor = parte_optimizador([int(x) for x in args.tamanos.split(',')], args.repeticiones)
+    parte_http(args.camiones, args.pendientes)
+    if peor > args.limite_ms:
+        raise SystemExit(f"LENTO: matriz + húngaro tardó {peor:.0f} ms (límite {args.limite_ms:.0f} ms)")
+    print(f"\nOK: peor caso matriz + húngaro {peor:.0f} ms")
+
+
+if __name__ == '__main__':
+    main()
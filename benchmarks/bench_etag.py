@@ -0,0 +1,107 @@
+"""Sondeos de los mapas con ETag: 200 completo vs 304 cuando nada cambió, y tamaño con gzip.
+
+Un despachador con --rutas rutas en su flota, otro despachador con la misma
+cantidad y un admin. Mide cada endpoint de mapa sin validador (respuesta
+completa) y con el ETag de la respuesta anterior (304): latencia, queries y
+bytes. También comprueba que un cambio en la otra flota no invalida el ETag
+del primer despachador y que sí lo hace uno en la suya.
+
+Uso: python benchmarks/bench_etag.py [--rutas 5000] [--repeticiones 100]
+"""
+import argparse
+
+import comun
+from ciudades import indice as indice_ciudades
+from main import app, db, User, Truck, Route, reconstruir_stats
+
+ENDPOINTS = [
+    ('desp0', '/mapa_despachador_data'),
+    ('admin', '/mapa_admin_data'),
+    ('admin', '/admin/routes_data?limit=500'),
+]
+
+
+def sembrar(n_rutas):
+    comun.reiniciar_db()
+    ciudades = list(indice_ciudades)
+    with app.app_context():
+        db.session.add(User(username='admin', role='admin', password=comun.PASSWORD_HASH))
+        for d in range(2):
+            desp = User(username=f'desp{d}', role='despachador', password=comun.PASSWORD_HASH)
+            db.session.add(desp)
+            db.session.flush()
+            camiones = []
+            for i in range(50):
+                chofer = User(username=f'chofer{d}_{i}', role='chofer', password=comun.PASSWORD_HASH)
+                camiones.append(Truck(plate=f'ETG{d}{i:03d}', status='en ruta', driver=chofer,
+                                      dispatcher_id=desp.id))
+            db.session.add_all(camiones)
+            db.session.flush()
+            filas = []
+            for i in range(n_rutas):
+                origen, destino = ciudades[i % len(ciudades)], ciudades[(i * 7 + 3) % len(ciudades)]
+                filas.append({'origin': origen.nombre, 'destination': destino.nombre,
+                              'origin_city_id': origen.id, 'destination_city_id': destino.id,
+                              'status': 'en_progreso' if i % 3 else 'completada',
+                              'truck_id': camiones[i % len(camiones)].id})
+            db.session.execute(db.insert(Route.__table__), filas)
+        db.session.commit()
+        reconstruir_stats()
+
+
+def medir(client, url, repeticiones, etag=None):
+    headers = {'Accept-Encoding': 'gzip'}
+    if etag:
+        headers['If-None-Match'] = etag
+    ultima = []
+
+    def pedir():
+        ultima[:] = [client.get(url, headers=headers)]
+
+    with comun.contar_sql() as c:
+        tiempos = comun.cronometrar(pedir, repeticiones)
+    resp = ultima[0]
+    return resp, comun.percentil(tiempos, 50), c[0] / repeticiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rutas', type=int, default=5000)
+    parser.add_argument('--repeticiones', type=int, default=100)
+    args = parser.parse_args()
+
+    sembrar(args.rutas)
+    clientes = {}
+    for nombre in ('admin', 'desp0', 'desp1', 'chofer1_0'):
+        clientes[nombre] = app.test_client()
+        comun.login(clientes[nombre], nombre)
+
+    print(f"{'endpoint':<32} {'200 p50':>9} {'SQL':>5} {'bytes gzip':>11} {'bytes':>9} "
+          f"{'304 p50':>9} {'SQL':>5}")
+    for nombre, url in ENDPOINTS:
+        client = clientes[nombre]
+        completo, p50, sql = medir(client, url, max(args.repeticiones // 10, 3))
+        plano = client.get(url)
+        _, p50_304, sql_304 = medir(client, url, args.repeticiones, completo.headers['ETag'])
+        print(f"{url:<32} {p50:>7.1f}ms {sql:>5.1f} {len(completo.data):>11,} {len(plano.data):>9,} "
+              f"{p50_304:>7.2f}ms {sql_304:>5.1f}")
+
+    # Un cambio en la flota 1 no invalida el mapa de la flota 0; uno en la flota 0 sí
+    desp0, chofer1 = clientes['desp0'], clientes['chofer1_0']
+    etag = desp0.get('/mapa_despachador_data').headers['ETag']
+    with app.app_context():
+        ajena = db.session.query(Route.id).join(Truck).filter(
+            Truck.plate == 'ETG1000', Route.status == 'en_progreso').first()[0]
+        propia = db.session.query(Route.id).join(Truck).filter(Truck.plate == 'ETG0000').first()[0]
+    chofer1.post(f'/update_route_status/{ajena}/completada')
+    tras_ajena = desp0.get('/mapa_despachador_data', headers={'If-None-Match': etag}).status_code
+    clientes['admin'].post('/admin/routes/bulk', json={'accion': 'estado', 'status': 'completada', 'ids': [propia]})
+    tras_propia = desp0.get('/mapa_despachador_data', headers={'If-None-Match': etag}).status_code
+    print(f"cambio en otra flota -> {tras_ajena}; cambio en la propia -> {tras_propia}")
+    if (tras_ajena, tras_propia) != (304, 200):
+        raise SystemExit("FALLA: el ETag no sigue los cambios de la flota")
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Carga del pub/sub de /mapa_stream: latencia de fan-out con muchos suscriptores.
+
+Cada suscriptor es un hilo bloqueado en `esperar()`, igual que un stream SSE.
+El publicador emite eventos con marca de tiempo y cada suscriptor mide cuánto
+tardó en recibirlos. Los eventos se coalescen por diseño, así que se reporta
+también cuántos vio cada suscriptor.
+
+Uso: python benchmarks/bench_fanout.py [--suscriptores 500] [--eventos 200] [--intervalo-ms 5]
+"""
+import argparse
+import threading
+import time
+
+import comun
+from eventos import Broker
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--suscriptores', type=int, default=500)
+    parser.add_argument('--eventos', type=int, default=200)
+    parser.add_argument('--intervalo-ms', type=float, default=5.0)
+    parser.add_argument('--despachadores', type=int, default=50,
+                        help='los suscriptores se reparten entre estos usuarios; el 10%% es admin')
+    args = parser.parse_args()
+
+    broker = Broker()
+    latencias = []
+    recibidos = []
+    lock = threading.Lock()
+    listos = threading.Barrier(args.suscriptores + 1)
+    fin = threading.Event()
+
+    def suscriptor(i):
+        sub = broker.suscribir(i % args.despachadores, ve_todo=(i % 10 == 0))
+        propias, vistos = [], 0
+        listos.wait()
+        while not fin.is_set():
+            evento = sub.esperar(timeout=0.2)
+            if evento is not None:
+                propias.append((time.perf_counter() - evento['t']) * 1000.0)
+                vistos += 1
+        broker.desuscribir(sub)
+        with lock:
+            latencias.extend(propias)
+            recibidos.append(vistos)
+
+    hilos = [threading.Thread(target=suscriptor, args=(i,), daemon=True)
+             for i in range(args.suscriptores)]
+    for h in hilos:
+        h.start()
+    listos.wait()
+
+    t0 = time.perf_counter()
+    costo_publicar = []
+    for seq in range(1, args.eventos + 1):
+        # Cada evento le interesa a 3 despachadores distintos (más los admins)
+        audiencia = {seq % args.despachadores, (seq * 7) % args.despachadores,
+                     (seq * 13) % args.despachadores}
+        tp = time.perf_counter()
+        broker.publicar({'seq': seq, 'audiencia': audiencia, 't': time.perf_counter()})
+        costo_publicar.append((time.perf_counter() - tp) * 1000.0)
+        time.sleep(args.intervalo_ms / 1000.0)
+    duracion = time.perf_counter() - t0
+
+    time.sleep(0.3)
+    fin.set()
+    for h in hilos:
+        h.join()
+
+    print(f"suscriptores={args.suscriptores} eventos={args.eventos} en {duracion:.2f}s")
+    print(f"publicar(): p50={comun.percentil(costo_publicar, 50):.3f}ms "
+          f"p99={comun.percentil(costo_publicar, 99):.3f}ms")
+    if latencias:
+        print(f"latencia fan-out: p50={comun.percentil(latencias, 50):.2f}ms "
+              f"p95={comun.percentil(latencias, 95):.2f}ms "
+              f"p99={comun.percentil(latencias, 99):.2f}ms max={max(latencias):.2f}ms")
+    print(f"entregas={len(latencias)} promedio por suscriptor={sum(recibidos) / len(recibidos):.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,392 @@
+"""Benchmark HTTP de punta a punta: sesiones realistas por rol sobre una DB sembrada.
+
+Cada sesión inicia sesión una vez y repite el flujo típico de su rol:
+
+- chofer:      dashboard_chofer, /mapa_data (3 polls), toma una ruta pendiente
+               (update_route_status en_progreso) y la completa
+- despachador: dashboard_despachador, /mapa_despachador_data (3 polls),
+               asignar_chofer_confirm de una ruta pendiente a un camión propio
+- admin:       dashboard_admin, /admin/routes, /mapa_admin_data (viewport de Chile)
+
+Reporta p50/p95/p99, requests por segundo y sentencias SQL por request de cada
+endpoint, y guarda los resultados en JSON para comparar entre commits:
+
+    python benchmarks/bench_http.py --out base.json
+    git checkout otra-rama
+    python benchmarks/bench_http.py --compare base.json
+
+Sin --db siembra una DB temporal con seed.py. Con --db trabaja sobre una copia
+(los flujos escriben), así cada corrida parte del mismo estado. Con --wsgi las
+requests pasan por un servidor werkzeug local en lugar del test client de Flask.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.cookiejar import CookieJar
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BBOX_CHILE = '-56,-76,-17,-66'
+
+
+def parsear_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='DB sembrada con seed.py (se usa una copia)')
+    parser.add_argument('--en-sitio', action='store_true', help='usar --db directamente, sin copiar')
+    parser.add_argument('--seed-args', default='--users 300 --trucks 200 --routes 20k --pings 100k --random-seed 1',
+                        help='argumentos de seed.py cuando no se pasa --db')
+    parser.add_argument('--password', default='1234', help='contraseña de los usuarios sembrados')
+    parser.add_argument('--choferes', type=int, default=8, help='sesiones de chofer')
+    parser.add_argument('--despachadores', type=int, default=3, help='sesiones de despachador')
+    parser.add_argument('--admins', type=int, default=1, help='sesiones de admin')
+    parser.add_argument('--iteraciones', type=int, default=10, help='flujos completos por sesión')
+    parser.add_argument('--hilos', type=int, default=4, help='sesiones en paralelo')
+    parser.add_argument('--wsgi', action='store_true', help='servidor werkzeug local en vez del test client')
+    parser.add_argument('--out', help='archivo JSON de resultados')
+    parser.add_argument('--compare', help='JSON de una corrida anterior para comparar')
+    parser.add_argument('--umbral', type=float, default=20.0,
+                        help='%% de aumento de p95 que se considera regresión (default 20)')
+    return parser.parse_args(argv)
+
+
+args = parsear_args()
+_tmp = tempfile.mkdtemp(prefix='logitrack-http-')
+if args.db and args.en_sitio:
+    ruta_db = os.path.abspath(args.db)
+elif args.db:
+    ruta_db = os.path.join(_tmp, 'bench.db')
+    shutil.copy(args.db, ruta_db)
+else:
+    ruta_db = os.path.join(_tmp, 'bench.db')
+    print(f"Sembrando DB temporal: seed.py {args.seed_args}")
+    subprocess.run([sys.executable, os.path.join(RAIZ, 'seed.py'), '--db', ruta_db,
+                    '--password', args.password] + args.seed_args.split(), check=True, cwd=RAIZ)
+os.environ['DATABASE_URL'] = 'sqlite:///' + ruta_db
+
+import comun  # noqa: E402
+from flask import g  # noqa: E402
+from sqlalchemy import event, func  # noqa: E402
+from main import app, db, User, Truck, Route, Tracking  # noqa: E402
+
+comun.PASSWORD = args.password
+
+# ========================
+# CONTEO DE SQL POR REQUEST
+# ========================
+# Cada request corre entero en un hilo (test client o servidor threaded), así
+# que basta con un contador en `g` que se devuelve en un header.
+
+
+def _contar(conn, cursor, statement, parameters, context, executemany):
+    try:
+        g.bench_sql += 1
+    except (AttributeError, RuntimeError):
+        pass  # fuera de un request (siembra, calentamiento)
+
+
+@app.before_request
+def _bench_inicio():
+    g.bench_sql = 0
+
+
+@app.after_request
+def _bench_fin(response):
+    response.headers['X-Bench-SQL'] = str(getattr(g, 'bench_sql', 0))
+    return response
+
+
+with app.app_context():
+    event.listen(db.engine, 'before_cursor_execute', _contar)
+
+
+# ========================
+# CLIENTES
+# ========================
+class ClienteTest:
+    """Sesión sobre el test client de Flask."""
+
+    def __init__(self):
+        self.client = app.test_client()
+
+    def login(self, username):
+        comun.login(self.client, username)
+
+    def pedir(self, metodo, url):
+        resp = self.client.open(url, method=metodo)
+        resp.get_data()
+        return resp.status_code, int(resp.headers.get('X-Bench-SQL', 0))
+
+
+class _SinRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *a, **kw):
+        return None
+
+
+class ClienteWSGI:
+    """Sesión HTTP real contra el servidor local (cookies propias, sin seguir redirects)."""
+
+    base = None
+
+    def __init__(self):
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(CookieJar()), _SinRedirect())
+
+    def login(self, username):
+        datos = urllib.parse.urlencode({'username': username, 'password': comun.PASSWORD}).encode()
+        status, _ = self._abrir(urllib.request.Request(self.base + '/login', data=datos))
+        if status != 302:
+            raise RuntimeError(f'login falló para {username}: {status}')
+
+    def pedir(self, metodo, url):
+        datos = b'' if metodo == 'POST' else None
+        return self._abrir(urllib.request.Request(self.base + url, data=datos, method=metodo))
+
+    def _abrir(self, req):
+        try:
+            with self.opener.open(req) as resp:
+                resp.read()
+                return resp.status, int(resp.headers.get('X-Bench-SQL', 0))
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code, int(e.headers.get('X-Bench-SQL', 0))
+
+
+def levantar_wsgi():
+    from werkzeug.serving import make_server
+    servidor = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    ClienteWSGI.base = f'http://127.0.0.1:{servidor.server_port}'
+    return servidor
+
+
+# ========================
+# SESIONES POR ROL
+# ========================
+class Registro:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencias = defaultdict(list)
+        self.sql = defaultdict(list)
+        self.errores = defaultdict(int)
+
+    def medir(self, cliente, nombre, metodo, url, grabar=True):
+        t0 = time.perf_counter()
+        status, n_sql = cliente.pedir(metodo, url)
+        ms = (time.perf_counter() - t0) * 1000.0
+        if not grabar:
+            return status
+        with self._lock:
+            self.latencias[nombre].append(ms)
+            self.sql[nombre].append(n_sql)
+            if status >= 400:
+                self.errores[nombre] += 1
+        return status
+
+
+def preparar_actores():
+    """Elige usuarios con datos reales en la DB y arma la cola de rutas pendientes."""
+    with app.app_context():
+        choferes = (
+            db.session.query(User.username)
+            .join(Truck, Truck.driver_id == User.id)
+            .filter(User.role == 'chofer')
+            .order_by(User.id).limit(args.choferes).all()
+        )
+        despachadores = (
+            db.session.query(User.id, User.username, func.min(Truck.id))
+            .join(Truck, Truck.dispatcher_id == User.id)
+            .filter(User.role == 'despachador')
+            .group_by(User.id).order_by(User.id).limit(args.despachadores).all()
+        )
+        admins = User.query.filter_by(role='admin').order_by(User.id).limit(args.admins).all()
+        necesarias = (args.choferes + args.despachadores) * (args.iteraciones + 1)
+        pendientes = (
+            db.session.query(Route.id)
+            .filter(Route.status == 'pendiente', Route.truck_id.is_(None))
+            .order_by(Route.id).limit(necesarias).all()
+        )
+        tamano = {
+            'users': User.query.count(),
+            'trucks': Truck.query.count(),
+            'routes': Route.query.count(),
+            'tracking': Tracking.query.count(),
+        }
+    if not choferes or not despachadores or not admins:
+        raise SystemExit('La DB no tiene choferes con camión, despachadores con flota y un admin')
+    sesiones = (
+        [('chofer', u, None) for (u,) in choferes]
+        + [('despachador', u, truck_id) for _, u, truck_id in despachadores]
+        + [('admin', a.username, None) for a in admins]
+    )
+    return sesiones, deque(r for (r,) in pendientes), tamano
+
+
+def flujo_chofer(cliente, reg, pendientes, grabar):
+    reg.medir(cliente, 'chofer dashboard_chofer', 'GET', '/dashboard_chofer', grabar)
+    for _ in range(3):
+        reg.medir(cliente, 'chofer /mapa_data', 'GET', '/mapa_data', grabar)
+    try:
+        route_id = pendientes.popleft()
+    except IndexError:
+        return
+    reg.medir(cliente, 'chofer update_route_status', 'POST',
+              f'/update_route_status/{route_id}/en_progreso', grabar)
+    reg.medir(cliente, 'chofer update_route_status', 'POST',
+              f'/update_route_status/{route_id}/completada', grabar)
+
+
+def flujo_despachador(cliente, reg, pendientes, truck_id, grabar):
+    reg.medir(cliente, 'despachador dashboard_despachador', 'GET', '/dashboard_despachador', grabar)
+    for _ in range(3):
+        reg.medir(cliente, 'despachador /mapa_despachador_data', 'GET', '/mapa_despachador_data', grabar)
+    try:
+        route_id = pendientes.popleft()
+    except IndexError:
+        return
+    reg.medir(cliente, 'despachador asignar_chofer_confirm', 'POST',
+              f'/asignar_chofer_confirm/{route_id}/{truck_id}', grabar)
+
+
+def flujo_admin(cliente, reg, pendientes, grabar):
+    reg.medir(cliente, 'admin dashboard_admin', 'GET', '/dashboard_admin', grabar)
+    reg.medir(cliente, 'admin /admin/routes', 'GET', '/admin/routes', grabar)
+    reg.medir(cliente, 'admin /mapa_admin_data', 'GET', f'/mapa_admin_data?bbox={BBOX_CHILE}&zoom=5', grabar)
+
+
+def correr_sesion(rol, username, truck_id, reg, pendientes):
+    cliente = ClienteWSGI() if args.wsgi else ClienteTest()
+    cliente.login(username)
+    for i in range(args.iteraciones + 1):
+        grabar = i > 0  # la primera vuelta calienta cachés y no se mide
+        if rol == 'chofer':
+            flujo_chofer(cliente, reg, pendientes, grabar)
+        elif rol == 'despachador':
+            flujo_despachador(cliente, reg, pendientes, truck_id, grabar)
+        else:
+            flujo_admin(cliente, reg, pendientes, grabar)
+
+
+# ========================
+# REPORTE
+# ========================
+def resumir(reg, segundos):
+    endpoints = {}
+    for nombre, tiempos in sorted(reg.latencias.items()):
+        sql = reg.sql[nombre]
+        endpoints[nombre] = {
+            'n': len(tiempos),
+            'p50_ms': round(comun.percentil(tiempos, 50), 3),
+            'p95_ms': round(comun.percentil(tiempos, 95), 3),
+            'p99_ms': round(comun.percentil(tiempos, 99), 3),
+            'media_ms': round(sum(tiempos) / len(tiempos), 3),
+            # rps de un solo worker atendiendo solo este endpoint
+            'rps_serial': round(1000.0 * len(tiempos) / sum(tiempos), 1),
+            'sql_por_request': round(sum(sql) / len(sql), 2),
+            'sql_max': max(sql),
+            'errores': reg.errores[nombre],
+        }
+    total = sum(e['n'] for e in endpoints.values())
+    return endpoints, {'requests': total, 'segundos': round(segundos, 3), 'rps': round(total / segundos, 1)}
+
+
+def commit_actual():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=RAIZ,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def imprimir(endpoints, total):
+    print(f"\n{'endpoint':<42} {'n':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'rps':>7} {'sql':>6} {'err':>4}")
+    for nombre, e in endpoints.items():
+        print(f"{nombre:<42} {e['n']:>5} {e['p50_ms']:>8.2f} {e['p95_ms']:>8.2f} {e['p99_ms']:>8.2f} "
+              f"{e['rps_serial']:>7.1f} {e['sql_por_request']:>6.1f} {e['errores']:>4}")
+    print(f"\nTotal: {total['requests']} requests en {total['segundos']:.2f}s = {total['rps']:.1f} req/s "
+          f"({args.hilos} sesiones en paralelo)")
+
+
+def comparar(endpoints, archivo, tamano_db):
+    """Compara contra una corrida anterior; devuelve la lista de regresiones."""
+    with open(archivo, encoding='utf-8') as f:
+        base = json.load(f)
+    meta = base.get('meta', {})
+    print(f"\nComparación contra {archivo} (commit {meta.get('commit')})")
+    if meta.get('modo') != ('wsgi' if args.wsgi else 'test_client') or meta.get('db') != tamano_db:
+        print("  ojo: la corrida base usó otro modo o una DB de otro tamaño")
+    print(f"{'endpoint':<42} {'p95 antes':>10} {'p95 ahora':>10} {'cambio':>8} {'sql antes':>10} {'sql ahora':>10}")
+    regresiones = []
+    for nombre, e in endpoints.items():
+        b = base['endpoints'].get(nombre)
+        if b is None:
+            continue
+        cambio = 100.0 * (e['p95_ms'] - b['p95_ms']) / b['p95_ms'] if b['p95_ms'] else 0.0
+        marca = ''
+        if cambio > args.umbral:
+            regresiones.append(f"{nombre}: p95 {b['p95_ms']:.2f} -> {e['p95_ms']:.2f} ms (+{cambio:.0f}%)")
+            marca = ' <'
+        if e['sql_por_request'] > b['sql_por_request']:
+            regresiones.append(f"{nombre}: SQL por request {b['sql_por_request']} -> {e['sql_por_request']}")
+            marca = ' <'
+        print(f"{nombre:<42} {b['p95_ms']:>10.2f} {e['p95_ms']:>10.2f} {cambio:>+7.0f}% "
+              f"{b['sql_por_request']:>10.1f} {e['sql_por_request']:>10.1f}{marca}")
+    return regresiones
+
+
+def main():
+    sesiones, pendientes, tamano = preparar_actores()
+    print(f"DB: {tamano['users']:,} usuarios, {tamano['trucks']:,} camiones, {tamano['routes']:,} rutas, "
+          f"{tamano['tracking']:,} pings")
+    servidor = levantar_wsgi() if args.wsgi else None
+
+    reg = Registro()
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.hilos) as pool:
+        futuros = [pool.submit(correr_sesion, rol, u, t, reg, pendientes) for rol, u, t in sesiones]
+        for f in futuros:
+            f.result()
+    segundos = time.perf_counter() - t0
+    if servidor is not None:
+        servidor.shutdown()
+
+    endpoints, total = resumir(reg, segundos)
+    imprimir(endpoints, total)
+
+    resultado = {
+        'meta': {
+            'commit': commit_actual(),
+            'fecha': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'modo': 'wsgi' if args.wsgi else 'test_client',
+            'db': tamano,
+            'args': {k: v for k, v in vars(args).items() if k not in ('out', 'compare')},
+        },
+        'total': total,
+        'endpoints': endpoints,
+    }
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+        print(f"Resultados en {args.out}")
+
+    if args.compare:
+        regresiones = comparar(endpoints, args.compare, tamano)
+        if regresiones:
+            raise SystemExit('REGRESIÓN:\n  ' + '\n  '.join(regresiones))
+        print("OK: sin regresiones")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Queries y latencia por sondeo con y sin la caché de identidades (identidad.py).
+
+Un chofer con --rutas rutas asignadas sondea GET /mapa_data (completo y en
+modo delta con ?since=) y abre /dashboard_chofer; un despachador sondea
+GET /mapa_despachador_data?since=. Cada endpoint se mide con la caché
+apagada (TTL 0: el user_loader consulta la DB en cada request) y encendida.
+
+Uso: python benchmarks/bench_identidad.py [--rutas 20] [--repeticiones 300]
+"""
+import argparse
+
+import comun
+from identidad import identidades
+from main import app, db, User, Truck, Route, cursor_actual
+
+ENDPOINTS = [
+    ('chofer', '/mapa_data'),
+    ('chofer', '/mapa_data?since={cursor}'),
+    ('chofer', '/dashboard_chofer'),
+    ('desp', '/mapa_despachador_data?since={cursor}'),
+]
+
+
+def sembrar(n_rutas):
+    comun.reiniciar_db()
+    with app.app_context():
+        desp = User(username='desp', role='despachador', password=comun.PASSWORD_HASH)
+        chofer = User(username='chofer', role='chofer', password=comun.PASSWORD_HASH)
+        db.session.add_all([desp, chofer])
+        db.session.flush()
+        truck = Truck(plate='IDN0001', status='en ruta', driver=chofer, dispatcher_id=desp.id)
+        for i in range(n_rutas):
+            db.session.add(Route(origin='Santiago', destination='Valparaíso',
+                                 status='en_progreso' if i % 2 else 'pendiente', truck=truck))
+        db.session.commit()
+
+
+def medir(clientes, cursor, repeticiones):
+    resultados = {}
+    for rol, url in ENDPOINTS:
+        url = url.format(cursor=cursor)
+        client = clientes[rol]
+        client.get(url)  # calentar (y llenar la caché si está encendida)
+        with comun.contar_sql() as c:
+            tiempos = comun.cronometrar(lambda: client.get(url), repeticiones)
+        resultados[url] = (c[0] / repeticiones, comun.percentil(tiempos, 50))
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rutas', type=int, default=20)
+    parser.add_argument('--repeticiones', type=int, default=300)
+    args = parser.parse_args()
+
+    sembrar(args.rutas)
+    clientes = {'chofer': app.test_client(), 'desp': app.test_client()}
+    comun.login(clientes['chofer'], 'chofer')
+    comun.login(clientes['desp'], 'desp')
+    with app.app_context():
+        cursor = cursor_actual()
+
+    ttl = identidades.ttl
+    identidades.ttl = 0
+    sin = medir(clientes, cursor, args.repeticiones)
+    identidades.ttl = ttl or 30
+    identidades.limpiar()
+    con = medir(clientes, cursor, args.repeticiones)
+
+    print(f"{'endpoint':<40} {'SQL sin caché':>13} {'SQL con caché':>13} {'p50 sin':>8} {'p50 con':>8}")
+    for url in sin:
+        (q_sin, p_sin), (q_con, p_con) = sin[url], con[url]
+        print(f"{url:<40} {q_sin:>13.1f} {q_con:>13.1f} {p_sin:>7.2f}ms {p_con:>7.2f}ms")
+    print(f"caché: {identidades.aciertos} aciertos, {identidades.fallos} fallos")
+    if any(con[url][0] >= sin[url][0] for url in sin):
+        raise SystemExit("FALLA: la caché no redujo las queries de algún endpoint")
+    print("OK: menos queries por sondeo con la caché")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""Importación masiva de rutas y cambios de estado por conjunto frente a fila por fila.
+
+Parte 1: un manifiesto CSV de --filas rutas (un --errores% con fallas) subido a
+POST /admin/import/routes, contra crear cada ruta con el ORM y un commit por
+ruta como hace /admin/routes/new (medido sobre una muestra y extrapolado).
+
+Parte 2: completar todas las rutas en curso con POST /admin/routes/bulk, contra
+cargar cada ruta y hacer commit una por una (también sobre una muestra).
+
+Al final verifica que los contadores de KPIs sigan consistentes.
+
+Uso: python benchmarks/bench_importacion.py [--filas 50000] [--camiones 2000] [--muestra 1000]
+"""
+import argparse
+import io
+import random
+import time
+
+import comun
+from ciudades import indice as indice_ciudades
+from main import app, db, User, Truck, Route, reconstruir_stats, verificar_stats
+
+
+def sembrar(n_camiones):
+    comun.reiniciar_db()
+    with app.app_context():
+        db.session.add(User(username='admin', role='admin', password=comun.PASSWORD_HASH))
+        db.session.execute(db.insert(Truck.__table__), [
+            {'plate': f'IMP{i:05d}', 'status': 'disponible'} for i in range(n_camiones)
+        ])
+        db.session.commit()
+        reconstruir_stats()  # el insert masivo no pasa por los hooks de la sesión
+
+
+def manifiesto(n_filas, n_camiones, pct_errores):
+    ciudades = [c.nombre for c in indice_ciudades]
+    lineas = ['origin,destination,status,truck,start_time']
+    for i in range(n_filas):
+        origen, destino = random.sample(ciudades, 2)
+        placa = f'IMP{random.randrange(n_camiones):05d}'
+        if random.random() < pct_errores / 100:
+            lineas.append(random.choice([f',{destino},pendiente,,', f'{origen},{destino},perdida,,',
+                                         f'{origen},{destino},pendiente,XX{i},']))
+        elif i % 2:
+            lineas.append(f'{origen},{destino},en_progreso,{placa},{1700000000 + i}')
+        else:
+            lineas.append(f'{origen},{destino},pendiente,,')
+    return ('\n'.join(lineas) + '\n').encode('utf-8')
+
+
+def fila_por_fila_import(n, n_camiones):
+    ciudades = [c.nombre for c in indice_ciudades]
+    with app.app_context():
+        t0 = time.perf_counter()
+        for _ in range(n):
+            origen, destino = random.sample(ciudades, 2)
+            truck_id = db.session.query(Truck.id).filter(
+                Truck.plate == f'IMP{random.randrange(n_camiones):05d}').scalar()
+            db.session.add(Route(origin=origen, destination=destino, status='en_progreso', truck_id=truck_id))
+            db.session.commit()
+        return time.perf_counter() - t0
+
+
+def fila_por_fila_completar(n):
+    with app.app_context():
+        ids = [r for (r,) in db.session.query(Route.id).filter(Route.status == 'en_progreso').limit(n)]
+        t0 = time.perf_counter()
+        for route_id in ids:
+            route = db.session.get(Route, route_id)
+            route.status = 'completada'
+            db.session.commit()
+        return time.perf_counter() - t0, len(ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--filas', type=int, default=50000)
+    parser.add_argument('--camiones', type=int, default=2000)
+    parser.add_argument('--errores', type=float, default=1.0, help='porcentaje de filas inválidas')
+    parser.add_argument('--muestra', type=int, default=1000, help='filas para medir la versión fila por fila')
+    args = parser.parse_args()
+
+    sembrar(args.camiones)
+    client = app.test_client()
+    comun.login(client, 'admin')
+    cuerpo = manifiesto(args.filas, args.camiones, args.errores)
+
+    with comun.contar_sql() as c:
+        t0 = time.perf_counter()
+        resumen = client.post('/admin/import/routes',
+                              data={'archivo': (io.BytesIO(cuerpo), 'manifiesto.csv')}).get_json()
+        segundos = time.perf_counter() - t0
+    lento = fila_por_fila_import(args.muestra, args.camiones) / args.muestra * args.filas
+    print(f"Importación de {args.filas} filas ({len(cuerpo) / 1e6:.1f} MB):")
+    print(f"  /admin/import/routes: {segundos:6.2f}s ({args.filas / segundos:,.0f} filas/s, {c[0]} queries, "
+          f"{resumen['lotes']} lotes) -> {resumen['insertadas']} insertadas, {resumen['con_error']} con error")
+    print(f"  ORM fila por fila:    {lento:6.2f}s (extrapolado de {args.muestra}) -> {lento / segundos:.0f}x")
+
+    t_lento, n_lento = fila_por_fila_completar(args.muestra)
+    with comun.contar_sql() as c:
+        t0 = time.perf_counter()
+        resultado = client.post('/admin/routes/bulk', json={
+            'accion': 'estado', 'status': 'completada', 'filtro': {'status': 'en_progreso'}}).get_json()
+        segundos = time.perf_counter() - t0
+    lento = t_lento / max(n_lento, 1) * resultado['actualizadas']
+    print(f"Completar {resultado['actualizadas']} rutas en curso:")
+    print(f"  /admin/routes/bulk:   {segundos:6.2f}s ({c[0]} queries)")
+    print(f"  ORM fila por fila:    {lento:6.2f}s (extrapolado de {n_lento}) -> {lento / segundos:.0f}x")
+
+    with app.app_context():
+        diferencias = verificar_stats()
+    if diferencias or resumen['con_error'] == 0 and args.errores > 0:
+        raise SystemExit(f"FALLA: contadores inconsistentes {diferencias} o errores no detectados")
+    print("OK: contadores consistentes")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Planes de consulta y latencia de las consultas calientes, sin y con índices.
+
+Siembra una DB grande (o usa una existente con --db), borra los índices
+secundarios del modelo, mide, los recrea con `crear_indices()` y vuelve a medir.
+
+Uso: python benchmarks/bench_indices.py [--rutas 300000] [--camiones 5000] [--pings 500000]
+     python benchmarks/bench_indices.py --db /ruta/a/grande.db
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+if '--db' in sys.argv:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.abspath(sys.argv[sys.argv.index('--db') + 1])
+
+import comun
+from sqlalchemy import text
+from main import app, db, crear_indices
+
+CONSULTAS = [
+    ('camiones del despachador', 'SELECT id, plate FROM truck WHERE dispatcher_id = :desp'),
+    ('camión del chofer', 'SELECT id FROM truck WHERE driver_id = :chofer LIMIT 1'),
+    ('rutas de un camión', 'SELECT id, status FROM route WHERE truck_id = :truck'),
+    ('pendientes sin camión', "SELECT id FROM route WHERE truck_id IS NULL AND status = 'pendiente' LIMIT 50"),
+    ('rutas por estado', "SELECT count(*) FROM route WHERE status = 'en_progreso'"),
+    ('choferes', "SELECT count(*) FROM user WHERE role = 'chofer'"),
+    ('mapa de la flota', 'SELECT r.id, r.status, t.plate, u.username FROM route r '
+                         'JOIN truck t ON r.truck_id = t.id LEFT JOIN user u ON t.driver_id = u.id '
+                         'WHERE t.dispatcher_id = :desp'),
+    ('último ping de ruta', 'SELECT lat, lon FROM tracking WHERE route_id = :ruta '
+                            'ORDER BY timestamp DESC LIMIT 1'),
+]
+
+
+def sembrar(n_desp, n_camiones, n_rutas, n_pings, lote=20000):
+    comun.reiniciar_db()
+    ahora = datetime.utcnow()
+    with db.engine.begin() as conn:
+        conn.execute(db.metadata.tables['user'].insert(), [
+            {'username': f'u{i}', 'role': 'despachador' if i < n_desp else 'chofer',
+             'password': comun.PASSWORD_HASH}
+            for i in range(n_desp + n_camiones)
+        ])
+        conn.execute(db.metadata.tables['truck'].insert(), [
+            {'plate': f'P{i:06d}', 'status': 'disponible', 'change_seq': 0,
+             'dispatcher_id': 1 + i % n_desp, 'driver_id': 1 + n_desp + i}
+            for i in range(n_camiones)
+        ])
+    estados = ['pendiente'] * 2 + ['en_progreso'] + ['completada'] * 7
+    for inicio in range(0, n_rutas, lote):
+        with db.engine.begin() as conn:
+            conn.execute(db.metadata.tables['route'].insert(), [
+                {'origin': 'Santiago', 'destination': 'Arica', 'status': (st := random.choice(estados)),
+                 'truck_id': None if st == 'pendiente' and random.random() < 0.5 else random.randint(1, n_camiones),
+                 'change_seq': 0}
+                for _ in range(inicio, min(n_rutas, inicio + lote))
+            ])
+    for inicio in range(0, n_pings, lote):
+        with db.engine.begin() as conn:
+            conn.execute(db.metadata.tables['tracking'].insert(), [
+                {'route_id': random.randint(1, n_rutas), 'lat': -33.0, 'lon': -70.0,
+                 'timestamp': ahora - timedelta(seconds=random.randint(0, 86400))}
+                for _ in range(inicio, min(n_pings, inicio + lote))
+            ])
+
+
+def borrar_indices():
+    with db.engine.begin() as conn:
+        for tabla in db.metadata.sorted_tables:
+            for indice in tabla.indexes:
+                conn.execute(text(f'DROP INDEX IF EXISTS {indice.name}'))
+        conn.execute(text('ANALYZE'))
+
+
+def medir(repeticiones, maximos):
+    resultados = {}
+    with db.engine.connect() as conn:
+        for nombre, sql in CONSULTAS:
+            def params():
+                return {'desp': random.randint(1, maximos['desp']), 'chofer': random.randint(1, maximos['user']),
+                        'truck': random.randint(1, maximos['truck']), 'ruta': random.randint(1, maximos['route'])}
+            plan = ' | '.join(fila[-1] for fila in conn.execute(text('EXPLAIN QUERY PLAN ' + sql), params()))
+            tiempos = comun.cronometrar(lambda: conn.execute(text(sql), params()).fetchall(), repeticiones)
+            resultados[nombre] = (plan, comun.percentil(tiempos, 50), comun.percentil(tiempos, 95))
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--db', help='usar una DB ya sembrada (no se re-siembra)')
+    parser.add_argument('--despachadores', type=int, default=50)
+    parser.add_argument('--camiones', type=int, default=5000)
+    parser.add_argument('--rutas', type=int, default=300000)
+    parser.add_argument('--pings', type=int, default=500000)
+    parser.add_argument('--repeticiones', type=int, default=30)
+    args = parser.parse_args()
+
+    with app.app_context():
+        if not args.db:
+            t0 = time.perf_counter()
+            sembrar(args.despachadores, args.camiones, args.rutas, args.pings)
+            print(f'sembrado en {time.perf_counter() - t0:.1f}s')
+        with db.engine.connect() as conn:
+            maximos = {t: conn.execute(text(f'SELECT max(id) FROM "{t}"')).scalar() or 1
+                       for t in ('user', 'truck', 'route')}
+            maximos['desp'] = conn.execute(
+                text("SELECT max(id) FROM user WHERE role = 'despachador'")).scalar() or 1
+
+        borrar_indices()
+        antes = medir(args.repeticiones, maximos)
+        creados = crear_indices()
+        with db.engine.begin() as conn:
+            conn.execute(text('ANALYZE'))
+        despues = medir(args.repeticiones, maximos)
+
+    print(f'índices creados: {", ".join(creados)}\n')
+    for nombre, _ in CONSULTAS:
+        plan_a, p50_a, p95_a = antes[nombre]
+        plan_d, p50_d, p95_d = despues[nombre]
+        print(f'{nombre}')
+        print(f'  antes:   p50={p50_a:8.3f}ms p95={p95_a:8.3f}ms  {plan_a}')
+        print(f'  después: p50={p50_d:8.3f}ms p95={p95_d:8.3f}ms  {plan_d}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Throughput de ingesta GPS (POST /tracking) con una flota simulada.
+
+Cada camión simulado avanza en línea recta desde su ciudad de origen y manda
+sus pings en lotes. Varios hilos envían en paralelo (SQLite en WAL serializa
+las escrituras, así que se mide el camino completo: HTTP + validación + insert).
+
+Al final comprueba que un ping llega a los mapas: el sondeo delta (?since=)
+del chofer y del despachador trae la ruta con la nueva posición y
+/mapa_stream (el broker) avisa al despachador. Falla si no.
+
+Uso: python benchmarks/bench_ingesta.py [--camiones 200] [--lote 50] [--rondas 10] [--hilos 8]
+"""
+import argparse
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import comun
+from ciudades import indice as indice_ciudades
+from eventos import broker
+from main import app, db, User, Truck, Route, Tracking
+
+
+def sembrar(n_camiones):
+    comun.reiniciar_db()
+    ciudades = list(indice_ciudades)
+    flota = []
+    with app.app_context():
+        desp = User(username='desp', role='despachador', password=comun.PASSWORD_HASH)
+        db.session.add(desp)
+        db.session.flush()
+        for i in range(n_camiones):
+            chofer = User(username=f'chofer{i}', role='chofer', password=comun.PASSWORD_HASH)
+            truck = Truck(plate=f'GPS{i:05d}', status='en ruta', driver=chofer, dispatcher_id=desp.id)
+            origen, destino = random.sample(ciudades, 2)
+            ruta = Route(origin=origen.nombre, destination=destino.nombre,
+                         status='en_progreso', truck=truck)
+            db.session.add(ruta)
+            flota.append((chofer, ruta, origen, destino))
+        db.session.commit()
+        return [(c.username, r.id, o.lat, o.lon, d.lat, d.lon) for c, r, o, d in flota]
+
+
+class CamionSimulado:
+    def __init__(self, username, route_id, lat0, lon0, lat1, lon1, pasos):
+        self.client = app.test_client()
+        comun.login(self.client, username)
+        self.route_id = route_id
+        self.lat, self.lon = lat0, lon0
+        self.dlat, self.dlon = (lat1 - lat0) / pasos, (lon1 - lon0) / pasos
+        self.t = time.time()
+
+    def lote(self, n):
+        pings = []
+        for _ in range(n):
+            self.lat += self.dlat + random.uniform(-1e-4, 1e-4)
+            self.lon += self.dlon + random.uniform(-1e-4, 1e-4)
+            self.t += 1
+            pings.append({'route_id': self.route_id, 'lat': self.lat, 'lon': self.lon, 'ts': self.t})
+        return pings
+
+    def enviar(self, n):
+        t0 = time.perf_counter()
+        resp = self.client.post('/tracking', json={'pings': self.lote(n)})
+        if resp.status_code != 201:
+            raise RuntimeError(resp.get_data(as_text=True))
+        return (time.perf_counter() - t0) * 1000.0
+
+
+def verificar_delta(camion):
+    """Fallas (lista de textos) si un ping no llega al delta de los mapas o al broker."""
+    despachador = app.test_client()
+    comun.login(despachador, 'desp')
+    urls = {'chofer': (camion.client, '/mapa_data'), 'despachador': (despachador, '/mapa_despachador_data')}
+    cursores = {nombre: client.get(url + '?since=0').get_json()['cursor'] for nombre, (client, url) in urls.items()}
+    with app.app_context():
+        desp_id = db.session.query(User.id).filter_by(username='desp').scalar()
+    sub = broker.suscribir(desp_id)
+    try:
+        camion.enviar(1)
+        evento = sub.esperar(timeout=1)
+    finally:
+        broker.desuscribir(sub)
+    fallas = []
+    if evento is None or camion.route_id not in evento['routes']:
+        fallas.append('el despachador no recibió aviso del ping')
+    for nombre, (client, url) in urls.items():
+        upserts = client.get(f'{url}?since={cursores[nombre]}').get_json()['upserts']
+        coords = [m['coords'] for m in upserts if m['route_id'] == camion.route_id]
+        if not coords or abs(coords[0][0] - camion.lat) > 1e-9 or abs(coords[0][1] - camion.lon) > 1e-9:
+            fallas.append(f'el delta del {nombre} no trae la nueva posición')
+    return fallas
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--camiones', type=int, default=200)
+    parser.add_argument('--lote', type=int, default=50, help='pings por request')
+    parser.add_argument('--rondas', type=int, default=10, help='lotes por camión')
+    parser.add_argument('--hilos', type=int, default=8)
+    args = parser.parse_args()
+
+    camiones = [CamionSimulado(*datos, pasos=args.lote * args.rondas)
+                for datos in sembrar(args.camiones)]
+
+    latencias = []
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.hilos) as pool:
+        for _ in range(args.rondas):
+            latencias.extend(pool.map(lambda c: c.enviar(args.lote), camiones))
+    duracion = time.perf_counter() - t0
+
+    total = args.camiones * args.lote * args.rondas
+    with app.app_context():
+        guardados = db.session.query(Tracking).count()
+    assert guardados == total, (guardados, total)
+
+    print(f"camiones={args.camiones} lote={args.lote} rondas={args.rondas} hilos={args.hilos}")
+    print(f"pings={total} en {duracion:.2f}s -> {total / duracion:,.0f} pings/s "
+          f"({len(latencias) / duracion:,.0f} requests/s)")
+    print(f"latencia por lote: p50={comun.percentil(latencias, 50):.2f}ms "
+          f"p95={comun.percentil(latencias, 95):.2f}ms p99={comun.percentil(latencias, 99):.2f}ms")
+
+    fallas = verificar_delta(camiones[0])
+    if fallas:
+        raise SystemExit('FALLA: ' + '; '.join(fallas))
+    print("OK: un ping llega al delta de los mapas y a /mapa_stream")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Regresión de N+1: sentencias SQL por request de /mapa_despachador_data.
+
+Siembra flotas de distinto tamaño para un mismo despachador y verifica que la
+cantidad de queries por request no crece con la flota.
+
+Uso: python benchmarks/bench_mapa_queries.py [--flotas 10,100,400] [--rutas 3]
+"""
+import argparse
+import random
+
+import comun
+from main import db, User, Truck, Route
+
+CIUDADES = ["Santiago", "Valparaíso", "Concepción", "Antofagasta", "La Serena",
+            "Rancagua", "Temuco", "Puerto Montt", "Valdivia", "Arica"]
+ESTADOS = ["pendiente", "en_progreso", "completada"]
+
+
+def sembrar(n_camiones, rutas_por_camion):
+    comun.reiniciar_db()
+    with comun.app.app_context():
+        desp = User(username='desp', role='despachador', password=comun.PASSWORD_HASH)
+        db.session.add(desp)
+        db.session.flush()
+        for i in range(n_camiones):
+            chofer = User(username=f'chofer{i}', role='chofer', password=comun.PASSWORD_HASH)
+            truck = Truck(plate=f'BNCH{i:05d}', status='en ruta', cargo='Madera',
+                          driver=chofer, dispatcher_id=desp.id)
+            db.session.add(truck)
+            for _ in range(rutas_por_camion):
+                origin, destination = random.sample(CIUDADES, 2)
+                db.session.add(Route(origin=origin, destination=destination,
+                                     status=random.choice(ESTADOS), truck=truck))
+        db.session.commit()
+
+
+def medir(repeticiones=20):
+    client = comun.app.test_client()
+    comun.login(client, 'desp')
+    client.get('/mapa_despachador_data')  # calentar
+    with comun.contar_sql() as c:
+        resp = client.get('/mapa_despachador_data')
+    assert resp.status_code == 200, resp.status_code
+    tiempos = comun.cronometrar(lambda: client.get('/mapa_despachador_data'), repeticiones)
+    return c[0], len(resp.get_json()), tiempos
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--flotas', default='10,100,400')
+    parser.add_argument('--rutas', type=int, default=3)
+    parser.add_argument('--repeticiones', type=int, default=20)
+    args = parser.parse_args()
+
+    conteos = []
+    print(f"{'camiones':>9} {'marcadores':>10} {'queries':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for n in [int(x) for x in args.flotas.split(',')]:
+        sembrar(n, args.rutas)
+        queries, marcadores, tiempos = medir(args.repeticiones)
+        conteos.append(queries)
+        print(f"{n:>9} {marcadores:>10} {queries:>8} "
+              f"{comun.percentil(tiempos, 50):>8.2f} {comun.percentil(tiempos, 95):>8.2f}")
+
+    if len(set(conteos)) != 1:
+        raise SystemExit(f"REGRESIÓN: las queries por request varían con la flota: {conteos}")
+    print("OK: queries por request constantes")
+
+
+if __name__ == '__main__':
+    main()
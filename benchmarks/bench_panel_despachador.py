@@ -0,0 +1,126 @@
+"""Panel del despachador con cada vez más rutas pendientes en la tabla.
+
+Una flota de --camiones camiones (con chofer, rutas activas e historial) y
+pendientes sin camión repartidas por todas las ciudades, que crecen por etapas
+hasta --pendientes. En cada etapa mide GET /dashboard_despachador (primera
+página y la siguiente) y GET /despachador/pendientes: latencia y queries. Como
+referencia mide lo que hacía el panel anterior: cargar todas las pendientes sin
+camión con el ORM.
+
+Falla si el panel supera PRESUPUESTO_SQL queries o si su latencia crece más
+de 3x entre la primera y la última etapa.
+
+Uso: python benchmarks/bench_panel_despachador.py [--pendientes 1_000_000] [--camiones 60]
+"""
+import argparse
+import random
+import re
+import time
+
+import comun
+from ciudades import indice as indice_ciudades
+from main import app, db, User, Truck, Route, reconstruir_stats
+
+PRESUPUESTO_SQL = 6
+
+
+def cantidad(texto):
+    texto = texto.replace('_', '').lower()
+    return int(float(texto[:-1]) * 1_000_000) if texto.endswith('m') else int(texto)
+
+
+def sembrar(n_camiones):
+    comun.reiniciar_db()
+    ciudades = list(indice_ciudades)
+    with app.app_context():
+        desp = User(username='desp', role='despachador', password=comun.PASSWORD_HASH)
+        db.session.add(desp)
+        db.session.flush()
+        camiones = []
+        for i in range(n_camiones):
+            chofer = User(username=f'chofer{i}', role='chofer', password=comun.PASSWORD_HASH)
+            camiones.append(Truck(plate=f'PNL{i:04d}', status='en ruta' if i % 2 else 'disponible',
+                                  driver=chofer, dispatcher_id=desp.id))
+        db.session.add_all(camiones)
+        db.session.flush()
+        filas = []
+        # Activas e historial: la posición de los camiones sale del destino de estas rutas
+        for i, camion in enumerate(camiones):
+            for k in range(20):
+                origen, destino = random.sample(ciudades[:20], 2)
+                filas.append({'origin': origen.nombre, 'destination': destino.nombre,
+                              'origin_city_id': origen.id, 'destination_city_id': destino.id,
+                              'status': 'en_progreso' if k == 0 and i % 2 else 'completada',
+                              'truck_id': camion.id})
+        db.session.execute(db.insert(Route.__table__), filas)
+        db.session.commit()
+
+
+def agregar_pendientes(n):
+    ciudades = list(indice_ciudades)
+    with app.app_context():
+        for inicio in range(0, n, 50_000):
+            filas = []
+            for _ in range(min(50_000, n - inicio)):
+                origen, destino = random.sample(ciudades, 2)
+                filas.append({'origin': origen.nombre, 'destination': destino.nombre,
+                              'origin_city_id': origen.id, 'destination_city_id': destino.id,
+                              'status': 'pendiente', 'truck_id': None})
+            db.session.execute(db.insert(Route.__table__), filas)
+            db.session.commit()
+
+
+def medir(client, url, repeticiones):
+    ultima = []
+    with comun.contar_sql() as c:
+        tiempos = comun.cronometrar(lambda: ultima.append(client.get(url)), repeticiones)
+    return comun.percentil(tiempos, 50), c[0] / repeticiones, ultima[-1]
+
+
+def panel_anterior():
+    """Lo que cargaba el panel antes: todas las pendientes sin camión del sistema."""
+    with app.app_context():
+        return len(Route.query.filter((Route.truck_id == None) & (Route.status == "pendiente")).all())  # noqa: E711
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--pendientes', type=cantidad, default=1_000_000)
+    parser.add_argument('--camiones', type=int, default=60)
+    parser.add_argument('--repeticiones', type=int, default=20)
+    args = parser.parse_args()
+
+    sembrar(args.camiones)
+    client = app.test_client()
+    comun.login(client, 'desp')
+
+    etapas = sorted({max(args.pendientes // 100, 1), max(args.pendientes // 10, 1), args.pendientes})
+    print(f"{'pendientes':>10} {'panel p50':>10} {'SQL':>5} {'pág. 2 p50':>11} {'SQL':>5} "
+          f"{'feed JSON':>10} {'SQL':>5} {'anterior':>10}")
+    total, latencias = 0, []
+    for etapa in etapas:
+        agregar_pendientes(etapa - total)
+        total = etapa
+        with app.app_context():
+            reconstruir_stats()
+        client.get('/dashboard_despachador')  # calentar
+        p50, sql, resp = medir(client, '/dashboard_despachador', args.repeticiones)
+        siguiente = re.search(r'pendientes=([\d%A]+)', resp.get_data(as_text=True))
+        url2 = f"/dashboard_despachador?pendientes={siguiente.group(1)}" if siguiente else '/dashboard_despachador'
+        p50_2, sql_2, _ = medir(client, url2, args.repeticiones)
+        p50_j, sql_j, _ = medir(client, '/despachador/pendientes', args.repeticiones)
+        t0 = time.perf_counter()
+        panel_anterior()
+        anterior = (time.perf_counter() - t0) * 1000.0
+        latencias.append(p50)
+        print(f"{etapa:>10,} {p50:>8.1f}ms {sql:>5.1f} {p50_2:>9.1f}ms {sql_2:>5.1f} "
+              f"{p50_j:>8.1f}ms {sql_j:>5.1f} {anterior:>8.0f}ms")
+        if max(sql, sql_2) > PRESUPUESTO_SQL:
+            raise SystemExit(f"FALLA: el panel usó más de {PRESUPUESTO_SQL} queries")
+    if latencias[-1] > 3 * latencias[0]:
+        raise SystemExit("FALLA: la latencia del panel crece con las pendientes")
+    print("OK: queries y latencia acotadas")
+
+
+if __name__ == '__main__':
+    main()
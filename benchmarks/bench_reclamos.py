@@ -0,0 +1,176 @@
+"""Estrés de reclamo de rutas: muchos hilos compitiendo por las mismas rutas pendientes.
+
+Cada hilo es un chofer o despachador con su propia sesión, y recorre TODAS las
+rutas en orden aleatorio intentando tomarlas por uno de los tres caminos:
+POST /asignar_ruta, POST /update_route_status/<id>/en_progreso (choferes) y
+POST /asignar_chofer_confirm (despachadores). Al final verifica que:
+
+- cada ruta tiene a lo más un ganador, y es el camión que quedó en la DB,
+- ningún request falló con 500 ("database is locked"),
+- los contadores de KPIs siguen consistentes,
+
+y reporta reclamos por segundo. Con --ingenuo corre además la versión anterior
+(leer, verificar y escribir con el ORM) para mostrar las dobles asignaciones.
+
+Uso: python benchmarks/bench_reclamos.py [--rutas 1000] [--hilos 16]
+"""
+import argparse
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import comun
+from main import app, db, User, Truck, Route, reconstruir_stats, verificar_stats
+
+
+def sembrar(n_rutas, n_hilos):
+    """Un chofer (con camión) o despachador (con un camión propio) por hilo; rutas pendientes libres."""
+    comun.reiniciar_db()
+    actores = []
+    with app.app_context():
+        for i in range(n_hilos):
+            chofer = User(username=f'chofer{i}', role='chofer', password=comun.PASSWORD_HASH)
+            db.session.add(chofer)
+            if i % 3 == 2:
+                desp = User(username=f'desp{i}', role='despachador', password=comun.PASSWORD_HASH)
+                db.session.add(desp)
+                db.session.flush()
+                truck = Truck(plate=f'CAS{i:04d}', status='disponible', driver=chofer, dispatcher_id=desp.id)
+                db.session.add(truck)
+                db.session.flush()
+                actores.append(('asignar_chofer_confirm', desp.username, truck.id))
+            else:
+                truck = Truck(plate=f'CAS{i:04d}', status='disponible', driver=chofer)
+                db.session.add(truck)
+                db.session.flush()
+                camino = 'asignar_ruta' if i % 3 == 0 else 'update_route_status'
+                actores.append((camino, chofer.username, truck.id))
+        db.session.execute(db.insert(Route.__table__), [
+            {'origin': 'Santiago', 'destination': 'Valparaíso', 'origin_city_id': 1,
+             'destination_city_id': 2, 'status': 'pendiente'}
+            for _ in range(n_rutas)
+        ])
+        db.session.commit()
+        reconstruir_stats()  # el insert masivo no pasa por los hooks de la sesión
+        route_ids = [r for (r,) in db.session.query(Route.id)]
+    return actores, route_ids
+
+
+def url_reclamo(camino, route_id, truck_id):
+    if camino == 'asignar_ruta':
+        return f'/asignar_ruta/{route_id}'
+    if camino == 'update_route_status':
+        return f'/update_route_status/{route_id}/en_progreso'
+    return f'/asignar_chofer_confirm/{route_id}/{truck_id}'
+
+
+def correr_http(actores, route_ids):
+    ganadores = defaultdict(list)  # route_id -> [truck_id que recibió éxito]
+    resultados = Counter()
+    latencias = []
+    lock = threading.Lock()
+    barrera = threading.Barrier(len(actores))
+
+    def actor(camino, username, truck_id):
+        client = app.test_client()
+        comun.login(client, username)
+        orden = route_ids[:]
+        random.shuffle(orden)
+        propios, propias_lat, conteo = [], [], Counter()
+        barrera.wait()
+        for route_id in orden:
+            t0 = time.perf_counter()
+            resp = client.post(url_reclamo(camino, route_id, truck_id))
+            propias_lat.append((time.perf_counter() - t0) * 1000)
+            conteo[resp.status_code] += 1
+            if resp.status_code == 302:
+                propios.append(route_id)
+        with lock:
+            for route_id in propios:
+                ganadores[route_id].append(truck_id)
+            resultados.update(conteo)
+            latencias.extend(propias_lat)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(actores)) as pool:
+        for f in [pool.submit(actor, *a) for a in actores]:
+            f.result()
+    return ganadores, resultados, latencias, time.perf_counter() - t0
+
+
+def correr_ingenuo(actores, route_ids):
+    """La versión anterior: leer, verificar y escribir con el ORM, sin condición en el UPDATE."""
+    ganadores = defaultdict(list)
+    lock = threading.Lock()
+    barrera = threading.Barrier(len(actores))
+
+    def actor(_, __, truck_id):
+        orden = route_ids[:]
+        random.shuffle(orden)
+        propios = []
+        barrera.wait()
+        with app.app_context():
+            for route_id in orden:
+                route = db.session.get(Route, route_id)
+                if route.status != 'pendiente' or route.truck_id is not None:
+                    db.session.rollback()
+                    continue
+                time.sleep(0)  # ceder el GIL entre la lectura y la escritura, como en un request real
+                route.truck_id = truck_id
+                route.status = 'en_progreso'
+                db.session.commit()
+                propios.append(route_id)
+        with lock:
+            for route_id in propios:
+                ganadores[route_id].append(truck_id)
+
+    with ThreadPoolExecutor(max_workers=len(actores)) as pool:
+        for f in [pool.submit(actor, *a) for a in actores]:
+            f.result()
+    return ganadores
+
+
+def verificar(ganadores, route_ids):
+    with app.app_context():
+        en_db = dict(db.session.query(Route.id, Route.truck_id))
+        diferencias = verificar_stats()
+    dobles = {r: t for r, t in ganadores.items() if len(t) > 1}
+    distinto = [r for r, t in ganadores.items() if len(t) == 1 and en_db[r] != t[0]]
+    sin_dueno = [r for r in route_ids if r not in ganadores and en_db[r] is not None]
+    return dobles, distinto, sin_dueno, diferencias
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rutas', type=int, default=1000)
+    parser.add_argument('--hilos', type=int, default=16)
+    parser.add_argument('--ingenuo', action='store_true', help='correr también la versión sin compare-and-set')
+    args = parser.parse_args()
+
+    actores, route_ids = sembrar(args.rutas, args.hilos)
+    ganadores, resultados, latencias, segundos = correr_http(actores, route_ids)
+    dobles, distinto, sin_dueno, diferencias = verificar(ganadores, route_ids)
+    intentos = sum(resultados.values())
+    exitos = sum(len(t) for t in ganadores.values())
+    print(f"{args.hilos} hilos × {args.rutas} rutas = {intentos} intentos en {segundos:.2f}s "
+          f"({intentos / segundos:.0f} req/s, {exitos / segundos:.0f} reclamos exitosos/s)")
+    print(f"  respuestas: {dict(sorted(resultados.items()))}")
+    print(f"  latencia p50 {comun.percentil(latencias, 50):.1f} ms, p99 {comun.percentil(latencias, 99):.1f} ms")
+    print(f"  rutas tomadas: {len(ganadores)}/{args.rutas}; dobles asignaciones: {len(dobles)}; "
+          f"ganador distinto al de la DB: {len(distinto)}; asignadas sin ganador: {len(sin_dueno)}")
+    print(f"  contadores: {'consistentes' if not diferencias else diferencias}")
+
+    if args.ingenuo:
+        actores, route_ids = sembrar(args.rutas, args.hilos)
+        dobles_ingenuo = {r: t for r, t in correr_ingenuo(actores, route_ids).items() if len(t) > 1}
+        print(f"Versión sin compare-and-set: {len(dobles_ingenuo)} rutas entregadas a más de un camión")
+
+    if dobles or distinto or sin_dueno or diferencias or resultados.get(500):
+        raise SystemExit("FALLA: hubo dobles asignaciones, errores 500 o contadores inconsistentes")
+    print("OK: cero dobles asignaciones")
+
+
+if __name__ == '__main__':
+    main()
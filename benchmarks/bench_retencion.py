@@ -0,0 +1,201 @@
+"""Compactación del historial GPS (retencion.py): espacio, tiempo de consulta y fidelidad del trazo.
+
+Genera --dias días de historial con --rutas-por-dia rutas de 2 horas, un ping
+cada 5 s sobre un camino con curvas y ruido de GPS de ~5 m. Compacta con
+`compactar_tracking()` mientras un chofer sigue enviando pings (POST /tracking)
+y mide:
+
+- filas y tamaño de la DB antes y después (con auto_vacuum=INCREMENTAL);
+- la consulta del trazo de una ruta vieja (route_id + orden por timestamp);
+- la fidelidad: distancia de cada ping crudo (leído del archivo) al trazo
+  compactado en su mismo instante, por nivel (baldes de 1 y de 10 minutos);
+- la latencia de la ingesta durante la compactación.
+
+Falla si falta algún ping crudo en el archivo, si el p99 del error de un nivel
+supera el doble de su tolerancia o si la ingesta devolvió errores.
+
+Uso: python benchmarks/bench_retencion.py [--dias 40] [--rutas-por-dia 20]
+"""
+import argparse
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import comun
+import retencion
+from main import (app, db, User, Truck, Route, Tracking, TrackingArchive, TRACKING_ARCHIVO_DIR,
+                  activar_vacuum_incremental, compactar_tracking)
+
+PINGS_POR_RUTA = 1440  # 2 horas, uno cada 5 s
+
+
+def trazo(rng, n):
+    """(lat, lon) de un camino con curvas suaves a ~15 m/s más ruido de GPS (~5 m)."""
+    rumbo = np.cumsum(rng.normal(0, 0.08, n)) + rng.uniform(0, 2 * math.pi)
+    paso = rng.uniform(10, 20, n) * 5.0
+    y = np.cumsum(paso * np.cos(rumbo)) + rng.normal(0, 5, n)
+    x = np.cumsum(paso * np.sin(rumbo)) + rng.normal(0, 5, n)
+    lat0, lon0 = rng.uniform(-38, -30), rng.uniform(-72, -70)
+    lat = lat0 + np.degrees(y / retencion.RADIO_TIERRA_M)
+    lon = lon0 + np.degrees(x / (retencion.RADIO_TIERRA_M * math.cos(math.radians(lat0))))
+    return lat, lon
+
+
+def sembrar(dias, por_dia, hoy):
+    comun.reiniciar_db()
+    rng = np.random.default_rng(7)
+    with app.app_context():
+        activar_vacuum_incremental()
+        chofer = User(username='chofer', role='chofer', password=comun.PASSWORD_HASH)
+        camion = Truck(plate='RET001', status='en ruta', driver=chofer)
+        db.session.add_all([chofer, camion])
+        db.session.flush()
+        rutas = [Route(origin='Santiago', destination='Talca', status='completada', truck_id=camion.id)
+                 for _ in range(dias * por_dia)]
+        en_curso = Route(origin='Santiago', destination='Talca', status='en_progreso', truck_id=camion.id)
+        db.session.add_all(rutas + [en_curso])
+        db.session.commit()
+        for d in range(dias):
+            filas = []
+            for k in range(por_dia):
+                route_id = rutas[d * por_dia + k].id
+                inicio = datetime.combine(hoy - timedelta(days=d + 1), datetime.min.time()) + \
+                    timedelta(hours=6, minutes=int(rng.integers(0, 600)))
+                lat, lon = trazo(rng, PINGS_POR_RUTA)
+                filas += [{'route_id': route_id, 'lat': float(lat[i]), 'lon': float(lon[i]),
+                           'timestamp': inicio + timedelta(seconds=5 * i)} for i in range(PINGS_POR_RUTA)]
+            db.session.execute(db.insert(Tracking.__table__), filas)
+            db.session.commit()
+        return [r.id for r in rutas], en_curso.id
+
+
+def tamano_mb():
+    with db.engine.connect() as conn:
+        conn.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+        paginas = conn.exec_driver_sql('PRAGMA page_count').scalar()
+        tamano = conn.exec_driver_sql('PRAGMA page_size').scalar()
+    return paginas * tamano / 1e6
+
+
+def consulta_trazo(route_ids):
+    """p50 en ms de leer el trazo completo de cada ruta (ix_tracking_route_ts)."""
+    tiempos = []
+    for route_id in route_ids:
+        t0 = time.perf_counter()
+        db.session.execute(db.select(Tracking.lat, Tracking.lon, Tracking.timestamp)
+                           .where(Tracking.route_id == route_id).order_by(Tracking.timestamp)).all()
+        tiempos.append((time.perf_counter() - t0) * 1000.0)
+    return comun.percentil(tiempos, 50)
+
+
+def errores_trazo(route_ids):
+    """Distancia (m) de cada ping crudo archivado al trazo compactado interpolado en su instante."""
+    crudos = {}
+    for dia in retencion.dias_archivados(TRACKING_ARCHIVO_DIR):
+        for fila in retencion.leer_dia(TRACKING_ARCHIVO_DIR, dia):
+            crudos.setdefault(int(fila['route_id']), []).append(
+                (datetime.fromisoformat(fila['timestamp']).timestamp(), float(fila['lat']), float(fila['lon'])))
+    errores = []
+    for route_id in route_ids:
+        crudo = np.array(sorted(crudos[route_id]))
+        kept = np.array([(ts.timestamp(), lat, lon) for lat, lon, ts in db.session.execute(
+            db.select(Tracking.lat, Tracking.lon, Tracking.timestamp)
+            .where(Tracking.route_id == route_id).order_by(Tracking.timestamp))])
+        x, y = retencion.proyectar(crudo[:, 1], crudo[:, 2])
+        kx, ky = retencion.proyectar(kept[:, 1], kept[:, 2])
+        # Segmento del trazo compactado que cubre el instante de cada ping crudo
+        j = np.clip(np.searchsorted(kept[:, 0], crudo[:, 0], side='right'), 1, len(kept) - 1)
+        errores.append(retencion.distancia_a_segmento(x, y, kx[j - 1], ky[j - 1], kx[j], ky[j]))
+    return np.concatenate(errores)
+
+
+class Ingesta:
+    """Un chofer enviando lotes de 10 pings desde otro hilo; guarda latencias y errores."""
+
+    def __init__(self, route_id):
+        self.client = app.test_client()
+        comun.login(self.client, 'chofer')
+        self.route_id = route_id
+        self.tiempos, self.errores = [], 0
+        self._parar = threading.Event()
+        self._hilo = threading.Thread(target=self._correr, daemon=True)
+
+    def __enter__(self):
+        self._hilo.start()
+        return self
+
+    def _correr(self):
+        while not self._parar.is_set():
+            ahora = time.time()
+            pings = [{'route_id': self.route_id, 'lat': -33.4, 'lon': -70.6, 'ts': ahora + i} for i in range(10)]
+            t0 = time.perf_counter()
+            resp = self.client.post('/tracking', json={'pings': pings})
+            self.tiempos.append((time.perf_counter() - t0) * 1000.0)
+            self.errores += resp.status_code != 201
+            time.sleep(0.05)
+
+    def __exit__(self, *exc):
+        self._parar.set()
+        self._hilo.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--dias', type=int, default=40)
+    parser.add_argument('--rutas-por-dia', type=int, default=20)
+    args = parser.parse_args()
+
+    hoy = datetime.utcnow().date()
+    t0 = time.perf_counter()
+    route_ids, en_curso = sembrar(args.dias, args.rutas_por_dia, hoy)
+    print(f"Sembrado: {len(route_ids) * PINGS_POR_RUTA:,} pings en {time.perf_counter() - t0:.0f}s")
+
+    with app.app_context():
+        # Rutas de días fuera de la ventana cruda (ayer todavía no se compacta), por nivel
+        por_nivel = {}
+        for d in range(2, args.dias):
+            balde = retencion.balde_para(hoy - timedelta(days=d + 1), hoy)
+            por_nivel.setdefault(balde, []).extend(route_ids[d * args.rutas_por_dia:(d + 1) * args.rutas_por_dia])
+        muestra = [r for rutas in por_nivel.values() for r in rutas[::max(1, len(rutas) // 25)]]
+        filas_antes, mb_antes = Tracking.query.count(), tamano_mb()
+        trazo_antes = consulta_trazo(muestra)
+
+        with Ingesta(en_curso) as ingesta:
+            t0 = time.perf_counter()
+            resumen = compactar_tracking()
+            segundos = time.perf_counter() - t0
+        filas_despues, mb_despues = Tracking.query.count(), tamano_mb()
+        trazo_despues = consulta_trazo(muestra)
+        por_balde = dict(db.session.query(TrackingArchive.bucket_s, db.func.count())
+                         .group_by(TrackingArchive.bucket_s))
+        archivados = sum(1 for dia in retencion.dias_archivados(TRACKING_ARCHIVO_DIR)
+                         for _ in retencion.leer_dia(TRACKING_ARCHIVO_DIR, dia))
+        esperados = db.session.query(db.func.sum(TrackingArchive.raw_pings)).scalar()
+        errores = {balde: errores_trazo(rutas[::max(1, len(rutas) // 25)]) for balde, rutas in por_nivel.items()}
+
+    print(f"Compactación: {resumen['dias']} días en {segundos:.1f}s (días por balde: {por_balde}); "
+          f"{resumen['paginas_liberadas']:,} páginas devueltas al disco")
+    print(f"Tracking: {filas_antes:,} -> {filas_despues:,} filas; DB {mb_antes:.0f} MB -> {mb_despues:.0f} MB")
+    print(f"Trazo de una ruta vieja: p50 {trazo_antes:.2f}ms -> {trazo_despues:.2f}ms")
+    for balde, e in sorted(errores.items()):
+        print(f"Error del trazo, baldes de {balde}s (tolerancia {retencion.NIVELES[balde][0]:.0f} m): "
+              f"p50 {np.percentile(e, 50):.1f} m, p99 {np.percentile(e, 99):.1f} m, máx {e.max():.1f} m")
+    print(f"Ingesta durante la compactación: {len(ingesta.tiempos)} lotes, "
+          f"p50 {comun.percentil(ingesta.tiempos, 50):.1f}ms p99 {comun.percentil(ingesta.tiempos, 99):.1f}ms, "
+          f"{ingesta.errores} errores")
+
+    if archivados != esperados or archivados != resumen['archivados']:
+        raise SystemExit(f"FALLA: el archivo tiene {archivados} pings crudos de {resumen['archivados']}")
+    for balde, e in errores.items():
+        if np.percentile(e, 99) > 2 * retencion.NIVELES[balde][0]:
+            raise SystemExit(f"FALLA: el p99 del error con baldes de {balde}s supera el doble de la tolerancia")
+    if ingesta.errores:
+        raise SystemExit("FALLA: la ingesta devolvió errores durante la compactación")
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
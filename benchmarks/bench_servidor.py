@@ -0,0 +1,265 @@
+"""Rendimiento del servidor de desarrollo frente a los de producción (wsgi.py, gunicorn).
+
+Siembra una DB con seed.py y levanta, uno por vez y en su propio proceso:
+
+- actual:   lo que hacía `python main.py`: esquema + posiciones y app.run(debug=True)
+            (sin el reloader, que solo vigila archivos);
+- wsgi:     `python wsgi.py`, un proceso con hilos y sin debugger;
+- gunicorn: `gunicorn -c gunicorn.conf.py wsgi:app` con cada combinación de
+            --gunicorn (workers x hilos), si gunicorn está instalado.
+
+Contra cada uno corre la misma carga de lectura: --usuarios sesiones reales
+(login con CSRF) repartidas en --procesos procesos cliente, cada una sondeando
+su mapa y su panel según el rol, durante --segundos. Reporta req/s, p50/p99,
+errores, el tiempo de arranque y la latencia del primer sondeo de mapa (con
+las cachés precargadas no paga el calentamiento).
+
+Uso: python benchmarks/bench_servidor.py [--segundos 15] [--usuarios 32] [--gunicorn 1x8,2x4]
+"""
+import argparse
+import http.client
+import os
+import re
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+BBOX_CHILE = '-56,-76,-17,-66'
+
+# Lo que hacía el bloque __main__ de main.py antes del punto de entrada de producción
+ACTUAL = """
+import os, main
+with main.app.app_context():
+    main.db.create_all(); main.agregar_columnas(); main.crear_indices()
+    main.sincronizar_ciudades(); main.calentar_posiciones()
+main.app.run(host='127.0.0.1', port=int(os.environ['PORT']), debug=True, use_reloader=False)
+"""
+
+FLUJOS = {
+    'chofer': ['/mapa_data', '/dashboard_chofer'],
+    'despachador': ['/mapa_despachador_data', '/mapa_despachador_data', '/dashboard_despachador'],
+    'admin': [f'/mapa_admin_data?bbox={BBOX_CHILE}&zoom=5', '/dashboard_admin'],
+}
+
+
+def percentil(valores, p):
+    orden = sorted(valores)
+    k = max(0, min(len(orden) - 1, int(round(p / 100.0 * len(orden) + 0.5)) - 1))
+    return orden[k]
+
+
+class Sesion:
+    """Cliente HTTP/1.1 con conexión persistente y cookies propias."""
+
+    def __init__(self, puerto):
+        self.puerto = puerto
+        self.conn = http.client.HTTPConnection('127.0.0.1', puerto, timeout=60)
+        self.cookies = {}
+
+    def pedir(self, metodo, url, cuerpo=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{k}={v}' for k, v in self.cookies.items())
+        for intento in range(2):
+            try:
+                self.conn.request(metodo, url, body=cuerpo, headers=headers)
+                resp = self.conn.getresponse()
+                datos = resp.read()
+                break
+            except (http.client.HTTPException, OSError):
+                # El servidor cerró la conexión persistente: se abre otra
+                self.conn.close()
+                self.conn = http.client.HTTPConnection('127.0.0.1', self.puerto, timeout=60)
+                if intento:
+                    raise
+        for valor in resp.headers.get_all('Set-Cookie') or []:
+            nombre, _, resto = valor.partition('=')
+            self.cookies[nombre.strip()] = resto.split(';', 1)[0]
+        if resp.getheader('Connection', '').lower() == 'close':
+            self.conn.close()
+        return resp.status, datos
+
+    def login(self, username, password):
+        _, html = self.pedir('GET', '/login')
+        token = re.search(rb'name="csrf_token" value="([^"]*)"', html).group(1).decode()
+        cuerpo = urllib.parse.urlencode({'username': username, 'password': password, 'csrf_token': token})
+        status, _ = self.pedir('POST', '/login', cuerpo, {'Content-Type': 'application/x-www-form-urlencoded'})
+        if status != 302:
+            raise RuntimeError(f'login falló para {username}: {status}')
+
+
+def carga(puerto, usuarios, password, medir_desde, hasta):
+    """Proceso cliente: una sesión por usuario en su hilo; devuelve [(url, ms, status)] medidos."""
+    resultados = []
+    lock = threading.Lock()
+
+    def sesion(username, rol):
+        cliente = Sesion(puerto)
+        cliente.login(username, password)
+        propios = []
+        i = 0
+        while time.time() < hasta:
+            url = FLUJOS[rol][i % len(FLUJOS[rol])]
+            i += 1
+            t0 = time.perf_counter()
+            try:
+                status, _ = cliente.pedir('GET', url)
+            except (http.client.HTTPException, OSError):
+                status = 0
+            if time.time() >= medir_desde:
+                propios.append((url.split('?')[0], (time.perf_counter() - t0) * 1000.0, status))
+        with lock:
+            resultados.extend(propios)
+
+    hilos = [threading.Thread(target=sesion, args=u) for u in usuarios]
+    for h in hilos:
+        h.start()
+    for h in hilos:
+        h.join()
+    return resultados
+
+
+def elegir_usuarios(ruta_db, n):
+    """Reparte `n` sesiones: mitad choferes con camión, un tercio despachadores con flota, el resto admins."""
+    with sqlite3.connect(ruta_db) as conn:
+        choferes = [u for (u,) in conn.execute(
+            "SELECT DISTINCT u.username FROM user u JOIN truck t ON t.driver_id = u.id ORDER BY u.id LIMIT ?", (n,))]
+        despachadores = [u for (u,) in conn.execute(
+            "SELECT DISTINCT u.username FROM user u JOIN truck t ON t.dispatcher_id = u.id ORDER BY u.id LIMIT ?",
+            (n,))]
+        admins = [u for (u,) in conn.execute("SELECT username FROM user WHERE role = 'admin' LIMIT 1")]
+    n_chofer, n_desp = n // 2, n // 3
+    sesiones = [(choferes[i % len(choferes)], 'chofer') for i in range(n_chofer)]
+    sesiones += [(despachadores[i % len(despachadores)], 'despachador') for i in range(n_desp)]
+    sesiones += [(admins[0], 'admin')] * (n - n_chofer - n_desp)
+    return sesiones
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def esperar_arranque(puerto, proceso, timeout=120):
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < timeout:
+        if proceso.poll() is not None:
+            raise RuntimeError(f'el servidor terminó al arrancar (código {proceso.returncode})')
+        try:
+            if Sesion(puerto).pedir('GET', '/login')[0] == 200:
+                return time.perf_counter() - t0
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('el servidor no respondió a tiempo')
+
+
+def medir(nombre, comando, env, args, sesiones, log):
+    puerto = puerto_libre()
+    env = {**env, 'PORT': str(puerto), 'BIND': f'127.0.0.1:{puerto}'}
+    with open(log, 'ab') as salida:
+        proceso = subprocess.Popen(comando, cwd=RAIZ, env=env, stdout=salida, stderr=subprocess.STDOUT)
+    try:
+        arranque = esperar_arranque(puerto, proceso)
+        primera = Sesion(puerto)
+        primera.login(next(u for u, r in sesiones if r == 'despachador'), args.password)
+        t0 = time.perf_counter()
+        primera.pedir('GET', '/mapa_despachador_data')
+        primer_mapa = (time.perf_counter() - t0) * 1000.0
+
+        inicio = time.time() + 2.0  # se deja un margen para los logins
+        medir_desde, hasta = inicio + 1.0, inicio + 1.0 + args.segundos
+        grupos = [sesiones[i::args.procesos] for i in range(args.procesos)]
+        with ProcessPoolExecutor(max_workers=args.procesos) as pool:
+            futuros = [pool.submit(carga, puerto, g, args.password, medir_desde, hasta) for g in grupos if g]
+            resultados = [r for f in futuros for r in f.result()]
+    finally:
+        proceso.terminate()
+        try:
+            proceso.wait(30)
+        except subprocess.TimeoutExpired:
+            proceso.kill()
+    tiempos = [ms for _, ms, status in resultados if status == 200]
+    errores = sum(1 for _, _, status in resultados if status != 200)
+    por_url = {}
+    for url, ms, status in resultados:
+        if status == 200:
+            por_url.setdefault(url, []).append(ms)
+    return {
+        'por_url': {url: (len(t) / args.segundos, percentil(t, 50), percentil(t, 99)) for url, t in por_url.items()},
+        'nombre': nombre, 'rps': len(tiempos) / args.segundos,
+        'p50': percentil(tiempos, 50) if tiempos else float('nan'),
+        'p99': percentil(tiempos, 99) if tiempos else float('nan'),
+        'errores': errores, 'arranque': arranque, 'primer_mapa': primer_mapa,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seed-args', default='--users 300 --trucks 200 --routes 20k --pings 200k --random-seed 1')
+    parser.add_argument('--password', default='1234')
+    parser.add_argument('--segundos', type=float, default=15)
+    parser.add_argument('--usuarios', type=int, default=32)
+    parser.add_argument('--procesos', type=int, default=4, help='procesos cliente que generan la carga')
+    parser.add_argument('--detalle', action='store_true', help='req/s y latencias por endpoint')
+    parser.add_argument('--gunicorn', default=f'{os.cpu_count()}x8,{2 * os.cpu_count()}x4',
+                        help='combinaciones workers x hilos, separadas por coma')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='logitrack-servidor-')
+    ruta_db = os.path.join(tmp, 'bench.db')
+    print(f"Sembrando DB temporal: seed.py {args.seed_args}")
+    subprocess.run([sys.executable, os.path.join(RAIZ, 'seed.py'), '--db', ruta_db,
+                    '--password', args.password] + args.seed_args.split(), check=True, cwd=RAIZ)
+    env = {**os.environ, 'DATABASE_URL': 'sqlite:///' + ruta_db, 'TRABAJOS_DIR': os.path.join(tmp, 'trabajos'),
+           'PYTHONUNBUFFERED': '1'}
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'main', 'init-db'], check=True, cwd=RAIZ, env=env)
+    sesiones = elegir_usuarios(ruta_db, args.usuarios)
+    log = os.path.join(tmp, 'servidores.log')
+
+    variantes = [
+        ('actual (app.run debug)', [sys.executable, '-c', ACTUAL], {}),
+        ('wsgi.py (hilos)', [sys.executable, 'wsgi.py'], {}),
+    ]
+    if shutil.which('gunicorn') or subprocess.run([sys.executable, '-c', 'import gunicorn'],
+                                                  capture_output=True).returncode == 0:
+        for combinacion in filter(None, args.gunicorn.split(',')):
+            workers, hilos = combinacion.split('x')
+            variantes.append((f'gunicorn {workers} workers x {hilos} hilos',
+                              [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'],
+                              {'WEB_CONCURRENCY': workers, 'WEB_THREADS': hilos}))
+    else:
+        print("gunicorn no está instalado: se omite")
+
+    print(f"{len(sesiones)} sesiones en {args.procesos} procesos cliente, {args.segundos:.0f}s por servidor, "
+          f"{os.cpu_count()} núcleos")
+    print(f"{'servidor':<32} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errores':>8} "
+          f"{'arranque':>9} {'1er mapa':>9}")
+    resultados = []
+    for nombre, comando, extra in variantes:
+        r = medir(nombre, comando, {**env, **extra}, args, sesiones, log)
+        resultados.append(r)
+        print(f"{r['nombre']:<32} {r['rps']:>8.1f} {r['p50']:>8.1f} {r['p99']:>8.1f} {r['errores']:>8} "
+              f"{r['arranque']:>8.2f}s {r['primer_mapa']:>7.1f}ms")
+        if args.detalle:
+            for url, (rps, p50, p99) in sorted(r['por_url'].items()):
+                print(f"  {url:<30} {rps:>8.1f} {p50:>8.1f} {p99:>8.1f}")
+    base = resultados[0]['rps']
+    mejor = max(resultados[1:], key=lambda r: r['rps'])
+    print(f"Mejor: {mejor['nombre']} con {mejor['rps'] / base:.1f}x el throughput del servidor actual "
+          f"(log de los servidores: {log})")
+    if any(r['errores'] for r in resultados[1:]):
+        raise SystemExit("FALLA: hubo respuestas con error en los servidores de producción")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""Operaciones pesadas en línea vs encoladas como trabajo (trabajos.py).
+
+Importa un manifiesto de --filas rutas de dos formas: en el request
+(POST /admin/import/routes) y encolado (?segundo_plano=1). Mide cuánto tarda
+en responder el POST, cuánto tarda el trabajo en terminar y la latencia de los
+sondeos del mapa de un despachador (otro hilo) en reposo y mientras corre el
+trabajo. Después encola un export, lo baja y compara sus filas, y mide cuánto
+tarda en parar un trabajo cancelado.
+
+Uso: python benchmarks/bench_trabajos.py [--filas 200000] [--rutas 2000]
+"""
+import argparse
+import gzip
+import threading
+import time
+
+import comun
+from ciudades import indice as indice_ciudades
+from main import app, db, User, Truck, Route, reconstruir_stats, verificar_stats
+
+TERMINADOS = ('completado', 'fallido', 'cancelado')
+
+
+def sembrar(n_rutas):
+    comun.reiniciar_db()
+    ciudades = list(indice_ciudades)
+    with app.app_context():
+        desp = User(username='desp', role='despachador', password=comun.PASSWORD_HASH)
+        db.session.add_all([desp, User(username='admin', role='admin', password=comun.PASSWORD_HASH)])
+        db.session.flush()
+        camiones = []
+        for i in range(50):
+            chofer = User(username=f'chofer{i}', role='chofer', password=comun.PASSWORD_HASH)
+            camiones.append(Truck(plate=f'TRB{i:03d}', status='en ruta', driver=chofer, dispatcher_id=desp.id))
+        db.session.add_all(camiones)
+        db.session.flush()
+        filas = []
+        for i in range(n_rutas):
+            origen, destino = ciudades[i % len(ciudades)], ciudades[(i * 7 + 3) % len(ciudades)]
+            filas.append({'origin': origen.nombre, 'destination': destino.nombre,
+                          'origin_city_id': origen.id, 'destination_city_id': destino.id,
+                          'status': 'en_progreso', 'truck_id': camiones[i % len(camiones)].id})
+        db.session.execute(db.insert(Route.__table__), filas)
+        db.session.commit()
+        reconstruir_stats()
+
+
+def manifiesto(n):
+    ciudades = list(indice_ciudades)
+    lineas = ['origin,destination,status']
+    for i in range(n):
+        lineas.append(f'{ciudades[i % len(ciudades)].nombre},{ciudades[(i * 3 + 1) % len(ciudades)].nombre},pendiente')
+    return ('\n'.join(lineas) + '\n').encode('utf-8')
+
+
+class Sondeos:
+    """Sondea el mapa del despachador desde otro hilo y guarda las latencias."""
+
+    def __init__(self):
+        self.client = app.test_client()
+        comun.login(self.client, 'desp')
+        self.tiempos = []
+        self._parar = threading.Event()
+        self._hilo = None
+
+    def __enter__(self):
+        self.tiempos = []
+        self._parar.clear()
+        self._hilo = threading.Thread(target=self._correr, daemon=True)
+        self._hilo.start()
+        return self
+
+    def _correr(self):
+        while not self._parar.is_set():
+            t0 = time.perf_counter()
+            self.client.get('/mapa_despachador_data')
+            self.tiempos.append((time.perf_counter() - t0) * 1000.0)
+            time.sleep(0.02)
+
+    def __exit__(self, *exc):
+        self._parar.set()
+        self._hilo.join()
+
+    def resumen(self):
+        return f"p50 {comun.percentil(self.tiempos, 50):6.1f}ms  p99 {comun.percentil(self.tiempos, 99):6.1f}ms " \
+               f"({len(self.tiempos)} sondeos)"
+
+
+def esperar(client, url, intervalo=0.05):
+    """Sondea el estado del trabajo hasta que termine; devuelve (estado, sondeos de estado)."""
+    sondeos = 0
+    while True:
+        estado = client.get(url).get_json()
+        sondeos += 1
+        if estado['estado'] in TERMINADOS:
+            return estado, sondeos
+        time.sleep(intervalo)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--filas', type=int, default=200000)
+    parser.add_argument('--rutas', type=int, default=2000)
+    args = parser.parse_args()
+
+    sembrar(args.rutas)
+    admin = app.test_client()
+    comun.login(admin, 'admin')
+    cuerpo = manifiesto(args.filas)
+    sondeos = Sondeos()
+
+    with sondeos:
+        time.sleep(1.0)
+    print(f"Mapa en reposo:                {sondeos.resumen()}")
+
+    with sondeos:
+        t0 = time.perf_counter()
+        resp = admin.post('/admin/import/routes?formato=csv', data=cuerpo)
+        en_linea = (time.perf_counter() - t0) * 1000.0
+    insertadas_en_linea = resp.get_json()['insertadas']
+    print(f"Import en el request: POST {en_linea:8.0f}ms; mapa {sondeos.resumen()}")
+
+    with sondeos:
+        t0 = time.perf_counter()
+        resp = admin.post('/admin/import/routes?formato=csv&segundo_plano=1', data=cuerpo)
+        encolado = (time.perf_counter() - t0) * 1000.0
+        with comun.contar_sql() as c:
+            estado, n_estado = esperar(admin, resp.headers['Location'])
+        total = (time.perf_counter() - t0) * 1000.0
+    print(f"Import encolado:      POST {encolado:8.1f}ms; terminado en {total:.0f}ms; "
+          f"mapa {sondeos.resumen()}")
+    print(f"  {n_estado} sondeos de estado, avance visto hasta {estado['avance']:.0%}; "
+          f"{c[0]} queries en total durante el trabajo (con las del propio trabajo)")
+    if estado['estado'] != 'completado' or estado['resultado']['insertadas'] != insertadas_en_linea:
+        raise SystemExit(f"FALLA: el import encolado no coincide: {estado}")
+
+    resp = admin.post('/admin/export/routes?formato=csv&gzip=1')
+    estado, _ = esperar(admin, resp.headers['Location'])
+    descarga = admin.get(estado['descarga'])
+    filas = len(gzip.decompress(descarga.data).splitlines()) - 1
+    with app.app_context():
+        esperadas = db.session.query(db.func.count(Route.id)).scalar()
+    print(f"Export encolado: {filas:,} filas ({estado['resultado']['bytes']:,} bytes gzip)")
+    if filas != esperadas:
+        raise SystemExit(f"FALLA: el export tiene {filas} filas y hay {esperadas} rutas")
+
+    resp = admin.post('/admin/import/routes?formato=csv&segundo_plano=1', data=cuerpo)
+    url = resp.headers['Location']
+    while admin.get(url).get_json()['avance'] < 0.2:
+        time.sleep(0.05)
+    t0 = time.perf_counter()
+    admin.post(url + '/cancelar')
+    estado, _ = esperar(admin, url, intervalo=0.01)
+    print(f"Cancelar un import en curso: {estado['estado']} en {(time.perf_counter() - t0) * 1000.0:.0f}ms "
+          f"({estado['mensaje']})")
+    with app.app_context():
+        diferencias = verificar_stats()
+    if estado['estado'] != 'cancelado' or diferencias:
+        raise SystemExit(f"FALLA: la cancelación no paró el trabajo o dejó contadores inconsistentes {diferencias}")
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""Trazo de una ruta (GET /rutas/<id>/trazo): tamaño y latencia por formato.
+
+Siembra un viaje de --horas horas con un ping por segundo (36k puntos en 10 h)
+sobre un camino con curvas, más otras rutas del mismo camión para que el
+índice (route_id, timestamp) tenga vecinos. Compara contra lo que sería la
+lista JSON de [epoch, lat, lon]:
+
+- bytes de la respuesta sin comprimir y con gzip, y p50 de la latencia;
+- la fidelidad del decodificado (trazos.decodificar_polyline / leer_binario);
+- una ventana de 10 minutos para el replay, el corte en partes con
+  MAX_PUNTOS_TRAZO y el 304 de un segundo pedido con el mismo ETag.
+
+Falla si el decodificado se aleja más de media unidad de la precisión, si la
+ventana o las partes no cuadran con la DB o si el 304 no llega.
+
+Uso: python benchmarks/bench_trazo.py [--horas 10] [--repeticiones 20]
+"""
+import argparse
+import gzip
+import json
+import math
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import comun
+import main as servidor
+import retencion
+import trazos
+from main import app, db, User, Truck, Route, Tracking, _epoch
+
+
+def sembrar(horas):
+    comun.reiniciar_db()
+    rng = np.random.default_rng(11)
+    n = horas * 3600
+    with app.app_context():
+        chofer = User(username='chofer', role='chofer', password=comun.PASSWORD_HASH)
+        desp = User(username='desp', role='despachador', password=comun.PASSWORD_HASH)
+        otro = User(username='otro', role='despachador', password=comun.PASSWORD_HASH)
+        db.session.add_all([chofer, desp, otro])
+        db.session.flush()
+        camion = Truck(plate='TRZ001', status='en ruta', driver=chofer, dispatcher_id=desp.id)
+        db.session.add(camion)
+        db.session.flush()
+        rutas = [Route(origin='Santiago', destination='Puerto Montt', status='completada', truck_id=camion.id)
+                 for _ in range(3)]
+        db.session.add_all(rutas)
+        db.session.commit()
+        inicio = datetime(2026, 3, 2, 6, 0, 0)
+        for route in rutas:
+            rumbo = np.cumsum(rng.normal(0, 0.02, n)) + rng.uniform(0, 2 * math.pi)
+            paso = rng.uniform(15, 25, n)
+            y = np.cumsum(paso * np.cos(rumbo))
+            x = np.cumsum(paso * np.sin(rumbo))
+            lat = -33.45 + np.degrees(y / retencion.RADIO_TIERRA_M)
+            lon = -70.65 + np.degrees(x / (retencion.RADIO_TIERRA_M * math.cos(math.radians(-33.45))))
+            db.session.execute(db.insert(Tracking.__table__), [
+                {'route_id': route.id, 'lat': float(lat[i]), 'lon': float(lon[i]),
+                 'timestamp': inicio + timedelta(seconds=i, microseconds=int(rng.integers(0, 400000)))}
+                for i in range(n)])
+            db.session.commit()
+        return rutas[1].id, inicio
+
+
+def medir(client, url, repeticiones):
+    """(p50 ms, bytes, bytes gzip, respuesta) de GET url."""
+    tiempos = []
+    for _ in range(repeticiones):
+        t0 = time.perf_counter()
+        resp = client.get(url)
+        tiempos.append((time.perf_counter() - t0) * 1000.0)
+    comprimida = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    return comun.percentil(tiempos, 50), len(resp.data), len(comprimida.data), resp
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--horas', type=int, default=10)
+    parser.add_argument('--repeticiones', type=int, default=20)
+    args = parser.parse_args()
+
+    route_id, inicio = sembrar(args.horas)
+    with app.app_context():
+        crudo = db.session.execute(
+            db.select(Tracking.timestamp, Tracking.lat, Tracking.lon)
+            .where(Tracking.route_id == route_id).order_by(Tracking.timestamp)).all()
+    epoch = np.array([_epoch(ts) for ts, _, _ in crudo])
+    lat = np.array([f[1] for f in crudo])
+    lon = np.array([f[2] for f in crudo])
+    lista = json.dumps({'puntos': [[round(e, 3), la, lo] for e, la, lo in zip(epoch, lat, lon)]}).encode()
+    print(f"Ruta {route_id}: {len(crudo):,} puntos en {args.horas} h")
+    print(f"  lista JSON [epoch, lat, lon] (referencia): {len(lista):>10,} B   gzip {len(gzip.compress(lista)):>9,} B")
+
+    client = app.test_client()
+    comun.login(client, 'desp')
+    url = f'/rutas/{route_id}/trazo'
+    resultados = {}
+    for nombre, consulta in [('polyline', ''), ('polyline p6', '?precision=6'),
+                             ('binario', '?formato=binario'), ('polyline 5 m', '?tolerancia=5')]:
+        p50, crudos, comprimidos, resp = medir(client, url + consulta, args.repeticiones)
+        resultados[nombre] = resp
+        print(f"  {nombre:<13} p50 {p50:6.1f}ms  {crudos:>10,} B   gzip {comprimidos:>9,} B")
+
+    fallas = []
+    datos = resultados['polyline'].get_json()
+    dlat, dlon = trazos.decodificar_polyline(datos['polyline'])
+    dt = datos['t0'] + np.cumsum(trazos.decodificar_enteros(datos['tiempos']))
+    if max(np.abs(dlat - lat).max(), np.abs(dlon - lon).max()) > 0.5e-5 + 1e-9 or \
+            np.abs(dt - epoch).max() > 0.5 + 1e-6:
+        fallas.append('la polyline no reproduce el trazo')
+    datos6 = resultados['polyline p6'].get_json()
+    dlat6, _ = trazos.decodificar_polyline(datos6['polyline'], 6)
+    bt, blat, blon = trazos.leer_binario(resultados['binario'].data)
+    if np.abs(dlat6 - lat).max() > 0.5e-6 + 1e-9 or np.abs(blat - lat).max() > 0.5e-6 + 1e-9 or \
+            np.abs(blon - lon).max() > 0.5e-6 + 1e-9 or np.abs(bt - epoch).max() > 0.5 + 1e-6:
+        fallas.append('precision=6 o el binario no reproducen el trazo')
+    simplificado = resultados['polyline 5 m'].get_json()['puntos']
+    print(f"  con ?tolerancia=5 quedan {simplificado:,} de {len(crudo):,} puntos")
+
+    # Ventana de 10 minutos a mitad del viaje (replay)
+    desde = inicio + timedelta(hours=args.horas / 2)
+    hasta = desde + timedelta(minutes=10)
+    ventana = f'{url}?desde={desde.isoformat()}&hasta={hasta.isoformat()}'
+    p50, crudos, _, resp = medir(client, ventana, args.repeticiones)
+    esperados = int(((epoch >= _epoch(desde)) & (epoch < _epoch(hasta))).sum())
+    print(f"  ventana de 10 min: {resp.get_json()['puntos']} puntos, {crudos:,} B, p50 {p50:.1f}ms")
+    if resp.get_json()['puntos'] != esperados:
+        fallas.append(f'la ventana trae {resp.get_json()["puntos"]} puntos y hay {esperados}')
+
+    # Partes de a MAX_PUNTOS_TRAZO
+    original, servidor.MAX_PUNTOS_TRAZO = servidor.MAX_PUNTOS_TRAZO, 5000
+    total, partes, siguiente = 0, 0, ''
+    while siguiente is not None:
+        datos = client.get(url + (f'?desde={siguiente}' if siguiente else '')).get_json()
+        total, partes, siguiente = total + datos['puntos'], partes + 1, datos['siguiente']
+    servidor.MAX_PUNTOS_TRAZO = original
+    print(f"  en partes de 5000: {partes} partes, {total:,} puntos")
+    if total != len(crudo):
+        fallas.append(f'las partes suman {total} puntos y hay {len(crudo)}')
+
+    t0 = time.perf_counter()
+    resp = client.get(url, headers={'If-None-Match': resultados['polyline'].headers['ETag']})
+    print(f"  mismo ETag: {resp.status_code} en {(time.perf_counter() - t0) * 1000.0:.1f}ms")
+    if resp.status_code != 304:
+        fallas.append('un pedido con el mismo ETag no devolvió 304')
+
+    ajeno = app.test_client()
+    comun.login(ajeno, 'otro')
+    if ajeno.get(url).status_code != 403:
+        fallas.append('un despachador ajeno pudo ver el trazo')
+
+    if fallas:
+        raise SystemExit('FALLA: ' + '; '.join(fallas))
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
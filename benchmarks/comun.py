@@ -0,0 +1,84 @@
+"""Utilidades compartidas por los benchmarks: DB temporal, login y conteo de SQL.
+
+Importar este módulo ANTES que `main`: fija DATABASE_URL (y TRABAJOS_DIR,
+TRACKING_ARCHIVO_DIR) a un directorio temporal para no tocar la base de datos
+de desarrollo.
+"""
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if RAIZ not in sys.path:
+    sys.path.insert(0, RAIZ)
+
+_tmp = tempfile.mkdtemp(prefix='logitrack-bench-')
+if 'DATABASE_URL' not in os.environ:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_tmp, 'bench.db')
+os.environ.setdefault('TRABAJOS_DIR', os.path.join(_tmp, 'trabajos'))  # archivos de los trabajos encolados
+os.environ.setdefault('TRACKING_ARCHIVO_DIR', os.path.join(_tmp, 'tracking'))  # segmentos de la retención
+
+from sqlalchemy import event  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+from identidad import identidades  # noqa: E402
+from main import app, db  # noqa: E402
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['TESTING'] = True
+
+# Hash barato: los benchmarks no miden el costo de pbkdf2
+PASSWORD = '1234'
+PASSWORD_HASH = generate_password_hash(PASSWORD, method='pbkdf2:sha256:1')
+
+
+def reiniciar_db():
+    """Borra y recrea el esquema en la DB temporal (y vacía la caché de identidades)."""
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    identidades.limpiar()
+
+
+@contextmanager
+def contar_sql():
+    """Cuenta las sentencias SQL ejecutadas dentro del bloque: `with contar_sql() as c: ...; c[0]`."""
+    contador = [0]
+
+    def _antes(conn, cursor, statement, parameters, context, executemany):
+        contador[0] += 1
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', _antes)
+    try:
+        yield contador
+    finally:
+        event.remove(engine, 'before_cursor_execute', _antes)
+
+
+def login(client, username):
+    resp = client.post('/login', data={'username': username, 'password': PASSWORD})
+    if resp.status_code != 302:
+        raise RuntimeError(f'login falló para {username}: {resp.status_code}')
+
+
+def percentil(valores, p):
+    """Percentil por rango más cercano; NaN si no hay valores."""
+    orden = sorted(valores)
+    if not orden:
+        return float('nan')
+    k = max(0, min(len(orden) - 1, int(round(p / 100.0 * len(orden) + 0.5)) - 1))
+    return orden[k]
+
+
+def cronometrar(fn, repeticiones):
+    """Ejecuta `fn` varias veces y devuelve la lista de latencias en ms."""
+    tiempos = []
+    for _ in range(repeticiones):
+        t0 = time.perf_counter()
+        fn()
+        tiempos.append((time.perf_counter() - t0) * 1000.0)
+    return tiempos
@@ -0,0 +1,100 @@
+"""Índice de coordenadas de ciudades chilenas para ubicar rutas en los mapas.
+
+Se carga una sola vez desde `data/ciudades_cl.csv` (ids estables, los mismos de
+la tabla `city`). La búsqueda por nombre no distingue mayúsculas, tildes ni
+espacios extra, acepta alias ("Stgo", "Valpo") y sufijos de región
+("Temuco, La Araucanía"). Los nombres ya consultados, incluidos los que no
+existen, quedan en un LRU para no repetir el trabajo.
+"""
+import csv
+import os
+import unicodedata
+from functools import lru_cache
+
+from espacial import Grilla
+
+RUTA_DATASET = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'ciudades_cl.csv')
+
+
+def normalizar(nombre):
+    """'  Concepción ' -> 'concepcion'; también quita puntos y guiones."""
+    if not nombre:
+        return ''
+    sin_tildes = ''.join(
+        c for c in unicodedata.normalize('NFKD', nombre) if not unicodedata.combining(c)
+    )
+    limpio = sin_tildes.lower().replace('.', ' ').replace('-', ' ')
+    return ' '.join(limpio.split())
+
+
+class Ciudad:
+    __slots__ = ('id', 'nombre', 'region', 'lat', 'lon')
+
+    def __init__(self, id, nombre, region, lat, lon):
+        self.id = id
+        self.nombre = nombre
+        self.region = region
+        self.lat = lat
+        self.lon = lon
+
+    @property
+    def coords(self):
+        return [self.lat, self.lon]
+
+
+class IndiceCiudades:
+    def __init__(self, ciudades, alias=None):
+        self.por_id = {c.id: c for c in ciudades}
+        self._por_nombre = {normalizar(c.nombre): c.id for c in ciudades}
+        for texto, city_id in (alias or {}).items():
+            self._por_nombre.setdefault(normalizar(texto), city_id)
+        self.resolver = lru_cache(maxsize=4096)(self._resolver)
+        self.grilla = Grilla(tam=1.0)
+        for c in ciudades:
+            self.grilla.mover(c.id, c.lat, c.lon)
+
+    @classmethod
+    def desde_csv(cls, ruta=RUTA_DATASET):
+        ciudades, alias = [], {}
+        with open(ruta, encoding='utf-8', newline='') as f:
+            for fila in csv.DictReader(f):
+                city_id = int(fila['id'])
+                ciudades.append(Ciudad(city_id, fila['nombre'], fila['region'],
+                                       float(fila['lat']), float(fila['lon'])))
+                for texto in filter(None, (fila.get('alias') or '').split('|')):
+                    alias[texto] = city_id
+        return cls(ciudades, alias)
+
+    def _resolver(self, nombre):
+        """Id de la ciudad para un texto libre, o None si no se reconoce."""
+        clave = normalizar(nombre)
+        if not clave:
+            return None
+        city_id = self._por_nombre.get(clave)
+        if city_id is None and ',' in clave:
+            # "Temuco, La Araucanía" / "Santiago, Chile"
+            city_id = self._por_nombre.get(clave.split(',', 1)[0].strip())
+        return city_id
+
+    def coords(self, city_id):
+        ciudad = self.por_id.get(city_id)
+        return ciudad.coords if ciudad else None
+
+    def coords_de(self, city_id, nombre):
+        """Coordenadas por id ya resuelto; si falta (filas antiguas), por nombre."""
+        if city_id is None:
+            city_id = self.resolver(nombre)
+        return self.coords(city_id)
+
+    def en_bbox(self, bbox):
+        """Ids de las ciudades dentro de bbox = (sur, oeste, norte, este)."""
+        return self.grilla.consultar(bbox)
+
+    def __iter__(self):
+        return iter(self.por_id.values())
+
+    def __len__(self):
+        return len(self.por_id)
+
+
+indice = IndiceCiudades.desde_csv()
@@ -0,0 +1,79 @@
+"""Perfil de base de datos configurable por variables de entorno.
+
+- DATABASE_URL: URI de SQLAlchemy (por defecto `sqlite:///database.db`). Con
+  `postgresql://...` se usa PostgreSQL (requiere instalar `psycopg2-binary`).
+- DB_PROFILE: `dev` (por defecto) o `prod`; fija los valores base de abajo.
+- SQLITE_JOURNAL_MODE, SQLITE_SYNCHRONOUS, SQLITE_MMAP_SIZE, SQLITE_CACHE_SIZE,
+  SQLITE_BUSY_TIMEOUT: sobreescriben cada PRAGMA del perfil.
+- DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE, DB_POOL_TIMEOUT: pool de conexiones.
+"""
+import os
+import re
+
+PERFILES = {
+    'dev': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 0,
+        'cache_size': -2000,  # negativo = KiB (2 MB, el default de SQLite)
+        'busy_timeout': 5000,
+        'pool_size': 5,
+        'max_overflow': 10,
+    },
+    'prod': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,  # 64 MB por conexión
+        'busy_timeout': 10000,
+        'pool_size': 10,
+        'max_overflow': 20,
+    },
+}
+
+_PRAGMAS = ('journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'busy_timeout')
+_VALOR_PRAGMA = re.compile(r'^-?[A-Za-z0-9_]+$')
+
+
+def perfil():
+    nombre = os.environ.get('DB_PROFILE', 'dev')
+    if nombre not in PERFILES:
+        raise ValueError(f"DB_PROFILE desconocido: {nombre!r} (opciones: {', '.join(PERFILES)})")
+    return PERFILES[nombre]
+
+
+def database_uri():
+    uri = os.environ.get('DATABASE_URL', 'sqlite:///database.db')
+    # Heroku y otros entregan el esquema antiguo "postgres://"
+    if uri.startswith('postgres://'):
+        uri = 'postgresql://' + uri[len('postgres://'):]
+    return uri
+
+
+def sqlite_pragmas():
+    """PRAGMAs a aplicar en cada conexión SQLite nueva, en orden."""
+    base = perfil()
+    pragmas = {}
+    for nombre in _PRAGMAS:
+        valor = str(os.environ.get(f'SQLITE_{nombre.upper()}', base[nombre]))
+        if not _VALOR_PRAGMA.match(valor):
+            raise ValueError(f'Valor inválido para SQLITE_{nombre.upper()}: {valor!r}')
+        pragmas[nombre] = valor
+    return pragmas
+
+
+def engine_options(uri=None):
+    """Opciones de `create_engine` para SQLALCHEMY_ENGINE_OPTIONS."""
+    uri = uri or database_uri()
+    base = perfil()
+    if uri == 'sqlite://' or ':memory:' in uri:
+        return {}
+    opciones = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', base['pool_size'])),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', base['max_overflow'])),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    }
+    if uri.startswith('postgresql'):
+        opciones['pool_pre_ping'] = True
+        opciones['pool_recycle'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    return opciones
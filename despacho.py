@@ -0,0 +1,178 @@
+"""Asignación automática de rutas pendientes a camiones disponibles.
+
+Minimiza el recorrido en vacío total: la distancia desde donde está cada camión
+hasta el origen de la ruta que se le asigna. El costo es una matriz
+camiones × rutas de distancias haversine calculada con NumPy.
+
+- Hasta LIMITE_EXACTO filas o columnas: método húngaro, óptimo (1000×1000 en
+  0,3-0,7 s con puntos uniformes, el peor caso; ver benchmarks/bench_despacho.py).
+- Problemas grandes: voraz por vecinos mutuamente más cercanos. Da el mismo
+  resultado que el voraz clásico (tomar siempre el par más barato libre), pero
+  por rondas vectorizadas en vez de un par a la vez.
+
+Si SciPy está instalado se usa su `linear_sum_assignment` (óptimo y rápido a
+cualquier tamaño) en lugar de los dos anteriores.
+"""
+import numpy as np
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:  # opcional
+    linear_sum_assignment = None
+
+RADIO_TIERRA_KM = 6371.0
+LIMITE_EXACTO = 1000
+DESEMPATE_KM = 1e-3  # ver `resolver`: 1 m por puesto en la prioridad
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Distancia haversine en km entre puntos en grados; los arreglos se combinan por broadcasting."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=float)) for v in (lat1, lon1, lat2, lon2))
+    h = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * RADIO_TIERRA_KM * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+
+def matriz_costos(desde, hasta):
+    """Distancias haversine en km entre cada punto de `desde` (m, 2) y de `hasta` (n, 2), en (lat, lon)."""
+    a = np.asarray(desde, dtype=float)
+    b = np.asarray(hasta, dtype=float)
+    return haversine_km(a[:, 0:1], a[:, 1:2], b[:, 0], b[:, 1])
+
+
+def hungaro(costos):
+    """Asignación de costo mínimo (filas, columnas); cada fila y columna se usa a lo más una vez.
+
+    Método húngaro en la variante de caminos de aumento más cortos (Jonker-
+    Volgenant): se parte de potenciales por reducción de filas y de un
+    emparejamiento con las aristas de costo reducido 0, y luego cada fila libre
+    se conecta con un Dijkstra sobre costos reducidos. El Dijkstra recorre
+    columnas con operaciones vectorizadas sobre arreglos preasignados.
+    """
+    costos = np.asarray(costos, dtype=float)
+    transpuesta = costos.shape[0] > costos.shape[1]
+    if transpuesta:
+        costos = costos.T
+    n, m = costos.shape
+    u = costos.min(axis=1)
+    v = np.zeros(m)
+    fila_de = np.full(m, -1)
+    col_de = np.full(n, -1)
+    for i in range(n):
+        for j in np.nonzero(costos[i] - u[i] <= 1e-12)[0]:
+            if fila_de[j] < 0:
+                fila_de[j], col_de[i] = i, j
+                break
+
+    reducido = np.empty(m)
+    mejora = np.empty(m, dtype=bool)
+    for libre in np.nonzero(col_de < 0)[0]:
+        dist = np.empty(m)              # distancia final de cada columna visitada
+        umbral = np.full(m, np.inf)     # mejor distancia tentativa; inf en las visitadas
+        v_ef = v.copy()                 # -inf en las visitadas: su costo reducido queda en inf
+        previo = np.full(m, -1)
+        visitada = np.zeros(m, dtype=bool)
+        filas_arbol = []
+        i, base = libre, 0.0
+        while True:
+            np.subtract(costos[i], v_ef, out=reducido)
+            reducido += base - u[i]
+            np.less(reducido, umbral, out=mejora)
+            np.copyto(umbral, reducido, where=mejora)
+            np.copyto(previo, i, where=mejora)
+            j = int(umbral.argmin())
+            base = umbral[j]
+            dist[j] = base
+            umbral[j] = np.inf
+            v_ef[j] = -np.inf
+            visitada[j] = True
+            if fila_de[j] < 0:
+                break
+            i = fila_de[j]
+            filas_arbol.append(i)
+        # Potenciales: solo cambian los nodos del árbol recorrido
+        u[libre] += base
+        if filas_arbol:
+            filas = np.array(filas_arbol)
+            u[filas] += base - dist[col_de[filas]]
+        cols = np.nonzero(visitada)[0]
+        v[cols] -= base - dist[cols]
+        # Aumentar: invertir el camino desde la columna libre hasta `libre`
+        while True:
+            i = previo[j]
+            fila_de[j] = i
+            j, col_de[i] = col_de[i], j
+            if i == libre:
+                break
+
+    filas, columnas = np.arange(n), col_de
+    if transpuesta:
+        orden = np.argsort(columnas)
+        filas, columnas = columnas[orden], filas[orden]
+    return filas, columnas
+
+
+def voraz(costos):
+    """Voraz por rondas: en cada una se toman todos los pares que son mutuamente el más cercano.
+
+    Un par (i, j) donde j es lo más barato para i e i lo más barato para j es
+    justo lo que el voraz clásico elegiría, así que cada ronda puede asignarlos
+    todos de una vez. Suelen bastar pocas rondas.
+    """
+    costos = np.array(costos, dtype=float)
+    m, n = costos.shape
+    # Con empates (muchos camiones en la misma ciudad) todas las filas eligen la
+    # misma columna y cada ronda asignaría un solo par: un ruido de 1 mm los desempata
+    costos += np.random.default_rng(0).random(costos.shape) * 1e-6
+    filas_libres = np.arange(m)
+    cols_libres = np.arange(n)
+    filas, columnas = [], []
+    while len(filas_libres) and len(cols_libres):
+        sub = costos[np.ix_(filas_libres, cols_libres)]
+        mejor_col = np.argmin(sub, axis=1)           # para cada fila libre
+        mejor_fila = np.argmin(sub, axis=0)          # para cada columna libre
+        mutuas = np.nonzero(mejor_fila[mejor_col] == np.arange(len(filas_libres)))[0]
+        filas.append(filas_libres[mutuas])
+        columnas.append(cols_libres[mejor_col[mutuas]])
+        filas_libres = np.delete(filas_libres, mutuas)
+        cols_libres = np.delete(cols_libres, mejor_col[mutuas])
+    if not filas:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    filas, columnas = np.concatenate(filas), np.concatenate(columnas)
+    orden = np.argsort(filas)
+    return filas[orden], columnas[orden]
+
+
+def asignar(costos, metodo='auto'):
+    """(filas, columnas, metodo_usado) de la asignación de costo mínimo."""
+    costos = np.asarray(costos, dtype=float)
+    if costos.size == 0:
+        vacio = np.array([], dtype=np.int64)
+        return vacio, vacio, 'vacío'
+    if metodo == 'auto':
+        if linear_sum_assignment is not None:
+            metodo = 'scipy'
+        else:
+            metodo = 'hungaro' if min(costos.shape) <= LIMITE_EXACTO else 'voraz'
+    if metodo == 'scipy':
+        filas, columnas = linear_sum_assignment(costos)
+    elif metodo == 'hungaro':
+        filas, columnas = hungaro(costos)
+    elif metodo == 'voraz':
+        filas, columnas = voraz(costos)
+    else:
+        raise ValueError(f'Método desconocido: {metodo!r}')
+    return filas, columnas, metodo
+
+
+def resolver(desde, hasta, prioridad=None, metodo='auto'):
+    """Asigna puntos `desde` (camiones) a puntos `hasta` (orígenes de ruta) minimizando los km.
+
+    `prioridad` (opcional, una por columna, 0 = primero) desempata columnas de
+    igual costo: entre rutas que salen de la misma ciudad gana la más antigua.
+    Devuelve listas (filas, columnas, km de cada par) y el método usado.
+    """
+    costos = matriz_costos(desde, hasta)
+    ajustados = costos + DESEMPATE_KM * np.asarray(prioridad, dtype=float) if prioridad is not None else costos
+    filas, columnas, metodo = asignar(ajustados, metodo)
+    return filas.tolist(), columnas.tolist(), costos[filas, columnas].tolist(), metodo
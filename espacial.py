@@ -0,0 +1,84 @@
+"""Índice espacial de grilla uniforme para consultas por bounding box.
+
+Chile es largo y angosto y los puntos se concentran en pocas ciudades, así que
+una grilla de celdas fijas rinde igual que un R-tree para estas consultas y se
+actualiza en O(1) cuando un camión se mueve.
+"""
+import math
+
+
+def celda(lat, lon, tam):
+    return math.floor(lat / tam), math.floor(lon / tam)
+
+
+def dentro(bbox, lat, lon):
+    sur, oeste, norte, este = bbox
+    return sur <= lat <= norte and oeste <= lon <= este
+
+
+class Grilla:
+    def __init__(self, tam=0.5):
+        self.tam = tam  # grados por celda
+        self._celdas = {}   # (i, j) -> {id: (lat, lon)}
+        self._celda_de = {}  # id -> (i, j)
+
+    def mover(self, id, lat, lon):
+        """Inserta o reubica `id` en (lat, lon)."""
+        nueva = celda(lat, lon, self.tam)
+        vieja = self._celda_de.get(id)
+        if vieja is not None and vieja != nueva:
+            puntos = self._celdas[vieja]
+            del puntos[id]
+            if not puntos:
+                del self._celdas[vieja]
+        self._celdas.setdefault(nueva, {})[id] = (lat, lon)
+        self._celda_de[id] = nueva
+
+    def quitar(self, id):
+        vieja = self._celda_de.pop(id, None)
+        if vieja is not None:
+            puntos = self._celdas[vieja]
+            del puntos[id]
+            if not puntos:
+                del self._celdas[vieja]
+
+    def consultar(self, bbox):
+        """Ids cuyos puntos caen dentro de bbox = (sur, oeste, norte, este)."""
+        sur, oeste, norte, este = bbox
+        i0, j0 = celda(sur, oeste, self.tam)
+        i1, j1 = celda(norte, este, self.tam)
+        resultado = []
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self._celdas):
+            # Viewport más grande que lo ocupado: recorrer solo las celdas con datos
+            candidatas = (p for (i, j), p in self._celdas.items() if i0 <= i <= i1 and j0 <= j <= j1)
+        else:
+            candidatas = filter(None, (
+                self._celdas.get((i, j)) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)
+            ))
+        for puntos in candidatas:
+            resultado.extend(id for id, (lat, lon) in puntos.items() if dentro(bbox, lat, lon))
+        return resultado
+
+    def __len__(self):
+        return len(self._celda_de)
+
+
+def agrupar(puntos, tam):
+    """Agrupa (lat, lon, peso) en celdas de `tam` grados.
+
+    Devuelve una lista de clusters {lat, lon, count} con el centroide ponderado.
+    """
+    acumulado = {}
+    for lat, lon, peso in puntos:
+        clave = celda(lat, lon, tam)
+        suma = acumulado.get(clave)
+        if suma is None:
+            acumulado[clave] = [lat * peso, lon * peso, peso]
+        else:
+            suma[0] += lat * peso
+            suma[1] += lon * peso
+            suma[2] += peso
+    return [
+        {'lat': slat / n, 'lon': slon / n, 'count': n}
+        for slat, slon, n in acumulado.values() if n
+    ]
@@ -0,0 +1,129 @@
+"""Pub/sub en proceso para avisar a los mapas abiertos que hubo cambios.
+
+Cada suscriptor guarda solo el último evento pendiente: si publican varios
+cambios antes de que el cliente lea, se coalescen en uno (el cliente igual pide
+el delta con su cursor). Publicar es O(suscriptores) y nunca bloquea.
+
+`Versiones` usa la misma audiencia de los avisos para saber, sin consultar la
+DB, si lo que ve un usuario cambió desde su último sondeo (ETag de los mapas).
+"""
+import os
+import threading
+import time
+
+
+class Suscripcion:
+    """Un cliente conectado (una pestaña con el mapa abierto)."""
+
+    __slots__ = ('user_id', 've_todo', '_aviso', '_lock', '_pendiente')
+
+    def __init__(self, user_id, ve_todo=False):
+        self.user_id = user_id
+        self.ve_todo = ve_todo  # admin: recibe todos los cambios
+        self._aviso = threading.Event()
+        self._lock = threading.Lock()
+        self._pendiente = None
+
+    def acepta(self, evento):
+        return self.ve_todo or self.user_id in evento['audiencia']
+
+    def entregar(self, evento):
+        with self._lock:
+            self._pendiente = evento
+        self._aviso.set()
+
+    def esperar(self, timeout=None):
+        """Bloquea hasta el próximo evento; None si vence el timeout."""
+        if not self._aviso.wait(timeout):
+            return None
+        with self._lock:
+            self._aviso.clear()
+            evento, self._pendiente = self._pendiente, None
+        return evento
+
+
+class Broker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._suscripciones = set()
+
+    def suscribir(self, user_id, ve_todo=False, maximo=None):
+        """Nueva suscripción; None si ya hay `maximo` abiertas en el proceso."""
+        sub = Suscripcion(user_id, ve_todo)
+        with self._lock:
+            if maximo is not None and len(self._suscripciones) >= maximo:
+                return None
+            self._suscripciones.add(sub)
+        return sub
+
+    def desuscribir(self, sub):
+        with self._lock:
+            self._suscripciones.discard(sub)
+
+    def publicar(self, evento):
+        """Entrega `evento` ({'seq', 'audiencia', ...}) a cada suscriptor interesado."""
+        with self._lock:
+            destinos = list(self._suscripciones)
+        entregados = 0
+        for sub in destinos:
+            if sub.acepta(evento):
+                sub.entregar(evento)
+                entregados += 1
+        return entregados
+
+    def __len__(self):
+        return len(self._suscripciones)
+
+
+class Versiones:
+    """Versión de los datos que ve cada usuario, para responder 304 a los sondeos.
+
+    Cada aviso publicado sube la versión de su audiencia (y la global, la del
+    admin). El ETag lleva además `instancia`, distinta en cada proceso: un ETag
+    emitido por otro worker nunca calza. Si la secuencia de la DB avanzó más
+    allá de lo publicado aquí (escribió otro proceso), `sincronizar` sube la
+    base y con ella todas las versiones.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.instancia = os.urandom(4).hex()
+        self._base = (0, time.time())    # (base, epoch): sube con escrituras de otros procesos
+        self._global = (0, time.time())  # (versión, epoch del cambio)
+        self._por_usuario = {}
+        self.ultimo_seq = 0
+
+    def nueva_instancia(self):
+        """Tras un fork: los workers heredan `instancia` del master y necesitan una propia."""
+        with self._lock:
+            self.instancia = os.urandom(4).hex()
+
+    def tocar(self, user_ids, seq=None):
+        """Registra un cambio visible para `user_ids` (y para el admin)."""
+        with self._lock:
+            version = (self._global[0] + 1, time.time())
+            self._global = version
+            for user_id in user_ids:
+                self._por_usuario[user_id] = version
+            if seq is not None and seq > self.ultimo_seq:
+                self.ultimo_seq = seq
+
+    def sincronizar(self, cursor):
+        """`cursor`: secuencia actual de la DB. Si es mayor que lo visto aquí, todo cambió."""
+        if cursor <= self.ultimo_seq:
+            return
+        with self._lock:
+            if cursor > self.ultimo_seq:
+                self.ultimo_seq = cursor
+                self._base = (self._base[0] + 1, time.time())
+
+    def de(self, user_id, ve_todo=False):
+        """(etag, epoch del último cambio) de lo que ve `user_id`."""
+        with self._lock:
+            base, desde = self._base
+            version, cuando = self._global if ve_todo else self._por_usuario.get(user_id, (0, 0.0))
+        return f'{self.instancia}.{base}.{user_id}.{version}', max(cuando, desde)
+
+
+broker = Broker()
+versiones = Versiones()
@@ -0,0 +1,42 @@
+"""Configuración de gunicorn: `gunicorn -c gunicorn.conf.py wsgi:app` (antes: `flask --app main init-db`).
+
+- BIND: dirección (por defecto 0.0.0.0:8000).
+- WEB_CONCURRENCY: workers (por defecto, uno por núcleo).
+- WEB_THREADS: hilos por worker (8).
+- MAPA_STREAM_MAX: /mapa_stream abiertos a la vez por worker (la mitad de los
+  hilos). Cada stream ocupa un hilo mientras dura (MAPA_STREAM_DURACION_S,
+  300 s, y el navegador se reconecta); los demás hilos quedan para el resto de
+  los requests. Pasado el cupo el stream responde 503 y ese mapa sondea cada
+  15 s, lo que con ETag es un 304 de ~2 ms. Para más mapas en vivo por worker,
+  subir WEB_THREADS y MAPA_STREAM_MAX juntos (p. ej. 64 y 48): un hilo
+  esperando en un stream no usa CPU.
+
+preload_app: la app se importa y precarga una vez en el master (crear_app) y
+los workers la heredan. post_fork rehace por worker lo que no se comparte:
+conexiones a la DB, id de instancia de los ETag, hilos de la cola de trabajos
+y el seguimiento de posiciones de los otros workers.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 8))
+# Se lee al importar main (preload_app, después de este archivo)
+os.environ.setdefault('MAPA_STREAM_MAX', str(max(1, threads // 2)))
+preload_app = True
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+
+def post_fork(server, worker):
+    from main import iniciar_worker
+    iniciar_worker(varios_procesos=server.cfg.workers > 1)
+
+
+def worker_exit(server, worker):
+    # Deja terminar los trabajos en curso; si no alcanza, vuelven a la cola por falta de latido
+    from trabajos import cola
+    cola.detener(timeout=server.cfg.graceful_timeout)
@@ -0,0 +1,96 @@
+"""Caché en proceso de la identidad del usuario logueado.
+
+Flask-Login llama al user_loader en cada request autenticado (también en cada
+sondeo de los mapas). En vez de cargar el `User` del ORM y luego buscar su
+camión, se guarda por usuario una `Identidad` con lo que usan los handlers:
+id, username, rol y el camión del chofer. Se carga con una consulta y queda en
+un LRU con vencimiento (TTL).
+
+`main.py` invalida la entrada de un usuario al hacer commit de cambios en él o
+en un camión del que es (o era) chofer. Con varios procesos cada uno tiene su
+caché: un cambio hecho en otro proceso se ve a más tardar al vencer el TTL.
+
+- USER_CACHE_TTL: segundos (por defecto 30; 0 desactiva la caché).
+- USER_CACHE_MAX: usuarios en memoria (por defecto 10000).
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask_login import UserMixin
+
+Camion = namedtuple('Camion', 'id plate')
+
+
+class Identidad(UserMixin):
+    """Lo que los handlers necesitan del usuario; no es un objeto del ORM."""
+
+    def __init__(self, id, username, role, truck_id=None, plate=None):
+        self.id = id
+        self.username = username
+        self.role = role
+        self.truck_id = truck_id  # camión del chofer (None si no tiene)
+        self.plate = plate
+
+    @property
+    def camion(self):
+        return Camion(self.truck_id, self.plate) if self.truck_id is not None else None
+
+    def __repr__(self):
+        return f'<Identidad {self.id} {self.username} {self.role} truck={self.truck_id}>'
+
+
+class CacheIdentidades:
+    def __init__(self, maximo=10000, ttl=30.0):
+        self.maximo = maximo
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._datos = OrderedDict()  # user_id -> (vence, Identidad)
+        self._generacion = 0  # sube con cada invalidación
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, user_id, cargar):
+        """Identidad de `user_id`; si no está o venció, `cargar(user_id)` (None = no existe)."""
+        if self.ttl <= 0:
+            return cargar(user_id)
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._datos.get(user_id)
+            if entrada is not None and entrada[0] > ahora:
+                self._datos.move_to_end(user_id)
+                self.aciertos += 1
+                return entrada[1]
+            self.fallos += 1
+            generacion = self._generacion
+        # La carga va fuera del lock para no serializar los requests en la DB
+        identidad = cargar(user_id)
+        with self._lock:
+            # Si hubo una invalidación mientras se cargaba, lo leído puede ser viejo: no se guarda
+            if identidad is not None and generacion == self._generacion:
+                self._datos[user_id] = (ahora + self.ttl, identidad)
+                self._datos.move_to_end(user_id)
+                while len(self._datos) > self.maximo:
+                    self._datos.popitem(last=False)
+        return identidad
+
+    def invalidar(self, user_ids):
+        with self._lock:
+            self._generacion += 1
+            for user_id in user_ids:
+                self._datos.pop(user_id, None)
+
+    def limpiar(self):
+        with self._lock:
+            self._generacion += 1
+            self._datos.clear()
+
+    def __len__(self):
+        return len(self._datos)
+
+
+identidades = CacheIdentidades(
+    maximo=int(os.environ.get('USER_CACHE_MAX', 10000)),
+    ttl=float(os.environ.get('USER_CACHE_TTL', 30)),
+)
@@ -0,0 +1,304 @@
+"""Instrumentación opcional por request: SQL, plantillas, JSON y perfilado por muestreo.
+
+Se activa con INSTRUMENTACION=1 (ver `init_app`); apagada no registra ningún
+hook, así que no cuesta nada. Por cada request mide:
+
+- cantidad de sentencias SQL y tiempo total en la DB (eventos del engine),
+- tiempo de render de plantillas (señales de Flask) y de serialización JSON,
+- las sentencias más lentas, agregadas por endpoint.
+
+Lo expone como header `Server-Timing` (visible en las DevTools del navegador) y
+en `/metrics` con formato de texto de Prometheus. El acceso a `/metrics` pide
+el token de METRICS_TOKEN (`Authorization: Bearer ...`) o un admin logueado.
+
+Perfilado: `?_profile=1` (solo quien puede ver métricas) devuelve, en lugar de
+la respuesta, el reporte del muestreador para ese request. Con
+PROFILE_SAMPLE_RATE=0.01 se perfila además el 1% de los requests y el reporte
+(stacks colapsados, aptos para flamegraph.pl/speedscope) se guarda en PROFILE_DIR.
+"""
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import Response, g, has_request_context, request, template_rendered, before_render_template
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LENTAS_POR_ENDPOINT = 5
+
+
+def _activo():
+    return has_request_context() and 'inst_inicio' in g
+
+
+# ========================
+# MUESTREADOR
+# ========================
+class Muestreador(threading.Thread):
+    """Perfilador por muestreo de un solo hilo: cada `intervalo` segundos anota su stack.
+
+    A diferencia de cProfile no instrumenta cada llamada, así que el request
+    perfilado corre casi a la misma velocidad que sin perfilar.
+    """
+
+    def __init__(self, hilo_id, intervalo=0.002):
+        super().__init__(daemon=True)
+        self.hilo_id = hilo_id
+        self.intervalo = intervalo
+        self.stacks = Counter()
+        self._fin = threading.Event()
+
+    def run(self):
+        while not self._fin.wait(self.intervalo):
+            frame = sys._current_frames().get(self.hilo_id)
+            pila = []
+            while frame is not None:
+                code = frame.f_code
+                pila.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            if pila:
+                self.stacks[tuple(reversed(pila))] += 1
+
+    def detener(self):
+        self._fin.set()
+        self.join()
+        return self.stacks
+
+    @staticmethod
+    def colapsado(stacks):
+        """Formato "a;b;c N" de flamegraph.pl / speedscope."""
+        return '\n'.join(f"{';'.join(pila)} {n}" for pila, n in stacks.most_common())
+
+    @staticmethod
+    def reporte(stacks, intervalo, titulo, top=25):
+        total = sum(stacks.values())
+        propio, incluido = Counter(), Counter()
+        for pila, n in stacks.items():
+            propio[pila[-1]] += n
+            for marco in set(pila):
+                incluido[marco] += n
+        lineas = [titulo, f"{total} muestras cada {intervalo * 1000:.1f} ms", '',
+                  f"{'propio':>7} {'incl.':>7}  función (archivo:función:línea)"]
+        for marco, n in incluido.most_common(top):
+            lineas.append(f"{100.0 * propio[marco] / total:>6.1f}% {100.0 * n / total:>6.1f}%  {marco}")
+        lineas += ['', '# stacks colapsados', Muestreador.colapsado(stacks)]
+        return '\n'.join(lineas) + '\n'
+
+
+# ========================
+# AGREGADOS
+# ========================
+class Metricas:
+    """Acumuladores por endpoint, compartidos por todos los hilos."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter()                    # (endpoint, método, status) -> n
+        self.histograma = defaultdict(lambda: [0] * (len(BUCKETS) + 1))  # endpoint -> cuentas por bucket
+        self.duracion = Counter()                    # endpoint -> segundos
+        self.sql = Counter()                         # endpoint -> sentencias
+        self.db = Counter()                          # endpoint -> segundos en la DB
+        self.plantillas = Counter()
+        self.json = Counter()
+        self.lentas = defaultdict(dict)              # endpoint -> {sentencia: segundos máx}
+
+    def registrar(self, endpoint, metodo, status, duracion, estado):
+        with self._lock:
+            self.requests[endpoint, metodo, status] += 1
+            cuentas = self.histograma[endpoint]
+            for i, limite in enumerate(BUCKETS):
+                if duracion <= limite:
+                    cuentas[i] += 1
+                    break
+            else:
+                cuentas[-1] += 1
+            self.duracion[endpoint] += duracion
+            self.sql[endpoint] += estado['sql']
+            self.db[endpoint] += estado['db']
+            self.plantillas[endpoint] += estado['plantillas']
+            self.json[endpoint] += estado['json']
+            lentas = self.lentas[endpoint]
+            for segundos, sentencia in estado['lentas']:
+                if segundos > lentas.get(sentencia, 0.0):
+                    lentas[sentencia] = segundos
+            if len(lentas) > LENTAS_POR_ENDPOINT:
+                for sentencia, _ in sorted(lentas.items(), key=lambda kv: kv[1])[:-LENTAS_POR_ENDPOINT]:
+                    del lentas[sentencia]
+
+    def prometheus(self):
+        """Texto de exposición de Prometheus (version 0.0.4)."""
+        with self._lock:
+            out = [
+                '# HELP logitrack_http_requests_total Requests atendidos.',
+                '# TYPE logitrack_http_requests_total counter',
+            ]
+            for (endpoint, metodo, status), n in sorted(self.requests.items()):
+                out.append(f'logitrack_http_requests_total{{endpoint="{_esc(endpoint)}",method="{metodo}",'
+                           f'status="{status}"}} {n}')
+            out += ['# HELP logitrack_http_request_duration_seconds Duración de los requests.',
+                    '# TYPE logitrack_http_request_duration_seconds histogram']
+            for endpoint, cuentas in sorted(self.histograma.items()):
+                etiqueta = _esc(endpoint)
+                acumulado = 0
+                for limite, n in zip(BUCKETS + ('+Inf',), cuentas):
+                    acumulado += n
+                    out.append(f'logitrack_http_request_duration_seconds_bucket{{endpoint="{etiqueta}",'
+                               f'le="{limite}"}} {acumulado}')
+                out.append(f'logitrack_http_request_duration_seconds_sum{{endpoint="{etiqueta}"}} '
+                           f'{self.duracion[endpoint]:.6f}')
+                out.append(f'logitrack_http_request_duration_seconds_count{{endpoint="{etiqueta}"}} {acumulado}')
+            for nombre, ayuda, datos in (
+                ('logitrack_db_statements_total', 'Sentencias SQL ejecutadas.', self.sql),
+                ('logitrack_db_seconds_total', 'Tiempo en la base de datos.', self.db),
+                ('logitrack_template_seconds_total', 'Tiempo renderizando plantillas.', self.plantillas),
+                ('logitrack_json_seconds_total', 'Tiempo serializando JSON.', self.json),
+            ):
+                out += [f'# HELP {nombre} {ayuda}', f'# TYPE {nombre} counter']
+                for endpoint, valor in sorted(datos.items()):
+                    out.append(f'{nombre}{{endpoint="{_esc(endpoint)}"}} {valor:.6g}')
+            out += ['# HELP logitrack_db_slowest_statement_seconds Sentencias más lentas vistas por endpoint.',
+                    '# TYPE logitrack_db_slowest_statement_seconds gauge']
+            for endpoint, lentas in sorted(self.lentas.items()):
+                for sentencia, segundos in sorted(lentas.items(), key=lambda kv: -kv[1]):
+                    out.append(f'logitrack_db_slowest_statement_seconds{{endpoint="{_esc(endpoint)}",'
+                               f'statement="{_esc(sentencia)}"}} {segundos:.6f}')
+        return '\n'.join(out) + '\n'
+
+
+def _esc(valor):
+    return valor.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _normalizar(sentencia):
+    return ' '.join(sentencia.split())[:300]
+
+
+metricas = Metricas()
+
+
+# ========================
+# HOOKS
+# ========================
+class ProveedorJSONMedido(DefaultJSONProvider):
+    """`jsonify` que suma su tiempo de serialización al request en curso."""
+
+    def dumps(self, obj, **kwargs):
+        if not _activo():
+            return super().dumps(obj, **kwargs)
+        t0 = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            g.inst_estado['json'] += time.perf_counter() - t0
+
+
+def _antes_sql(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('inst_t0', []).append(time.perf_counter())
+
+
+def _despues_sql(conn, cursor, statement, parameters, context, executemany):
+    pila = conn.info.get('inst_t0')
+    if not pila:
+        return
+    segundos = time.perf_counter() - pila.pop()
+    if not _activo():
+        return
+    estado = g.inst_estado
+    estado['sql'] += 1
+    estado['db'] += segundos
+    lentas = estado['lentas']
+    if len(lentas) < LENTAS_POR_ENDPOINT or segundos > lentas[0][0]:
+        lentas.append((segundos, _normalizar(statement)))
+        lentas.sort()
+        del lentas[:-LENTAS_POR_ENDPOINT]
+
+
+def _antes_plantilla(sender, template, context, **extra):
+    if _activo():
+        g.inst_plantilla_t0 = time.perf_counter()
+
+
+def _plantilla_lista(sender, template, context, **extra):
+    t0 = g.pop('inst_plantilla_t0', None) if _activo() else None
+    if t0 is not None:
+        g.inst_estado['plantillas'] += time.perf_counter() - t0
+
+
+def _token_valido():
+    token = os.environ.get('METRICS_TOKEN')
+    return bool(token) and request.headers.get('Authorization') == f'Bearer {token}'
+
+
+def init_app(app, engine, puede_ver=lambda: False):
+    """Registra los hooks si INSTRUMENTACION=1. `puede_ver()` autoriza /metrics y ?_profile=1."""
+    if os.environ.get('INSTRUMENTACION') != '1':
+        return False
+
+    tasa = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    carpeta = os.environ.get('PROFILE_DIR') or os.path.join(tempfile.gettempdir(), 'logitrack-perfiles')
+    intervalo = float(os.environ.get('PROFILE_INTERVAL_MS', 2)) / 1000.0
+
+    app.json = ProveedorJSONMedido(app)
+    event.listen(engine, 'before_cursor_execute', _antes_sql)
+    event.listen(engine, 'after_cursor_execute', _despues_sql)
+    before_render_template.connect(_antes_plantilla, app)
+    template_rendered.connect(_plantilla_lista, app)
+
+    @app.before_request
+    def _inst_inicio():
+        g.inst_inicio = time.perf_counter()
+        g.inst_estado = {'sql': 0, 'db': 0.0, 'plantillas': 0.0, 'json': 0.0, 'lentas': []}
+        pedido = request.args.get('_profile') == '1'
+        if pedido or (tasa and random.random() < tasa):
+            g.inst_perfil = (Muestreador(threading.get_ident(), intervalo), pedido)
+            g.inst_perfil[0].start()
+
+    @app.after_request
+    def _inst_fin(response):
+        if 'inst_inicio' not in g:
+            return response
+        duracion = time.perf_counter() - g.inst_inicio
+        estado = g.inst_estado
+        endpoint = request.url_rule.rule if request.url_rule else 'sin_ruta'
+        metricas.registrar(endpoint, request.method, response.status_code, duracion, estado)
+        response.headers['Server-Timing'] = ', '.join([
+            f'db;dur={estado["db"] * 1000:.2f};desc="{estado["sql"]} sql"',
+            f'tpl;dur={estado["plantillas"] * 1000:.2f}',
+            f'json;dur={estado["json"] * 1000:.2f}',
+            f'total;dur={duracion * 1000:.2f}',
+        ])
+
+        perfil = g.pop('inst_perfil', None)
+        if perfil is None:
+            return response
+        muestreador, pedido = perfil
+        stacks = muestreador.detener()
+        titulo = f"{request.method} {request.full_path} -> {response.status_code} en {duracion * 1000:.1f} ms"
+        if pedido and (puede_ver() or _token_valido()):
+            return Response(Muestreador.reporte(stacks, intervalo, titulo), mimetype='text/plain')
+        if not pedido:
+            os.makedirs(carpeta, exist_ok=True)
+            nombre = f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint.strip('/').replace('/', '_') or 'raiz'}.txt"
+            with open(os.path.join(carpeta, nombre), 'a', encoding='utf-8') as f:
+                f.write(Muestreador.colapsado(stacks) + '\n')
+        return response
+
+    @app.teardown_request
+    def _inst_limpiar(exc):
+        # Si el request falló antes de after_request, no dejar el hilo muestreando
+        perfil = g.pop('inst_perfil', None)
+        if perfil is not None:
+            perfil[0].detener()
+
+    def ver_metricas():
+        if not (_token_valido() or puede_ver()):
+            return "No autorizado", 403
+        return Response(metricas.prometheus(), mimetype='text/plain; version=0.0.4')
+
+    app.add_url_rule('/metrics', 'metrics', ver_metricas)
+    return True
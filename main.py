@@ -1,4 +1,5 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify, flash
+import click
+from flask import Flask, Response, render_template, request, redirect, url_for, jsonify, flash, send_file
 import random
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import (
@@ -6,24 +7,67 @@ from flask_login import (
     logout_user, current_user
 )
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
 
 from collections import Counter
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
+import csv
+import io
+import json
 import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+
+import numpy as np
 from flask_wtf import CSRFProtect
 from flask_wtf.csrf import generate_csrf
 
+import analitica
+import config
+import despacho
+import instrumentacion
+import retencion
+import trazos
+from ciudades import indice as indice_ciudades
+from eventos import broker, versiones
+from espacial import agrupar, dentro
+from identidad import Identidad, identidades
+from posiciones import posiciones
+from trabajos import ESTADOS_ACTIVOS, cola
+
 
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-change-me')
 
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = config.database_uri()
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = config.engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 db = SQLAlchemy(app)
 
+
+SQLITE_PRAGMAS = config.sqlite_pragmas()
+
+
+@event.listens_for(Engine, 'connect')
+def _configurar_sqlite(dbapi_connection, connection_record):
+    """Aplica el perfil (config.py): WAL permite leer mientras se escribe telemetría."""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for nombre, valor in SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {nombre}={valor}')
+    cursor.close()
+
 csrf = CSRFProtect()
 csrf.init_app(app)
 
@@ -38,16 +82,17 @@ login_manager.login_view = "login"  # si alguien no logueado entra a ruta proteg
 class User( UserMixin,db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(50), unique=True, nullable=False)
-    role = db.Column(db.String(20), nullable=False)  # chofer, despachador, admin.
+    role = db.Column(db.String(20), nullable=False, index=True)  # chofer, despachador, admin.
     password = db.Column(db.String(200), nullable=False)  # contraseña hasheada
 
 class Truck(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     plate = db.Column(db.String(20), unique=True, nullable=False)
-    status = db.Column(db.String(20), nullable=False, default="disponible")
+    status = db.Column(db.String(20), nullable=False, default="disponible", index=True)
     cargo = db.Column(db.String(50), nullable=True)
-    driver_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    dispatcher_id = db.Column(db.Integer, db.ForeignKey("user.id"))  #qué despachador lo controla
+    driver_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    dispatcher_id = db.Column(db.Integer, db.ForeignKey("user.id"), index=True)  #qué despachador lo controla
+    change_seq = db.Column(db.Integer, nullable=False, default=0, index=True)  # último cambio (ver SyncCounter)
 
     
     driver = db.relationship('User', foreign_keys=[driver_id], backref='driven_truck')
@@ -58,28 +103,1014 @@ class Route(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     origin = db.Column(db.String(100), nullable=False)
     destination = db.Column(db.String(100), nullable=False)
+    origin_city_id = db.Column(db.Integer, db.ForeignKey('city.id'), nullable=True, index=True)  # se resuelve al asignar origin
+    destination_city_id = db.Column(db.Integer, db.ForeignKey('city.id'), nullable=True, index=True)
     status = db.Column(db.String(20), nullable=False, default="pendiente")
-    truck_id = db.Column(db.Integer, db.ForeignKey('truck.id'))
+    truck_id = db.Column(db.Integer, db.ForeignKey('truck.id'), index=True)
     start_time = db.Column(db.DateTime, nullable=True)
-    
+    completed_at = db.Column(db.DateTime, nullable=True)  # se fija al llegar a destino (ver _con_cierre)
+    change_seq = db.Column(db.Integer, nullable=False, default=0, index=True)  # último cambio (ver SyncCounter)
+
     truck = db.relationship('Truck', backref='routes')
 
+    # status primero: sirve para filtrar por estado, para "pendientes sin camión" y,
+    # con la ciudad de origen, para el feed de pendientes cercanas del despachador
+    __table_args__ = (
+        db.Index('ix_route_pendientes_origen', 'status', 'truck_id', 'origin_city_id', 'id'),
+        db.Index('ix_route_status_id', 'status', 'id'),  # listado admin filtrado por estado
+    )
+
+class City(db.Model):
+    """Ciudades conocidas por los mapas; espejo de data/ciudades_cl.csv (mismos ids)."""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    region = db.Column(db.String(100))
+    lat = db.Column(db.Float, nullable=False)
+    lon = db.Column(db.Float, nullable=False)
+
 class Tracking(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     route_id = db.Column(db.Integer, db.ForeignKey('route.id'))
-    location = db.Column(db.String(200))
+    location = db.Column(db.String(200))  # texto libre (legado); la posición va en lat/lon
     timestamp = db.Column(db.DateTime)
+    lat = db.Column(db.Float)
+    lon = db.Column(db.Float)
+
+    __table_args__ = (
+        db.Index('ix_tracking_route_ts', 'route_id', 'timestamp'),
+        db.Index('ix_tracking_ts', 'timestamp'),  # la compactación y el export recorren por día
+    )
+
+class TrackingArchive(db.Model):
+    """Un día de Tracking ya compactado y archivado (ver retencion.py)."""
+    day = db.Column(db.Date, primary_key=True)
+    bucket_s = db.Column(db.Integer, nullable=False)  # ancho de balde aplicado
+    raw_pings = db.Column(db.Integer, nullable=False, default=0)  # pings crudos en los segmentos
+    kept_pings = db.Column(db.Integer, nullable=False, default=0)  # pings que quedan en Tracking
+    last_id = db.Column(db.Integer, nullable=False, default=0)  # mayor Tracking.id ya archivado
+    compacted_at = db.Column(db.DateTime)
+
+class SyncCounter(db.Model):
+    """Contadores por nombre: 'cambios' (cada flush que toca Route/Truck lo incrementa) y
+    'retencion' (Tracking.id hasta el que la compactación buscó pings tardíos)."""
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class Stat(db.Model):
+    """Contadores de KPIs mantenidos en cada flush (ver _actualizar_stats).
+
+    Claves: trucks, routes, users:<role>, truck_status:<status>, route_status:<status>.
+    """
+    key = db.Column(db.String(80), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class Tombstone(db.Model):
+    """Registro de salidas para que los clientes del modo delta quiten marcadores.
+
+    Sin user_id: la entidad se borró (lo lee el mapa admin). Con user_id: la ruta
+    salió de lo que ve ese chofer o despachador (se borró, cambió de camión o su
+    camión cambió de chofer o de despachador).
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)  # route, truck
+    entity_id = db.Column(db.Integer, nullable=False)
+    change_seq = db.Column(db.Integer, nullable=False, index=True)
+    user_id = db.Column(db.Integer, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_tombstone_user_seq', 'user_id', 'change_seq'),
+    )
+
+class LaneStat(db.Model):
+    """Agregados de duración de las rutas completadas por carril (ver analitica.py)."""
+    origin_city_id = db.Column(db.Integer, primary_key=True)
+    destination_city_id = db.Column(db.Integer, primary_key=True)
+    n = db.Column(db.Integer, nullable=False, default=0)
+    mean = db.Column(db.Float, nullable=False, default=0.0)  # segundos
+    m2 = db.Column(db.Float, nullable=False, default=0.0)  # suma de cuadrados de las desviaciones
+    min_s = db.Column(db.Float)
+    max_s = db.Column(db.Float)
+    on_time = db.Column(db.Integer, nullable=False, default=0)
+    hist = db.Column(db.Text, nullable=False, default='[]')  # conteos por bin (JSON)
+
+class Job(db.Model):
+    """Trabajo en segundo plano; la tabla es la cola (ver trabajos.py)."""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(40), nullable=False)  # tarea registrada con @cola.tarea
+    status = db.Column(db.String(20), nullable=False, default='pendiente')  # pendiente, en_curso, completado, fallido, cancelado
+    params = db.Column(db.Text, nullable=False, default='{}')  # JSON
+    result = db.Column(db.Text)  # JSON
+    error = db.Column(db.Text)
+    progress = db.Column(db.Float, nullable=False, default=0.0)  # 0..1
+    message = db.Column(db.String(200))
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    worker = db.Column(db.String(80))  # host:pid que lo corre
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_job_status_id', 'status', 'id'),  # el pendiente más antiguo
+        db.Index('ix_job_user_id', 'user_id', 'id'),  # "mis trabajos"
+    )
+
+
+# ======== ESQUEMA ========
+
+def crear_indices():
+    """Crea los índices del modelo que falten en una DB existente (create_all no lo hace)."""
+    creados = []
+    with db.engine.begin() as conn:
+        existentes = set()
+        inspector = inspect(conn)
+        for tabla in db.metadata.sorted_tables:
+            if not inspector.has_table(tabla.name):
+                continue
+            existentes |= {idx['name'] for idx in inspector.get_indexes(tabla.name)}
+            for indice in tabla.indexes:
+                if indice.name not in existentes:
+                    indice.create(conn)
+                    creados.append(indice.name)
+    return creados
+
+
+def agregar_columnas():
+    """Agrega a una DB existente las columnas opcionales (nullable) del modelo que falten."""
+    agregadas = []
+    with db.engine.begin() as conn:
+        inspector = inspect(conn)
+        preparador = conn.dialect.identifier_preparer
+        for tabla in db.metadata.sorted_tables:
+            if not inspector.has_table(tabla.name):
+                continue
+            existentes = {c['name'] for c in inspector.get_columns(tabla.name)}
+            for columna in tabla.columns:
+                if columna.name in existentes or not columna.nullable:
+                    continue
+                conn.execute(text(f'ALTER TABLE {preparador.quote(tabla.name)} ADD COLUMN '
+                                  f'{preparador.quote(columna.name)} {columna.type.compile(conn.dialect)}'))
+                agregadas.append(f'{tabla.name}.{columna.name}')
+    return agregadas
+
+
+# ======== CIUDADES ========
+
+@event.listens_for(Route.origin, 'set')
+def _resolver_origen(target, value, oldvalue, initiator):
+    target.origin_city_id = indice_ciudades.resolver(value)
+
+
+@event.listens_for(Route.destination, 'set')
+def _resolver_destino(target, value, oldvalue, initiator):
+    target.destination_city_id = indice_ciudades.resolver(value)
+
+
+def sincronizar_ciudades():
+    """Inserta en la tabla `city` las ciudades del dataset que falten (idempotente)."""
+    existentes = {city_id for (city_id,) in db.session.query(City.id)}
+    nuevas = [
+        {'id': c.id, 'name': c.nombre, 'region': c.region, 'lat': c.lat, 'lon': c.lon}
+        for c in indice_ciudades if c.id not in existentes
+    ]
+    if nuevas:
+        db.session.execute(db.insert(City), nuevas)
+        db.session.commit()
+    return len(nuevas)
+
+
+# ======== POSICIONES EN VIVO ========
+
+def _epoch(ts):
+    """datetime naive en UTC (como se guarda en la DB) -> segundos epoch."""
+    return ts.replace(tzinfo=timezone.utc).timestamp()
+
+
+def calentar_posiciones():
+    """Carga en memoria el último ping de cada ruta (recorre el índice (route_id, timestamp))."""
+    # Antes de leer: lo que llegue mientras tanto lo trae seguir_posiciones
+    hasta_id = db.session.query(db.func.max(Tracking.id)).scalar() or 0
+    ultimo = (
+        db.session.query(Tracking.route_id, db.func.max(Tracking.timestamp).label('ts'))
+        .filter(Tracking.lat.isnot(None))
+        .group_by(Tracking.route_id)
+        .subquery()
+    )
+    filas = (
+        db.session.query(Tracking.route_id, Route.truck_id, Tracking.lat, Tracking.lon, Tracking.timestamp)
+        .join(ultimo, (Tracking.route_id == ultimo.c.route_id) & (Tracking.timestamp == ultimo.c.ts))
+        .join(Route, Route.id == Tracking.route_id)
+        .filter(Tracking.lat.isnot(None))
+    )
+    posiciones.actualizar_lote(
+        (route_id, truck_id, lat, lon, _epoch(ts)) for route_id, truck_id, lat, lon, ts in filas
+    )
+    posiciones.ultimo_tracking_id = max(posiciones.ultimo_tracking_id, hasta_id)
+    posiciones.calentado = True
+    return len(posiciones)
+
+
+def posiciones_en_vivo():
+    """El store de posiciones, precargado la primera vez si el arranque no lo hizo."""
+    if not posiciones.calentado:
+        calentar_posiciones()
+    return posiciones
+
+
+# Con varios workers cada proceso tiene su store y solo ve los pings que él
+# recibió; un hilo por worker trae los de los demás por id creciente (en
+# SQLite los ids se hacen visibles en orden: las escrituras van en serie).
+POSICIONES_SEGUIMIENTO_S = float(os.environ.get('POSICIONES_SEGUIMIENTO_S', 1))
+MAX_PINGS_SEGUIMIENTO = 50000
+
+
+def seguir_posiciones():
+    """Aplica al store los pings guardados desde el último visto; devuelve cuántos movieron algo.
+
+    Sube la versión de los choferes y despachadores afectados (ETag de los mapas).
+    """
+    filas = db.session.execute(
+        db.select(Tracking.id, Tracking.route_id, Route.truck_id, Tracking.lat, Tracking.lon,
+                  Tracking.timestamp, Truck.driver_id, Truck.dispatcher_id)
+        .join(Route, Route.id == Tracking.route_id)
+        .outerjoin(Truck, Truck.id == Route.truck_id)
+        .where(Tracking.id > posiciones.ultimo_tracking_id)
+        .order_by(Tracking.id).limit(MAX_PINGS_SEGUIMIENTO)
+    ).all()
+    db.session.rollback()  # no dejar abierta la lectura
+    if not filas:
+        return 0
+    nuevos, audiencia = [], set()
+    for _, route_id, truck_id, lat, lon, ts, driver_id, dispatcher_id in filas:
+        if lat is None:
+            continue
+        ts = _epoch(ts)
+        previo = posiciones.de_ruta(route_id)
+        if previo is not None and previo[2] >= ts:
+            continue  # ya estaba (lo recibió este mismo proceso)
+        nuevos.append((route_id, truck_id, lat, lon, ts))
+        audiencia |= {driver_id, dispatcher_id}
+    posiciones.ultimo_tracking_id = filas[-1][0]
+    if nuevos:
+        posiciones.actualizar_lote(nuevos)
+        versiones.tocar(audiencia - {None})
+    return len(nuevos)
+
+
+def posiciones_al_dia():
+    """El store con todos los pings ya guardados, incluidos los de otros workers.
+
+    Los mapas lo piden después de leer su cursor: un lote de pings marca sus
+    rutas con la secuencia en la misma transacción en que se guarda, así que
+    todo lo que cubre el cursor ya está en el store al armar los marcadores.
+    """
+    vivo = posiciones_en_vivo()
+    seguir_posiciones()
+    return vivo
+
+
+def _seguir_posiciones_en_segundo_plano(intervalo):
+    def bucle():
+        while True:
+            time.sleep(intervalo)
+            try:
+                with app.app_context():
+                    seguir_posiciones()
+            except OperationalError:
+                pass  # DB ocupada: el próximo ciclo trae lo mismo y más
+            except Exception:
+                # Cualquier otro error no debe matar el hilo: se registra y se sigue
+                app.logger.exception('Error siguiendo posiciones en vivo')
+
+    threading.Thread(target=bucle, name='posiciones-seguimiento', daemon=True).start()
+
+
+# ======== CONTADORES DE KPIs ========
+
+def _cargar_valor_previo(target, value, oldvalue, initiator):
+    return value
+
+
+# Los hooks de flush leen el valor anterior de estas columnas (contadores y
+# audiencia de los avisos): que se cargue aunque el objeto esté expirado.
+for _attr in (Truck.status, Truck.driver_id, Truck.dispatcher_id,
+              Route.status, Route.truck_id, User.role):
+    event.listen(_attr, 'set', _cargar_valor_previo, active_history=True, retval=True)
+
+def _valor_actual(obj, attr):
+    """Valor de la columna, aplicando el default si el objeto aún no se insertó."""
+    valor = getattr(obj, attr)
+    if valor is None:
+        default = obj.__table__.c[attr].default
+        valor = default.arg if default is not None else None
+    return valor
+
+
+def _claves_stats(obj, anterior=False):
+    """Claves de Stat a las que suma `obj` (con sus valores previos si `anterior`)."""
+    def valor(attr):
+        if anterior:
+            historia = inspect(obj).attrs[attr].history
+            if historia.deleted:
+                return historia.deleted[0]
+            if historia.added:
+                return None  # valor nuevo sin anterior conocido
+        return _valor_actual(obj, attr)
+
+    if isinstance(obj, Truck):
+        return ['trucks', f'truck_status:{valor("status")}']
+    if isinstance(obj, Route):
+        return ['routes', f'route_status:{valor("status")}']
+    if isinstance(obj, User):
+        return [f'users:{valor("role")}']
+    return []
+
+
+def aplicar_deltas_stats(conn, deltas):
+    """Suma `deltas` ({clave: n}) a la tabla Stat dentro de la transacción de `conn`."""
+    tabla = Stat.__table__
+    for clave, n in deltas.items():
+        if not n:
+            continue
+        actualizado = conn.execute(
+            tabla.update().where(tabla.c.key == clave).values(value=tabla.c.value + n)
+        )
+        if actualizado.rowcount == 0:
+            conn.execute(tabla.insert().values(key=clave, value=n))
+
+
+@event.listens_for(Session, 'before_flush')
+def _actualizar_stats(session, flush_context, instances):
+    deltas = Counter()
+    for obj in session.new:
+        deltas.update(_claves_stats(obj))
+    for obj in session.deleted:
+        deltas.subtract(_claves_stats(obj, anterior=True))
+    for obj in session.dirty:
+        if not isinstance(obj, (Truck, Route, User)) or not session.is_modified(obj):
+            continue
+        antes, despues = _claves_stats(obj, anterior=True), _claves_stats(obj)
+        if antes != despues:
+            deltas.subtract(antes)
+            deltas.update(despues)
+    if any(deltas.values()):
+        aplicar_deltas_stats(session.connection(), deltas)
+
+
+def contar_stats():
+    """Contadores calculados desde las tablas base (la fuente de verdad)."""
+    conteos = {
+        'trucks': Truck.query.count(),
+        'routes': Route.query.count(),
+    }
+    for role, n in db.session.query(User.role, db.func.count(User.id)).group_by(User.role):
+        conteos[f'users:{role}'] = n
+    for status, n in db.session.query(Truck.status, db.func.count(Truck.id)).group_by(Truck.status):
+        conteos[f'truck_status:{status}'] = n
+    for status, n in db.session.query(Route.status, db.func.count(Route.id)).group_by(Route.status):
+        conteos[f'route_status:{status}'] = n
+    return conteos
+
+
+def verificar_stats():
+    """Diferencias {clave: (guardado, real)} entre Stat y las tablas base."""
+    guardados = {k: v for k, v in db.session.query(Stat.key, Stat.value) if v}
+    reales = contar_stats()
+    return {
+        clave: (guardados.get(clave, 0), reales.get(clave, 0))
+        for clave in guardados.keys() | reales.keys()
+        if guardados.get(clave, 0) != reales.get(clave, 0)
+    }
+
+
+def reconstruir_stats():
+    """Reemplaza la tabla Stat con los conteos de las tablas base."""
+    conteos = contar_stats()
+    db.session.query(Stat).delete()
+    db.session.execute(db.insert(Stat), [{'key': k, 'value': v} for k, v in conteos.items()])
+    db.session.commit()
+    return conteos
+
+
+def leer_stats():
+    """Todos los contadores en una lectura; se reconstruyen si la tabla está vacía."""
+    stats = dict(db.session.query(Stat.key, Stat.value))
+    if not stats:
+        stats = reconstruir_stats()
+    return stats
+
+
+@app.cli.command('stats')
+@click.argument('accion', type=click.Choice(['check', 'rebuild']))
+def stats_command(accion):
+    """Verifica (check) o reconstruye (rebuild) los contadores de KPIs."""
+    if accion == 'rebuild':
+        conteos = reconstruir_stats()
+        click.echo(f'{len(conteos)} contadores reconstruidos')
+        return
+    diferencias = verificar_stats()
+    for clave, (guardado, real) in sorted(diferencias.items()):
+        click.echo(f'{clave}: guardado={guardado} real={real}')
+    if diferencias:
+        raise SystemExit(1)
+    click.echo('OK: contadores consistentes')
+
+
+# ======== SECUENCIA DE CAMBIOS (modo delta de los mapas) ========
+
+def siguiente_seq(session):
+    """Incrementa el contador global dentro de la transacción actual y devuelve el nuevo valor.
+
+    El UPDATE toma el lock de escritura, así que el orden de las secuencias coincide
+    con el orden de commit y un cliente nunca se salta un cambio.
+    """
+    conn = session.connection()
+    tabla = SyncCounter.__table__
+    actualizado = conn.execute(
+        tabla.update().where(tabla.c.name == 'cambios').values(value=tabla.c.value + 1)
+    )
+    if actualizado.rowcount == 0:
+        conn.execute(tabla.insert().values(name='cambios', value=1))
+    return conn.execute(db.select(tabla.c.value).where(tabla.c.name == 'cambios')).scalar()
+
+
+def cursor_actual():
+    """Último valor de la secuencia de cambios (0 si nunca hubo cambios)."""
+    return db.session.query(SyncCounter.value).filter_by(name='cambios').scalar() or 0
+
+
+@event.listens_for(Session, 'before_flush')
+def _marcar_cambios(session, flush_context, instances):
+    tocados = [
+        obj for obj in session.new | session.dirty
+        if isinstance(obj, (Route, Truck))
+        and (obj in session.new or session.is_modified(obj, include_collections=False))
+    ]
+    borrados = [obj for obj in session.deleted if isinstance(obj, (Route, Truck))]
+    if not tocados and not borrados:
+        return
+
+    seq = siguiente_seq(session)
+    session.info['seq_flush'] = seq
+    for obj in tocados:
+        obj.change_seq = seq
+    for obj in borrados:
+        if isinstance(obj, Truck):
+            # El flush deja sus rutas con truck_id = NULL: también cambian
+            for ruta in obj.routes:
+                ruta.change_seq = seq
+        session.add(Tombstone(entity=obj.__tablename__, entity_id=obj.id, change_seq=seq))
+
+
+def _valores_previos(obj, attr):
+    """Valor actual y anterior (si cambió en este flush) de una columna."""
+    historia = inspect(obj).attrs[attr].history
+    return {getattr(obj, attr), *historia.deleted} - {None}
+
+
+@event.listens_for(Session, 'after_flush')
+def _preparar_evento(session, flush_context):
+    """Arma el aviso del flush (ids ya asignados); se publica recién en el commit."""
+    seq = session.info.pop('seq_flush', None)
+    if seq is None:
+        return
+
+    rutas, camiones, truck_ids = set(), set(), set()
+    audiencia = set()
+    dejan_camion = []  # (route_id, camiones de los que salió la ruta)
+    duenos_previos = {}  # truck_id -> chofer/despachador que dejaron de verlo
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Route):
+            rutas.add(obj.id)
+            previos = _valores_previos(obj, 'truck_id')
+            truck_ids |= previos
+            dejan_camion.append((obj.id, previos if obj in session.deleted else previos - {obj.truck_id}))
+        elif isinstance(obj, Truck):
+            camiones.add(obj.id)
+            duenos = _valores_previos(obj, 'driver_id') | _valores_previos(obj, 'dispatcher_id')
+            audiencia |= duenos
+            if obj not in session.deleted:
+                duenos -= {obj.driver_id, obj.dispatcher_id}
+            if duenos:
+                duenos_previos[obj.id] = duenos
+    _registrar_salidas_flush(session, seq, dejan_camion, duenos_previos)
+
+    # Chofer y despachador de los camiones (actuales y anteriores) de las rutas tocadas
+    truck_ids -= camiones
+    if truck_ids:
+        filas = session.connection().execute(
+            db.select(Truck.driver_id, Truck.dispatcher_id).where(Truck.id.in_(truck_ids))
+        )
+        for driver_id, dispatcher_id in filas:
+            audiencia |= {driver_id, dispatcher_id} - {None}
+
+    session.info.setdefault('eventos', []).append({
+        'seq': seq,
+        'routes': sorted(rutas),
+        'trucks': sorted(camiones),
+        'audiencia': audiencia,
+    })
+
+
+def _duenos_de_camiones(truck_ids, conn=None):
+    """{truck_id: {chofer, despachador}} de los camiones `truck_ids` según la DB."""
+    duenos = {}
+    if truck_ids:
+        camiones = Truck.__table__
+        filas = (conn or db.session).execute(
+            db.select(camiones.c.id, camiones.c.driver_id, camiones.c.dispatcher_id)
+            .where(camiones.c.id.in_(truck_ids)))
+        for truck_id, driver_id, dispatcher_id in filas:
+            duenos[truck_id] = {driver_id, dispatcher_id} - {None}
+    return duenos
+
+
+def registrar_salidas(conn, seq, salidas):
+    """Tombstones por usuario: `salidas` son pares (route_id, user_id) de rutas que ese usuario dejó de ver.
+
+    Pueden sobrar (alguien que la sigue viendo por otro camión): el mapa descarta
+    de `removed` lo que vuelve en `upserts`.
+    """
+    filas = [{'entity': 'route', 'entity_id': route_id, 'user_id': user_id, 'change_seq': seq}
+             for route_id, user_id in set(salidas)]
+    if filas:
+        conn.execute(db.insert(Tombstone.__table__), filas)
+
+
+def _registrar_salidas_flush(session, seq, dejan_camion, duenos_previos):
+    """Salidas de un flush del ORM: rutas que dejan un camión y camiones que cambian de duenos."""
+    conn = session.connection()
+    # Camiones borrados en este flush ya no están en la DB: sus duenos salen de la historia
+    duenos = {obj.id: _valores_previos(obj, 'driver_id') | _valores_previos(obj, 'dispatcher_id')
+              for obj in session.deleted if isinstance(obj, Truck)}
+    duenos.update(_duenos_de_camiones({t for _, previos in dejan_camion for t in previos} - duenos.keys(), conn))
+    salidas = [(route_id, user_id) for route_id, previos in dejan_camion
+               for truck_id in previos for user_id in duenos.get(truck_id, ())]
+    if duenos_previos:
+        rutas = Route.__table__
+        for route_id, truck_id in conn.execute(
+                db.select(rutas.c.id, rutas.c.truck_id).where(rutas.c.truck_id.in_(duenos_previos))):
+            salidas.extend((route_id, user_id) for user_id in duenos_previos[truck_id])
+    registrar_salidas(conn, seq, salidas)
+
+
+@event.listens_for(Session, 'after_commit')
+def _publicar_eventos(session):
+    for evento in session.info.pop('eventos', []):
+        versiones.tocar(evento['audiencia'], evento['seq'])
+        broker.publicar(evento)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _descartar_eventos(session):
+    session.info.pop('eventos', None)
+    session.info.pop('seq_flush', None)
+
+# ======== RECLAMO ATÓMICO DE RUTAS ========
+# Tomar/asignar/cambiar de estado una ruta es un compare-and-set: un solo
+# UPDATE ... WHERE id = :id AND status = :visto AND truck_id = :visto. Si otro
+# request llegó antes, el WHERE ya no calza y rowcount = 0: nunca hay doble
+# asignación, sin locks explícitos y sin depender del nivel de aislamiento.
+# Como es un UPDATE de Core (no pasa por el flush del ORM), aquí mismo se
+# hace lo que harían los hooks: secuencia de cambios, contadores y aviso.
+REINTENTOS_OCUPADA = 6
+ESPERA_BASE = 0.02  # segundos; se duplica en cada reintento (con jitter)
+MAX_IDS_EN_AVISO = 1000  # más que esto (operaciones masivas) viaja sin ids: el cliente pide el delta igual
+
+
+def _db_ocupada(error):
+    """¿Es un error transitorio de concurrencia? (SQLite: locked/busy; PostgreSQL: serialización/deadlock)."""
+    mensaje = str(getattr(error, 'orig', error)).lower()
+    return any(t in mensaje for t in ('database is locked', 'database is busy',
+                                      'could not serialize', 'deadlock detected'))
+
+
+def ejecutar_con_reintentos(operacion):
+    """Corre `operacion(evento)` en una transacción propia y hace commit.
+
+    `evento` ya trae la secuencia del cambio; la operación agrega en él las
+    rutas/camiones tocados y su audiencia, y se publica al hacer commit. Si no
+    tocó nada se hace rollback (la secuencia no avanza). Si la DB está ocupada
+    se reintenta todo con backoff exponencial.
+    """
+    for intento in range(REINTENTOS_OCUPADA + 1):
+        try:
+            evento = {'seq': siguiente_seq(db.session), 'routes': set(), 'trucks': set(), 'audiencia': set()}
+            resultado = operacion(evento)
+            if not evento['routes'] and not evento['trucks']:
+                db.session.rollback()
+                return resultado
+            for clave in ('routes', 'trucks'):
+                evento[clave] = sorted(evento[clave]) if len(evento[clave]) <= MAX_IDS_EN_AVISO else []
+            db.session.info.setdefault('eventos', []).append(evento)
+            db.session.commit()
+            return resultado
+        except OperationalError as error:
+            db.session.rollback()
+            if not _db_ocupada(error) or intento == REINTENTOS_OCUPADA:
+                raise
+            time.sleep(ESPERA_BASE * 2 ** intento * (0.5 + random.random()))
+
+
+def cas_ruta(evento, route_id, esperado, nuevo, camion_hacia=None, camion_desde=None):
+    """Compare-and-set de una ruta dentro de la transacción de `ejecutar_con_reintentos`.
+
+    `esperado`: valores que la ruta debe tener ({'status': ..., 'truck_id': ...};
+    None = IS NULL); 'status' es obligatorio para ajustar los contadores.
+    `nuevo`: valores a escribir. `camion_hacia`: estado a dejar en el camión
+    nuevo de la ruta; con `camion_desde` ese cambio también es condicional.
+    Devuelve True si aplicó el cambio, False si la ruta (o el camión) ya no
+    estaba como se esperaba.
+    """
+    rutas, camiones = Route.__table__, Truck.__table__
+    seq = evento['seq']
+    deltas = Counter()
+    truck_id = nuevo.get('truck_id', esperado.get('truck_id'))
+    completa = nuevo.get('status') in ESTADOS_EN_DESTINO and esperado['status'] not in ESTADOS_EN_DESTINO
+    reabre = esperado['status'] in ESTADOS_EN_DESTINO and \
+        nuevo.get('status', esperado['status']) not in ESTADOS_EN_DESTINO
+    nuevo = _con_cierre(esperado['status'], nuevo)
+    columnas_carril = (rutas.c.origin_city_id, rutas.c.destination_city_id, rutas.c.start_time, rutas.c.completed_at)
+
+    camion_previo = None
+    if camion_hacia is not None and truck_id is not None:
+        camion_previo = db.session.execute(
+            db.select(camiones.c.status).where(camiones.c.id == truck_id)).scalar()
+        if camion_desde is not None and camion_previo != camion_desde:
+            return False
+
+    condicion = [rutas.c.id == route_id] + [
+        rutas.c[col].is_(None) if valor is None else rutas.c[col] == valor
+        for col, valor in esperado.items()
+    ]
+    # Al reabrir se descuenta con los tiempos con que se contó (el UPDATE borra completed_at)
+    contada = db.session.execute(db.select(*columnas_carril).where(*condicion)).all() if reabre else []
+    cambia_camion = camion_previo is not None and camion_previo != camion_hacia
+    # Primero la ruta y después el camión, en un SAVEPOINT: si el camión ya no
+    # está como se leyó se deshacen los dos y la transacción sigue con los demás pares
+    punto = db.session.begin_nested() if cambia_camion else None
+    if db.session.execute(rutas.update().where(*condicion).values(**nuevo, change_seq=seq)).rowcount != 1:
+        if punto is not None:
+            punto.rollback()
+        return False
+    if cambia_camion:
+        condicion = [camiones.c.id == truck_id, camiones.c.status == camion_previo]
+        if db.session.execute(camiones.update().where(*condicion)
+                              .values(status=camion_hacia, change_seq=seq)).rowcount != 1:
+            punto.rollback()
+            return False
+        punto.commit()
+
+    deltas[f"route_status:{esperado['status']}"] -= 1
+    deltas[f"route_status:{nuevo.get('status', esperado['status'])}"] += 1
+    if cambia_camion:
+        deltas[f'truck_status:{camion_previo}'] -= 1
+        deltas[f'truck_status:{camion_hacia}'] += 1
+        evento['trucks'].add(truck_id)
+    aplicar_deltas_stats(db.session.connection(), deltas)
+    if completa:
+        registrar_duraciones(db.session.connection(), db.session.execute(
+            db.select(*columnas_carril).where(rutas.c.id == route_id)).all())
+    if contada:
+        descontar_duraciones(db.session.connection(), contada)
+
+    duenos = _duenos_de_camiones({esperado.get('truck_id'), truck_id} - {None})
+    if esperado.get('truck_id') is not None and esperado['truck_id'] != truck_id:
+        registrar_salidas(db.session.connection(), seq,
+                          [(route_id, user_id) for user_id in duenos.get(esperado['truck_id'], ())])
+    evento['audiencia'] |= set().union(*duenos.values())
+    evento['routes'].add(route_id)
+    return True
+
+
+def _audiencia_de_camiones(truck_ids):
+    """Choferes y despachadores de los camiones `truck_ids` (para los avisos de /mapa_stream)."""
+    return set().union(*_duenos_de_camiones(truck_ids).values())
+
+
+
+# ======== DURACIONES Y ETA POR CARRIL ========
+# Cuando una ruta llega a destino se guarda completed_at (start_time se
+# conserva) y su duración se suma a los agregados de su carril (LaneStat, ver
+# analitica.py) en la misma transacción: por el hook de flush si el cambio es
+# del ORM, o desde cas_ruta / las operaciones masivas / la importación si es de
+# Core. Los paneles leen una fila por carril en vez de recorrer el historial.
+# Reabrir una ruta ya contada la descuenta en la misma transacción con los
+# tiempos que tenía (descontar_duraciones); `flask carriles rebuild` queda
+# para reparar o migrar.
+COORDS_CIUDADES = analitica.coords_por_id(indice_ciudades)
+CARRILES_POR_CONSULTA = 400  # pares (origen, destino) por IN al leer LaneStat
+CAMPOS_DURACION = ('origin_city_id', 'destination_city_id', 'start_time', 'completed_at')
+
+
+def _con_cierre(previo, valores):
+    """`valores` más completed_at según la transición: se fija al llegar a destino y se borra al reabrir."""
+    nuevo = valores.get('status', previo)
+    if nuevo in ESTADOS_EN_DESTINO and previo not in ESTADOS_EN_DESTINO:
+        return {'completed_at': datetime.utcnow(), **valores}
+    if previo in ESTADOS_EN_DESTINO and nuevo not in ESTADOS_EN_DESTINO:
+        return {**valores, 'completed_at': None}
+    return valores
+
+
+def _leer_carriles(conn, pares, bloquear=False):
+    """{(origen, destino): fila de LaneStat} de los carriles `pares`."""
+    tabla = LaneStat.__table__
+    pares = list(pares)
+    guardados = {}
+    for inicio in range(0, len(pares), CARRILES_POR_CONSULTA):
+        stmt = db.select(tabla).where(db.tuple_(tabla.c.origin_city_id, tabla.c.destination_city_id)
+                                      .in_(pares[inicio:inicio + CARRILES_POR_CONSULTA]))
+        if bloquear:
+            stmt = stmt.with_for_update()  # PostgreSQL; en SQLite el writer ya tiene el lock
+        for fila in conn.execute(stmt):
+            guardados[(fila.origin_city_id, fila.destination_city_id)] = fila
+    return guardados
+
+
+def _agregados_de(fila):
+    """Fila de LaneStat -> agregados escalares como los de analitica.agregar."""
+    return {'n': fila.n, 'media': fila.mean, 'm2': fila.m2, 'minimo': fila.min_s or 0.0,
+            'maximo': fila.max_s or 0.0, 'a_tiempo': fila.on_time, 'hist': analitica.hist_de_texto(fila.hist)}
+
+
+def _agregados_guardados(guardados, pares):
+    """Agregados alineados con `pares` desde las filas de LaneStat (cero donde no hay fila)."""
+    agregados = analitica.vacios(len(pares))
+    for i, par in enumerate(pares):
+        if par in guardados:
+            for campo, valor in _agregados_de(guardados[par]).items():
+                agregados[campo][i] = valor
+    return agregados
+
+
+def _guardar_carriles(conn, pares, agregados, guardados):
+    """Escribe `agregados` (alineados con `pares`): UPDATE de los que ya tenían fila, INSERT del resto."""
+    tabla = LaneStat.__table__
+    actualizar, insertar = [], []
+    columnas = ('n', 'mean', 'm2', 'min_s', 'max_s', 'on_time', 'hist')
+    for i, (origen, destino) in enumerate(pares):
+        fila = {'n': int(agregados['n'][i]), 'mean': float(agregados['media'][i]),
+                'm2': float(agregados['m2'][i]), 'min_s': float(agregados['minimo'][i]),
+                'max_s': float(agregados['maximo'][i]), 'on_time': int(agregados['a_tiempo'][i]),
+                'hist': analitica.hist_a_texto(agregados['hist'][i])}
+        if (origen, destino) in guardados:
+            actualizar.append({**fila, 'b_origen': origen, 'b_destino': destino})
+        else:
+            insertar.append({**fila, 'origin_city_id': origen, 'destination_city_id': destino})
+    if actualizar:
+        conn.execute(
+            tabla.update()
+            .where(tabla.c.origin_city_id == db.bindparam('b_origen'),
+                   tabla.c.destination_city_id == db.bindparam('b_destino'))
+            .values({c: db.bindparam(c) for c in columnas}),
+            actualizar)
+    if insertar:
+        conn.execute(tabla.insert(), insertar)
+
+
+def registrar_duraciones(conn, filas):
+    """Suma a LaneStat las rutas completadas `filas` dentro de la transacción de `conn`.
+
+    `filas`: (origin_city_id, destination_city_id, start_time, completed_at);
+    las que no tienen ciudades o tiempos se ignoran. Devuelve cuántas se sumaron.
+    """
+    carriles, duraciones, plazos = analitica.muestras(filas, COORDS_CIUDADES)
+    if not len(duraciones):
+        return 0
+    claves, nuevos = analitica.agregar(carriles, duraciones, plazos)
+    pares = [(int(o), int(d)) for o, d in claves]
+    guardados = _leer_carriles(conn, pares, bloquear=True)
+    total = analitica.combinar(_agregados_guardados(guardados, pares), nuevos)
+    _guardar_carriles(conn, pares, total, guardados)
+    return len(duraciones)
+
+
+def descontar_duraciones(conn, filas, excluir=()):
+    """Resta de LaneStat las rutas `filas` que se reabren, en la transacción de `conn`.
+
+    `filas` como en `registrar_duraciones`, con los tiempos con que se
+    completaron. Los carriles donde una de ellas era el mínimo o el máximo (o
+    que no las tenían contadas) se releen de las rutas completadas; `excluir`
+    son los ids de las que en la DB todavía figuran completadas (hook del ORM).
+    Devuelve cuántas se restaron.
+    """
+    carriles, duraciones, plazos = analitica.muestras(filas, COORDS_CIUDADES)
+    if not len(duraciones):
+        return 0
+    claves, quitar = analitica.agregar(carriles, duraciones, plazos)
+    pares = [(int(o), int(d)) for o, d in claves]
+    guardados = _leer_carriles(conn, pares, bloquear=True)
+    resto, recalcular = analitica.restar(_agregados_guardados(guardados, pares), quitar)
+    releer = [par for par, marcado in zip(pares, recalcular) if marcado]
+    if releer:
+        claves_h, historial = _historial_carriles(conn, releer, excluir)
+        posicion = {(int(o), int(d)): j for j, (o, d) in enumerate(claves_h)}
+        for i, par in enumerate(pares):
+            if recalcular[i]:
+                j = posicion.get(par)
+                for campo in resto:
+                    resto[campo][i] = historial[campo][j] if j is not None else 0
+    _guardar_carriles(conn, pares, resto, guardados)
+    return len(duraciones)
+
+
+@event.listens_for(Session, 'before_flush')
+def _registrar_completadas(session, flush_context, instances):
+    """completed_at y agregados de carril para los cambios de estado (y borrados) hechos con el ORM."""
+    filas, reabiertas, ids_reabiertas = [], [], []
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, Route):
+            continue
+        if obj in session.new:
+            previo = None
+        else:
+            historia = inspect(obj).attrs.status.history
+            if not historia.deleted:
+                continue  # el estado no cambió
+            previo = historia.deleted[0]
+        status = _valor_actual(obj, 'status')
+        if status in ESTADOS_EN_DESTINO and previo not in ESTADOS_EN_DESTINO:
+            if obj.completed_at is None:
+                obj.completed_at = datetime.utcnow()
+            filas.append((obj.origin_city_id, obj.destination_city_id, obj.start_time, obj.completed_at))
+        elif previo in ESTADOS_EN_DESTINO and status not in ESTADOS_EN_DESTINO:
+            # Se descuenta con los valores con que se contó (los de la DB)
+            reabiertas.append(tuple(_valor_guardado(obj, attr) for attr in CAMPOS_DURACION))
+            ids_reabiertas.append(obj.id)
+            obj.completed_at = None
+    for obj in session.deleted:
+        # Una completada que se borra también deja de contar
+        if isinstance(obj, Route) and _valor_guardado(obj, 'status') in ESTADOS_EN_DESTINO:
+            reabiertas.append(tuple(_valor_guardado(obj, attr) for attr in CAMPOS_DURACION))
+            ids_reabiertas.append(obj.id)
+    if filas:
+        registrar_duraciones(session.connection(), filas)
+    if reabiertas:
+        descontar_duraciones(session.connection(), reabiertas, excluir=ids_reabiertas)
+
+
+def _valor_guardado(obj, attr):
+    """Valor de la columna tal como está en la DB (antes de los cambios sin flush)."""
+    historia = inspect(obj).attrs[attr].history
+    return historia.deleted[0] if historia.deleted else getattr(obj, attr)
+
+
+def _historial_carriles(conn=None, pares=None, excluir=()):
+    """Agregados calculados desde las rutas completadas (la fuente de verdad).
+
+    Todos los carriles, o solo `pares`; `excluir`: ids de rutas a no contar.
+    """
+    rutas = Route.__table__
+    stmt = db.select(rutas.c.origin_city_id, rutas.c.destination_city_id, rutas.c.start_time,
+                     rutas.c.completed_at).where(rutas.c.status.in_(ESTADOS_EN_DESTINO),
+                                                 rutas.c.start_time.isnot(None), rutas.c.completed_at.isnot(None))
+    if excluir:
+        stmt = stmt.where(rutas.c.id.notin_(list(excluir)))
+    if pares is None:
+        filas = (conn or db.session).execute(stmt).all()
+    else:
+        pares, filas = list(pares), []
+        for inicio in range(0, len(pares), CARRILES_POR_CONSULTA):
+            filas += (conn or db.session).execute(stmt.where(
+                db.tuple_(rutas.c.origin_city_id, rutas.c.destination_city_id)
+                .in_(pares[inicio:inicio + CARRILES_POR_CONSULTA]))).all()
+    return analitica.agregar(*analitica.muestras(filas, COORDS_CIUDADES))
+
+
+def reconstruir_carriles():
+    """Reemplaza LaneStat con los agregados del historial; devuelve cuántos carriles quedaron."""
+    claves, agregados = _historial_carriles()
+    filas = [{
+        'origin_city_id': int(o), 'destination_city_id': int(d), 'n': int(agregados['n'][i]),
+        'mean': float(agregados['media'][i]), 'm2': float(agregados['m2'][i]),
+        'min_s': float(agregados['minimo'][i]), 'max_s': float(agregados['maximo'][i]),
+        'on_time': int(agregados['a_tiempo'][i]), 'hist': analitica.hist_a_texto(agregados['hist'][i]),
+    } for i, (o, d) in enumerate(claves)]
+    db.session.query(LaneStat).delete()
+    if filas:
+        db.session.execute(db.insert(LaneStat), filas)
+    db.session.commit()
+    return len(claves)
+
+
+def verificar_carriles():
+    """Diferencias {(origen, destino): (n guardado, n real)} entre LaneStat y el historial."""
+    claves, agregados = _historial_carriles()
+    reales = {(int(o), int(d)): int(agregados['n'][i]) for i, (o, d) in enumerate(claves)}
+    guardados = {(o, d): n for o, d, n in db.session.query(
+        LaneStat.origin_city_id, LaneStat.destination_city_id, LaneStat.n) if n}
+    return {par: (guardados.get(par, 0), reales.get(par, 0)) for par in guardados.keys() | reales.keys()
+            if guardados.get(par, 0) != reales.get(par, 0)}
+
+
+@app.cli.command('carriles')
+@click.argument('accion', type=click.Choice(['check', 'rebuild']))
+def carriles_command(accion):
+    """Verifica (check) o reconstruye (rebuild) los agregados de duración por carril."""
+    if accion == 'rebuild':
+        click.echo(f'{reconstruir_carriles()} carriles reconstruidos')
+        return
+    diferencias = verificar_carriles()
+    for (origen, destino), (guardado, real) in sorted(diferencias.items()):
+        click.echo(f'{origen}->{destino}: guardado={guardado} real={real}')
+    if diferencias:
+        raise SystemExit(1)
+    click.echo('OK: carriles consistentes')
+
+
+def _km_carril(origen, destino):
+    """Distancia del carril en km; None si alguna ciudad no tiene coordenadas."""
+    if origen is None or destino is None or max(origen, destino) >= len(COORDS_CIUDADES):
+        return None
+    km = float(analitica.distancia_km(COORDS_CIUDADES[origen], COORDS_CIUDADES[destino])[0])
+    return None if km != km else km  # NaN: id sin ciudad
+
+
+def eta_rutas(rutas):
+    """ETA de rutas en curso: {route_id: {...}} desde los agregados de sus carriles (una consulta).
+
+    `rutas`: (id, origin_city_id, destination_city_id, start_time). El ETA es
+    el inicio más la mediana del carril (y el p90 como estimación pesimista);
+    sin historial suficiente se estima por distancia.
+    """
+    limite = len(COORDS_CIUDADES)
+    pares = sorted({(o, d) for _, o, d, _ in rutas if o is not None and d is not None and max(o, d) < limite})
+    guardados = _leer_carriles(db.session.connection(), pares) if pares else {}
+    # Lo que depende solo del carril se calcula una vez por carril, vectorizado
+    indices = np.array(pares, dtype=np.int64).reshape(-1, 2)
+    km = analitica.distancia_km(COORDS_CIUDADES[indices[:, 0]], COORDS_CIUDADES[indices[:, 1]])
+    filas = [guardados.get(par) for par in pares]
+    n = np.array([f.n if f is not None else 0 for f in filas], dtype=np.int64)
+    hist = np.array([analitica.hist_de_texto(f.hist) if f is not None else np.zeros(analitica.N_BINS)
+                     for f in filas]).reshape(-1, analitica.N_BINS)
+    p50, p90 = analitica.duracion_estimada(n, hist, km)
+    plazos = analitica.plazo_s(km)
+    por_carril = {}
+    for i, par in enumerate(pares):
+        if km[i] != km[i]:  # NaN: id sin ciudad
+            continue
+        por_carril[par] = (float(p50[i]), float(p90[i]), float(plazos[i]), {
+            'fuente': 'historial' if n[i] >= analitica.MIN_MUESTRAS_ETA else 'distancia',
+            'muestras': int(n[i]),
+            'a_tiempo_pct': round(100.0 * filas[i].on_time / n[i], 1) if n[i] else None,
+        })
+    ahora = datetime.utcnow()
+    etas = {}
+    for route_id, origen, destino, inicio in rutas:
+        if (origen, destino) not in por_carril:
+            continue
+        p50, p90, plazo, datos = por_carril[(origen, destino)]
+        desde = inicio or ahora
+        etas[route_id] = {
+            'eta': (desde + timedelta(seconds=p50)).isoformat(timespec='seconds'),
+            'eta_p90': (desde + timedelta(seconds=p90)).isoformat(timespec='seconds'),
+            'plazo': (desde + timedelta(seconds=plazo)).isoformat(timespec='seconds'),
+            **datos,
+        }
+    return etas
+
+
+def _cargar_identidad(user_id):
+    """Usuario y su camión (el de menor id si maneja varios) en una consulta."""
+    fila = db.session.execute(
+        db.select(User.id, User.username, User.role, Truck.id, Truck.plate)
+        .outerjoin(Truck, Truck.driver_id == User.id)
+        .where(User.id == user_id).order_by(Truck.id).limit(1)
+    ).first()
+    return Identidad(*fila) if fila else None
 
-# ======== INICIALIZAR DB ========
-if __name__ == '__main__':
-    # with app.app_context():
-    #     db.create_all()
-    pass
 
-    
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Desde la caché: los sondeos de los mapas no consultan la DB para saber quién es el usuario
+    return identidades.obtener(int(user_id), _cargar_identidad)
+
+
+@event.listens_for(Session, 'after_flush')
+def _anotar_identidades(session, flush_context):
+    """Usuarios cuya identidad cambia con este flush: ellos mismos o el chofer de un camión tocado."""
+    user_ids = session.info.setdefault('identidades', set())
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, User):
+            user_ids.add(obj.id)
+        elif isinstance(obj, Truck):
+            user_ids |= _valores_previos(obj, 'driver_id')
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidar_identidades(session):
+    user_ids = session.info.pop('identidades', None)
+    if user_ids:
+        identidades.invalidar(user_ids)
+        versiones.tocar(user_ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _descartar_identidades(session):
+    session.info.pop('identidades', None)
 
 
 @app.context_processor
@@ -90,6 +1121,16 @@ def inject_csrf_token():
         token = ""
     return dict(csrf_token=token)
 
+
+# Métricas por request, /metrics y ?_profile=1 (solo con INSTRUMENTACION=1)
+with app.app_context():
+    instrumentacion.init_app(
+        app, db.engine,
+        puede_ver=lambda: current_user.is_authenticated and current_user.role == 'admin',
+    )
+    # Cola de trabajos en segundo plano: los hilos arrancan con el primer encolado
+    cola.init_app(app, db.engine, Job.__table__)
+
 @app.route("/")
 def home():
     return redirect(url_for("login"))
@@ -125,7 +1166,7 @@ def dashboard_chofer():
     if current_user.role != "chofer":
         return "No autorizado", 403
 
-    truck = Truck.query.filter_by(driver_id=current_user.id).first()
+    truck = current_user.camion
 
     assigned_routes = Route.query.filter_by(truck_id=truck.id).all() if truck else []
 
@@ -144,35 +1185,35 @@ def update_route_status(route_id, status):
     route = Route.query.get_or_404(route_id)
 
 
+    # El cambio se aplica solo si la ruta sigue como se leyó (estado y camión)
+    visto = {'status': route.status, 'truck_id': route.truck_id}
+
     # Manejar request para cambiar estado: 'en_progreso' o 'completada'
     if status == "en_progreso":
         # Chofer intenta tomar una ruta pendiente o iniciar una ruta ya asignada a su camión
         if route.status == "pendiente" and route.truck_id is None:
-            truck = Truck.query.filter_by(driver_id=current_user.id).first()
-            if not truck:
+            if current_user.truck_id is None:
                 return "No tienes camión asignado", 400
 
-            route.truck_id = truck.id
-            route.status = "en_progreso"
-            route.start_time = datetime.utcnow()
+            nuevo = {'truck_id': current_user.truck_id, 'status': "en_progreso", 'start_time': datetime.utcnow()}
         else:
             # Si la ruta ya está asignada, validar que corresponda al chofer y permitir cambiar a en_progreso
             if not route.truck or route.truck.driver_id != current_user.id:
                 return "No autorizado", 403
-            route.status = "en_progreso"
-            route.start_time = datetime.utcnow()
+            nuevo = {'status': "en_progreso", 'start_time': datetime.utcnow()}
 
     elif status == "completada":
         # Solo el chofer asignado puede marcarla como completada
         if not route.truck or route.truck.driver_id != current_user.id:
             return "No autorizado", 403
-        route.status = "completada"
-        route.start_time = None
+        nuevo = {'status': "completada"}  # cas_ruta fija completed_at; start_time se conserva
 
     else:
         return "Estado no soportado", 400
 
-    db.session.commit()
+    aplicado = ejecutar_con_reintentos(lambda evento: cas_ruta(evento, route_id, visto, nuevo))
+    if not aplicado:
+        return "La ruta cambió mientras tanto (¿otro chofer la tomó?)", 409
     return redirect(url_for("dashboard_chofer"))
 
 @app.route("/asignar_ruta/<int:route_id>", methods=["POST"])
@@ -187,43 +1228,253 @@ def asignar_ruta(route_id):
     if route.status != "pendiente" or route.truck_id is not None:
         return "Ruta no disponible", 400
 
-    # Buscar el camión del chofer actual
-    truck = Truck.query.filter_by(driver_id=current_user.id).first()
-    if not truck:
+    # Camión del chofer actual (viene con la identidad del usuario)
+    if current_user.truck_id is None:
         return "No tienes camión asignado", 400
 
-    # Asignar ruta
-    route.truck_id = truck.id
-    route.status = "en_progreso"
-    db.session.commit()
+    # Asignar ruta (atómico: si otro la tomó entre la lectura y aquí, no se pisa)
+    tomada = ejecutar_con_reintentos(lambda evento: cas_ruta(
+        evento, route_id,
+        esperado={'status': 'pendiente', 'truck_id': None},
+        nuevo={'truck_id': current_user.truck_id, 'status': 'en_progreso'},
+    ))
+    if not tomada:
+        return "Ruta no disponible: otro la tomó primero", 409
 
     return redirect(url_for("dashboard_chofer")) 
 
+MAX_PINGS_POR_LOTE = 5000
+
+
+def _parsear_ts(valor):
+    """Timestamp de un ping: epoch en segundos o ISO 8601 (UTC); None = ahora.
+
+    ValueError si no se entiende (incluye epoch fuera de rango y booleanos).
+    """
+    if valor is None:
+        return datetime.utcnow()
+    if isinstance(valor, bool):
+        raise ValueError(f'timestamp inválido: {valor!r}')
+    if isinstance(valor, (int, float)):
+        try:
+            return datetime.fromtimestamp(valor, timezone.utc).replace(tzinfo=None)
+        except (OverflowError, OSError):
+            raise ValueError(f'timestamp fuera de rango: {valor!r}') from None
+    ts = datetime.fromisoformat(str(valor).replace('Z', '+00:00'))
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def _parsear_ts_texto(valor):
+    """Como `_parsear_ts` pero para texto (query string, CSV): '1700000000' es epoch."""
+    valor = valor.strip()
+    return _parsear_ts(float(valor) if valor.replace('.', '', 1).isdigit() else valor)
+
+
+@app.route("/tracking", methods=["POST"])
+@login_required
+def tracking_ingesta():
+    """Recibe un lote de posiciones GPS del chofer y las guarda en una sola transacción.
+
+    Cuerpo JSON: {"pings": [{"route_id": 1, "lat": -33.4, "lon": -70.6, "ts": 1700000000}, ...]}
+    """
+    if current_user.role != "chofer":
+        return jsonify({"error": "No autorizado"}), 403
+
+    datos = request.get_json(silent=True) or {}
+    pings = datos.get("pings") if isinstance(datos, dict) else datos
+    if not isinstance(pings, list) or not pings:
+        return jsonify({"error": "Se esperaba una lista 'pings'"}), 400
+    if len(pings) > MAX_PINGS_POR_LOTE:
+        return jsonify({"error": f"Máximo {MAX_PINGS_POR_LOTE} pings por lote"}), 413
+
+    filas = []
+    try:
+        for ping in pings:
+            lat, lon = float(ping["lat"]), float(ping["lon"])
+            if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+                raise ValueError("coordenadas fuera de rango")
+            filas.append({
+                "route_id": int(ping["route_id"]),
+                "lat": lat,
+                "lon": lon,
+                "timestamp": _parsear_ts(ping.get("ts")),
+            })
+    except (KeyError, TypeError, ValueError, OverflowError) as e:
+        return jsonify({"error": f"Ping inválido: {e}"}), 400
+
+    # Una sola consulta valida que todas las rutas del lote sean del camión del chofer
+    route_ids = {f["route_id"] for f in filas}
+    propias, despachadores = {}, set()
+    for route_id, truck_id, dispatcher_id in (
+        db.session.query(Route.id, Route.truck_id, Truck.dispatcher_id)
+        .join(Truck, Route.truck_id == Truck.id)
+        .filter(Truck.driver_id == current_user.id, Route.id.in_(route_ids))
+    ):
+        propias[route_id] = truck_id
+        despachadores.add(dispatcher_id)
+    ajenas = route_ids - propias.keys()
+    if ajenas:
+        return jsonify({"error": "Rutas no asignadas a tu camión", "route_ids": sorted(ajenas)}), 403
+
+    # executemany sobre un único INSERT preparado, todo en la misma transacción.
+    # Los marcadores se movieron: el lote avanza la secuencia de cambios y marca
+    # sus rutas, así el delta de los mapas las trae y /mapa_stream avisa una vez
+    # al chofer y su despachador (se publica en el commit, ver _publicar_eventos)
+    seq = siguiente_seq(db.session)
+    db.session.execute(db.insert(Tracking.__table__), filas)
+    rutas = Route.__table__
+    db.session.execute(rutas.update().where(rutas.c.id.in_(route_ids)).values(change_seq=seq))
+    db.session.info.setdefault('eventos', []).append({
+        'seq': seq, 'routes': sorted(route_ids), 'trucks': [],
+        'audiencia': {current_user.id} | despachadores - {None},
+    })
+    db.session.commit()
+
+    posiciones_en_vivo().actualizar_lote(
+        (f["route_id"], propias[f["route_id"]], f["lat"], f["lon"], _epoch(f["timestamp"])) for f in filas
+    )
+    return jsonify({"insertados": len(filas)}), 201
+
+
+# ======== PANEL DEL DESPACHADOR ========
+# El panel sale de una foto de la flota (camiones con su chofer y sus rutas
+# activas, con carga anticipada) y de un feed de pendientes sin camión que
+# salen cerca de la flota: ciudades a menos de RADIO_PENDIENTES_KM de algún
+# camión, de la más cercana a la más lejana y, en cada una, de la más antigua a
+# la más nueva. Cada página del feed es una consulta (un UNION ALL con un LIMIT
+# por ciudad sobre ix_route_pendientes_origen): cuesta lo mismo con mil o con un
+# millón de pendientes en la tabla.
+RADIO_PENDIENTES_KM = float(os.environ.get('RADIO_PENDIENTES_KM', 300))
+MAX_CIUDADES_PENDIENTES = 15
+PENDIENTES_POR_PAGINA = 12
+
+
+def _flota_despachador(despachador_id):
+    """(camiones con su chofer, rutas activas con su camión) de la flota, en dos consultas."""
+    trucks = (
+        Truck.query.options(db.joinedload(Truck.driver))
+        .filter(Truck.dispatcher_id == despachador_id)
+        .order_by(Truck.id).all()
+    )
+    # IN (subconsulta) además del JOIN: así busca cada (estado, camión) en
+    # ix_route_pendientes_origen en vez de recorrer las rutas de todos los estados activos
+    activas = (
+        Route.query.join(Route.truck).options(db.contains_eager(Route.truck))
+        .filter(Route.truck_id.in_(db.select(Truck.id).where(Truck.dispatcher_id == despachador_id)),
+                Route.status.in_(ESTADOS_EN_ORIGEN))
+        .order_by(Route.id).all()
+    )
+    return trucks, activas
+
+
+def _posiciones_flota(trucks, activas):
+    """{truck_id: (lat, lon)}: último ping GPS; si no, destino de su ruta activa o de la última completada."""
+    vivo = posiciones_en_vivo()
+    destino_activa = {r.truck_id: indice_ciudades.coords_de(r.destination_city_id, r.destination) for r in activas}
+    posiciones, faltan = {}, []
+    for truck in trucks:
+        ping = vivo.de_camion(truck.id)
+        coords = ping[:2] if ping else destino_activa.get(truck.id)
+        if coords is None:
+            faltan.append(truck.id)
+        else:
+            posiciones[truck.id] = coords
+    posiciones.update((t, c) for t, c in _ultimos_destinos(faltan).items() if c is not None)
+    return posiciones
+
+
+def _ciudades_cercanas(posiciones):
+    """[(city_id, km al camión más cercano)] dentro de RADIO_PENDIENTES_KM, de la más cercana a la más lejana."""
+    posiciones = list(posiciones)
+    if not posiciones:
+        return []
+    ids = np.nonzero(~np.isnan(COORDS_CIUDADES[:, 0]))[0]
+    km = despacho.matriz_costos(posiciones, COORDS_CIUDADES[ids]).min(axis=0)
+    orden = np.argsort(km, kind='stable')[:MAX_CIUDADES_PENDIENTES]
+    return [(int(ids[i]), float(km[i])) for i in orden if km[i] <= RADIO_PENDIENTES_KM]
+
+
+def _cursor_pendientes(texto):
+    """'<city_id>:<route_id>' -> (city_id, route_id); None si falta o no se entiende."""
+    ciudad, _, ruta = (texto or '').partition(':')
+    return (int(ciudad), int(ruta)) if ciudad.isdigit() and ruta.isdigit() else None
+
+
+def pendientes_cercanas(ciudades, despues=None, limite=PENDIENTES_POR_PAGINA):
+    """Una página del feed: ([{id, origin, destination, status, km}], cursor de la siguiente o None).
+
+    `ciudades`: [(city_id, km)] en el orden del feed (ver _ciudades_cercanas).
+    `despues`: (city_id, route_id) de la última ruta de la página anterior.
+    """
+    if despues is not None:
+        orden = [city_id for city_id, _ in ciudades]
+        if despues[0] in orden:
+            ciudades = ciudades[orden.index(despues[0]):]
+    partes = []
+    for city_id, _ in ciudades:
+        consulta = db.select(Route.id, Route.origin, Route.destination, Route.origin_city_id).where(
+            Route.status == 'pendiente', Route.truck_id.is_(None), Route.origin_city_id == city_id)
+        if despues is not None and city_id == despues[0]:
+            consulta = consulta.where(Route.id > despues[1])
+        # limite + 1 por ciudad: alcanza para llenar la página y saber si hay otra
+        partes.append(consulta.order_by(Route.id).limit(limite + 1).subquery().select())
+    if not partes:
+        return [], None
+    por_ciudad = {}
+    for fila in db.session.execute(db.union_all(*partes) if len(partes) > 1 else partes[0]):
+        por_ciudad.setdefault(fila.origin_city_id, []).append(fila)
+    km = dict(ciudades)
+    filas = [f for city_id, _ in ciudades for f in por_ciudad.get(city_id, [])]
+    items = [{'id': f.id, 'origin': f.origin, 'destination': f.destination, 'status': 'pendiente',
+              'km': round(km[f.origin_city_id])} for f in filas[:limite]]
+    ultima = filas[limite - 1] if len(filas) > limite else None
+    return items, f'{ultima.origin_city_id}:{ultima.id}' if ultima else None
+
+
 @app.route("/dashboard_despachador")
 @login_required
 def dashboard_despachador():
     if current_user.role != "despachador":
         return "No autorizado", 403
 
-    # Camiones de su flota
-    trucks = Truck.query.filter_by(dispatcher_id=current_user.id).all()
+    # Foto de la flota: camiones con chofer y sus rutas activas con camión
+    trucks, activas = _flota_despachador(current_user.id)
 
-    # Rutas pendientes SOLO de sus camiones
-    available_routes = Route.query.filter(
-        (Route.truck_id == None) & (Route.status == "pendiente")
-    ).all()
+    # Rutas pendientes sin camión que salen cerca de la flota, paginadas
+    ciudades = _ciudades_cercanas(_posiciones_flota(trucks, activas).values())
+    available_routes, siguiente = pendientes_cercanas(ciudades, _cursor_pendientes(request.args.get('pendientes')))
 
-    # Rutas en progreso o completadas de sus camiones
-    my_routes = Route.query.join(Truck).filter(Truck.dispatcher_id == current_user.id).all()
+    # ETA de las que están en curso, desde los agregados de su carril
+    en_curso = [r for r in activas if r.status in ESTADOS_CON_CAMION]
+    etas = eta_rutas([(r.id, r.origin_city_id, r.destination_city_id, r.start_time) for r in en_curso])
 
     return render_template(
         "dashboard_despachador.html",
         trucks=trucks,
         available_routes=available_routes,
-        my_routes=my_routes
+        siguiente=siguiente,
+        pagina_pendientes=request.args.get('pendientes'),
+        radio_km=RADIO_PENDIENTES_KM,
+        en_curso=en_curso,
+        etas=etas
     )
 
 
+@app.route('/despachador/pendientes')
+@login_required
+def despachador_pendientes():
+    """Feed de pendientes cercanas a la flota en JSON: ?despues=<cursor> (el `next` de la página anterior)."""
+    if current_user.role != "despachador":
+        return "No autorizado", 403
+    trucks, activas = _flota_despachador(current_user.id)
+    ciudades = _ciudades_cercanas(_posiciones_flota(trucks, activas).values())
+    limite = min(_entero_arg('limit') or PENDIENTES_POR_PAGINA, MAX_POR_PAGINA)
+    items, siguiente = pendientes_cercanas(ciudades, _cursor_pendientes(request.args.get('despues')), limite)
+    return jsonify({'items': items, 'next': siguiente, 'ciudades': len(ciudades), 'radio_km': RADIO_PENDIENTES_KM})
+
+
 @app.route('/asignar_chofer/<int:route_id>')
 @login_required
 def asignar_chofer(route_id):
@@ -257,67 +1508,461 @@ def asignar_chofer_confirm(route_id, truck_id):
     if route.status != 'pendiente' or route.truck_id is not None:
         return "Ruta no disponible", 400
 
-    # Asignar
-    route.truck_id = truck.id
-    route.status = 'en_progreso'
-    truck.status = 'en ruta'
-    db.session.commit()
+    # Asignar (atómico frente a otros despachadores y choferes)
+    asignada = ejecutar_con_reintentos(lambda evento: cas_ruta(
+        evento, route_id,
+        esperado={'status': 'pendiente', 'truck_id': None},
+        nuevo={'truck_id': truck.id, 'status': 'en_progreso'},
+        camion_hacia='en ruta',
+    ))
+    if not asignada:
+        return "Ruta no disponible: ya fue asignada", 409
 
     return redirect(url_for('dashboard_despachador'))
 
+# ======== ASIGNACIÓN AUTOMÁTICA ========
+# Por ciudad de origen basta con considerar tantas rutas pendientes como camiones
+# libres haya (las más antiguas): nunca se asignan más. Así la matriz de costos
+# queda acotada por camiones × ciudades aunque haya decenas de miles pendientes.
+
+
+def _camiones_para_despacho(despachador_id):
+    """[(id, plate, (lat, lon))] de los camiones libres con chofer; y los ids sin posición conocida.
+
+    Posición: último ping GPS del camión; si no hay, el destino de su última ruta completada.
+    """
+    camiones = (
+        db.session.query(Truck.id, Truck.plate)
+        .filter(Truck.dispatcher_id == despachador_id, Truck.status == 'disponible',
+                Truck.driver_id.isnot(None))
+        .order_by(Truck.id).all()
+    )
+    vivo = posiciones_en_vivo()
+    destinos = _ultimos_destinos([t.id for t in camiones if vivo.de_camion(t.id) is None])
+    con_posicion, sin_posicion = [], []
+    for truck_id, plate in camiones:
+        ping = vivo.de_camion(truck_id)
+        coords = ping[:2] if ping else destinos.get(truck_id)
+        if coords is None:
+            sin_posicion.append(truck_id)
+        else:
+            con_posicion.append((truck_id, plate, coords))
+    return con_posicion, sin_posicion
+
+
+def _ultimos_destinos(truck_ids):
+    """{truck_id: (lat, lon)} del destino de la última ruta completada de cada camión (una consulta)."""
+    if not truck_ids:
+        return {}
+    ultima = (
+        db.session.query(db.func.max(Route.id))
+        .filter(Route.truck_id.in_(truck_ids), Route.status == 'completada')
+        .group_by(Route.truck_id)
+    )
+    return {
+        truck_id: indice_ciudades.coords_de(city_id, nombre)
+        for truck_id, city_id, nombre in db.session.query(
+            Route.truck_id, Route.destination_city_id, Route.destination).filter(Route.id.in_(ultima))
+    }
+
+
+def _rutas_para_despacho(por_ciudad):
+    """Rutas pendientes sin camión, las `por_ciudad` más antiguas de cada ciudad de origen."""
+    rango = db.func.row_number().over(partition_by=Route.origin_city_id, order_by=Route.id).label('rango')
+    pendientes = (
+        db.select(Route.id, Route.origin, Route.destination, Route.origin_city_id, rango)
+        .where(Route.status == 'pendiente', Route.truck_id.is_(None))
+        .subquery()
+    )
+    filas = db.session.execute(
+        db.select(pendientes).where(pendientes.c.rango <= por_ciudad).order_by(pendientes.c.id)
+    ).all()
+    rutas = ((f, indice_ciudades.coords_de(f.origin_city_id, f.origin)) for f in filas)
+    return [(f, coords) for f, coords in rutas if coords is not None]
+
+
+def planificar_despacho(despachador_id, metodo='auto', max_km=None):
+    """Propuesta de asignación que minimiza los km en vacío de la flota del despachador."""
+    t0 = time.perf_counter()
+    camiones, sin_posicion = _camiones_para_despacho(despachador_id)
+    rutas = _rutas_para_despacho(len(camiones)) if camiones else []
+    asignaciones = []
+    usado = 'vacío'
+    if camiones and rutas:
+        filas, columnas, kms, usado = despacho.resolver(
+            [c[2] for c in camiones], [r[1] for r in rutas],
+            prioridad=[r[0].rango - 1 for r in rutas], metodo=metodo)
+        for i, j, km in zip(filas, columnas, kms):
+            if max_km is not None and km > max_km:
+                continue
+            truck_id, plate, _ = camiones[i]
+            ruta = rutas[j][0]
+            asignaciones.append({
+                'route_id': ruta.id, 'truck_id': truck_id, 'plate': plate,
+                'origin': ruta.origin, 'destination': ruta.destination, 'km_vacio': round(km, 1),
+            })
+    return {
+        'metodo': usado,
+        'camiones': len(camiones),
+        'rutas_candidatas': len(rutas),
+        'sin_posicion': sin_posicion,
+        'km_vacio_total': round(sum(a['km_vacio'] for a in asignaciones), 1),
+        'ms': round((time.perf_counter() - t0) * 1000.0, 1),
+        'asignaciones': asignaciones,
+    }
+
+
+def aplicar_despacho(despachador_id, pares):
+    """Aplica [(route_id, truck_id)] en una sola transacción; devuelve (aplicadas, rechazadas).
+
+    Cada par es un compare-and-set sobre la ruta (pendiente y libre) y el camión
+    (disponible): una ruta ya tomada o un camión que dejó de estar libre (o no
+    es de la flota) se rechaza sin afectar al resto.
+    """
+    de_la_flota = {t for (t,) in db.session.query(Truck.id).filter(
+        Truck.id.in_({t for _, t in pares}), Truck.dispatcher_id == despachador_id,
+        Truck.driver_id.isnot(None))}
+
+    def aplicar(evento):
+        aplicadas, rechazadas = [], []
+        for route_id, truck_id in pares:
+            ok = truck_id in de_la_flota and cas_ruta(
+                evento, route_id,
+                esperado={'status': 'pendiente', 'truck_id': None},
+                nuevo={'truck_id': truck_id, 'status': 'en_progreso'},
+                camion_hacia='en ruta', camion_desde='disponible',
+            )
+            (aplicadas if ok else rechazadas).append({'route_id': route_id, 'truck_id': truck_id})
+        return aplicadas, rechazadas
+
+    return ejecutar_con_reintentos(aplicar)
+
+
+def _metodo_y_max_km(origen):
+    metodo = origen.get('metodo', 'auto')
+    if metodo not in ('auto', 'hungaro', 'voraz'):
+        raise ValueError('metodo')
+    max_km = origen.get('max_km')
+    return metodo, float(max_km) if max_km not in (None, '') else None
+
+
+@app.route('/despacho/auto')
+@login_required
+def despacho_auto():
+    """Vista previa (JSON) de la asignación automática; no modifica nada."""
+    if current_user.role != 'despachador':
+        return "No autorizado", 403
+    try:
+        metodo, max_km = _metodo_y_max_km(request.args)
+    except ValueError:
+        return "Parámetros inválidos (metodo: auto|hungaro|voraz; max_km: número)", 400
+    return jsonify(planificar_despacho(current_user.id, metodo, max_km))
+
+
+@app.route('/despacho/auto/trabajo', methods=['POST'])
+@login_required
+def despacho_auto_trabajo():
+    """Encola el cálculo de la propuesta (flotas grandes); el resultado es el mismo JSON de /despacho/auto."""
+    if current_user.role != 'despachador':
+        return "No autorizado", 403
+    try:
+        metodo, max_km = _metodo_y_max_km(request.get_json(silent=True) or request.form)
+    except ValueError:
+        return "Parámetros inválidos (metodo: auto|hungaro|voraz; max_km: número)", 400
+    return _trabajo_encolado(cola.encolar('planificar_despacho', {
+        'despachador_id': current_user.id, 'metodo': metodo, 'max_km': max_km}, current_user.id))
+
+
+@app.route('/despacho/auto/aplicar', methods=['POST'])
+@login_required
+def despacho_auto_aplicar():
+    """Aplica una propuesta: la enviada en JSON ({"asignaciones": [...]}) o una recalculada."""
+    if current_user.role != 'despachador':
+        return "No autorizado", 403
+    datos = request.get_json(silent=True)
+    if datos is not None:
+        try:
+            if not isinstance(datos, dict):
+                raise TypeError('se esperaba un objeto')
+            pares = [(int(a['route_id']), int(a['truck_id'])) for a in datos.get('asignaciones', [])]
+        except (KeyError, TypeError, ValueError, OverflowError):
+            return "Formato inválido: se espera {\"asignaciones\": [{\"route_id\", \"truck_id\"}]}", 400
+        aplicadas, rechazadas = aplicar_despacho(current_user.id, pares)
+        return jsonify({'aplicadas': aplicadas, 'rechazadas': rechazadas})
+
+    try:
+        metodo, max_km = _metodo_y_max_km(request.form)
+    except ValueError:
+        return "Parámetros inválidos", 400
+    plan = planificar_despacho(current_user.id, metodo, max_km)
+    aplicadas, rechazadas = aplicar_despacho(
+        current_user.id, [(a['route_id'], a['truck_id']) for a in plan['asignaciones']])
+    if aplicadas:
+        flash(f"Se asignaron {len(aplicadas)} rutas ({plan['km_vacio_total']} km en vacío en total).", 'success')
+    else:
+        flash('No hay camiones libres con posición conocida o rutas pendientes para asignar.', 'error')
+    return redirect(url_for('dashboard_despachador'))
+
+
+# ======== ANALÍTICA DE CARRILES ========
+# Lecturas de LaneStat (ver "DURACIONES Y ETA POR CARRIL"): cuestan lo mismo
+# con mil o con un millón de rutas en el historial.
+MAX_CARRILES = 500
+
+
+@app.route('/analitica/carriles')
+@login_required
+def analitica_carriles():
+    """Duración (media, p50, p90, rango) y % a tiempo por carril, de más a menos viajes.
+
+    Filtros: ?origin= / ?destination= (nombre de ciudad), ?min_n= (viajes mínimos), ?limit=.
+    """
+    if current_user.role not in ('admin', 'despachador'):
+        return "No autorizado", 403
+    consulta = (db.select(LaneStat).where(LaneStat.n >= (_entero_arg('min_n') or 1))
+                .order_by(LaneStat.n.desc(), LaneStat.origin_city_id, LaneStat.destination_city_id)
+                .limit(min(_entero_arg('limit') or 100, MAX_CARRILES)))
+    for nombre, columna in (('origin', LaneStat.origin_city_id), ('destination', LaneStat.destination_city_id)):
+        if request.args.get(nombre):
+            city_id = indice_ciudades.resolver(request.args[nombre])
+            if city_id is None:
+                return jsonify({'error': f'ciudad desconocida: {request.args[nombre]}'}), 400
+            consulta = consulta.where(columna == city_id)
+
+    carriles = []
+    for fila in db.session.execute(consulta).scalars():
+        origen = indice_ciudades.por_id.get(fila.origin_city_id)
+        destino = indice_ciudades.por_id.get(fila.destination_city_id)
+        km = _km_carril(fila.origin_city_id, fila.destination_city_id)
+        carriles.append({
+            'origin': origen.nombre if origen else None,
+            'destination': destino.nombre if destino else None,
+            'km': round(km, 1) if km is not None else None,
+            'plazo_min': round(float(analitica.plazo_s(km)) / 60, 1) if km is not None else None,
+            **analitica.resumen(_agregados_de(fila)),
+        })
+    return jsonify({'carriles': carriles})
+
+
+@app.route('/analitica/eta')
+@login_required
+def analitica_eta():
+    """ETA de las rutas en curso: las de su flota (despachador) o las de ?ids=1,2,3 (admin)."""
+    if current_user.role not in ('admin', 'despachador'):
+        return "No autorizado", 403
+    texto = request.args.get('ids', '').strip()
+    ids = [int(i) for i in texto.split(',') if i.strip().isdigit()] if texto else None
+    if current_user.role == 'admin' and not ids:
+        return jsonify({'error': 'Falta ?ids='}), 400
+    if ids is not None and len(ids) > MAX_IDS_MASIVO:
+        return jsonify({'error': f'Máximo {MAX_IDS_MASIVO} ids'}), 413
+
+    consulta = db.select(Route.id, Route.origin_city_id, Route.destination_city_id, Route.start_time) \
+        .where(Route.status.in_(ESTADOS_CON_CAMION))
+    if current_user.role == 'despachador':
+        consulta = consulta.join(Truck, Route.truck_id == Truck.id).where(Truck.dispatcher_id == current_user.id)
+    if ids is not None:
+        consulta = consulta.where(Route.id.in_(ids))
+    etas = eta_rutas(db.session.execute(consulta).all())
+    return jsonify({'etas': {str(route_id): eta for route_id, eta in etas.items()}})
+
+
+# ======== CACHÉ HTTP Y COMPRESIÓN ========
+# Los mapas sondean cada pocos segundos y casi siempre nada cambió para ese
+# usuario. La versión de sus datos (eventos.Versiones) sale de memoria, así que
+# un sondeo sin cambios responde 304 sin recorrer rutas ni serializar JSON.
+MIN_BYTES_COMPRIMIR = 1024
+TIPOS_COMPRIMIBLES = ('application/json', 'text/html', 'text/csv', 'application/octet-stream')
+
+try:
+    import brotli
+except ImportError:  # opcional: sin él se usa solo gzip
+    brotli = None
+
+
+def _con_version(generar, ve_todo=False):
+    """Respuesta condicional (ETag / Last-Modified) con los datos que ve el usuario actual.
+
+    `generar()` arma la respuesta completa y solo se llama si algo cambió. La
+    versión se lee antes de consultar los datos: si algo cambia entre medio, el
+    cuerpo sale más nuevo que su ETag y el próximo sondeo lo vuelve a traer
+    (al revés nunca: un ETag no puede adelantarse a su cuerpo).
+    """
+    versiones.sincronizar(cursor_actual())
+    etag, modificado = versiones.de(current_user.id, ve_todo)
+    etag = f'{etag}.{zlib.crc32(request.query_string):08x}'
+    segundo = int(modificado)
+    if request.if_none_match:
+        vigente = request.if_none_match.contains_weak(etag)
+    else:
+        vigente = request.if_modified_since is not None and segundo <= request.if_modified_since.timestamp()
+    respuesta = Response(status=304) if vigente else app.make_response(generar())
+    if respuesta.status_code in (200, 304):
+        respuesta.set_etag(etag, weak=True)
+        # Last-Modified tiene resolución de 1 s: solo se envía cuando ese segundo ya
+        # terminó, así un cambio posterior nunca cae en el mismo segundo
+        if time.time() >= segundo + 1:
+            respuesta.last_modified = segundo
+        respuesta.headers['Cache-Control'] = 'private, no-cache'
+    return respuesta
+
+
+@app.after_request
+def comprimir_respuesta(response):
+    """gzip (o brotli, si está instalado) para respuestas grandes que no van en streaming."""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in TIPOS_COMPRIMIBLES):
+        return response
+    response.vary.add('Accept-Encoding')
+    aceptadas = request.accept_encodings
+    codificacion = 'br' if brotli is not None and aceptadas['br'] else 'gzip' if aceptadas['gzip'] else None
+    if codificacion is None:
+        return response
+    datos = response.get_data()
+    if len(datos) < MIN_BYTES_COMPRIMIR:
+        return response
+    if codificacion == 'br':
+        datos = brotli.compress(datos, quality=5)
+    else:
+        compresor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: formato gzip
+        datos = compresor.compress(datos) + compresor.flush()
+    response.set_data(datos)
+    response.headers['Content-Encoding'] = codificacion
+    return response
+
+
+# Rutas que se dibujan en la ciudad de origen / en la de destino
+ESTADOS_EN_ORIGEN = ["pendiente", "en_progreso", "en curso", "en ruta"]
+ESTADOS_EN_DESTINO = ["completada", "finalizada"]
+
+
+_MASCARA_64 = (1 << 64) - 1
+
+
+def _desplazamiento(route_id, jitter):
+    """Desplazamiento (dlat, dlon) en [-jitter, jitter) fijo para cada ruta.
+
+    Hash splitmix64 del id: rutas de la misma ciudad quedan repartidas, pero
+    cada una siempre en el mismo lugar, así dos sondeos sin cambios dan el
+    mismo JSON (y el mismo ETag).
+    """
+    z = (route_id + 0x9E3779B97F4A7C15) & _MASCARA_64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASCARA_64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASCARA_64
+    z ^= z >> 31
+    return ((z & 0xFFFFFFFF) / 2 ** 31 - 1) * jitter, ((z >> 32) / 2 ** 31 - 1) * jitter
+
+
+def _punto_marcador(route_id, status, origin_city_id, destination_city_id, origin, destination, jitter,
+                    vivo=None):
+    """Posición del marcador de una ruta, o None si la ruta no se dibuja en el mapa.
+
+    `vivo` es el último ping GPS de la ruta (lat, lon, ts); si existe, manda sobre
+    la posición simulada en la ciudad de origen.
+    """
+    status = (status or '').lower()
+    if status in ESTADOS_EN_ORIGEN and status != "pendiente" and vivo is not None:
+        return [vivo[0], vivo[1]]
+    if status in ESTADOS_EN_ORIGEN:
+        coords = indice_ciudades.coords_de(origin_city_id, origin)
+        if not coords:
+            return None
+        dlat, dlon = _desplazamiento(route_id, jitter)
+        return [coords[0] + dlat, coords[1] + dlon]
+    if status in ESTADOS_EN_DESTINO:
+        return indice_ciudades.coords_de(destination_city_id, destination)
+    return None
+
+
+def _rutas_cambiadas(since):
+    """Ids de rutas modificadas (ellas o su camión) después del cursor `since`.
+
+    Son dos rangos sobre índices de change_seq, así que el costo depende de
+    cuántos cambios hubo y no del tamaño de la tabla.
+    """
+    return db.union(
+        db.select(Route.id).where(Route.change_seq > since),
+        db.select(Route.id).join(Truck, Route.truck_id == Truck.id).where(Truck.change_seq > since),
+    )
+
+
+def _leer_since():
+    """Cursor del modo delta (`?since=N`); None si el cliente pide la lista completa."""
+    return request.args.get('since', type=int)
+
+
+def _respuesta_mapa(marcadores, since, cursor, quitados, user_id=None, extra=None):
+    """Lista completa (modo clásico) o sobre delta {cursor, upserts, removed, full}.
+
+    En delta, `removed` suma los Tombstone de rutas: las que salieron de lo que
+    ve `user_id` o, sin usuario (mapa admin), las borradas. `extra` se agrega
+    al sobre (p. ej. el zoom del viewport).
+    """
+    if since is None:
+        return jsonify(marcadores)
+    if since > 0:
+        quitados = quitados + [
+            entity_id for (entity_id,) in db.session.query(Tombstone.entity_id)
+            .filter(Tombstone.entity == 'route', Tombstone.user_id.is_(None) if user_id is None
+                    else Tombstone.user_id == user_id, Tombstone.change_seq > since)
+        ]
+    # Una ruta que salió y volvió dentro del mismo delta se actualiza, no se quita
+    return jsonify({
+        "cursor": cursor,
+        "full": since <= 0,
+        "upserts": marcadores,
+        "removed": sorted(set(quitados) - {m['route_id'] for m in marcadores}),
+        **(extra or {}),
+    })
+
+
 @app.route("/mapa_data")
 @login_required
 def mapa_data():
+    """Marcadores de las rutas del camión del chofer actual.
+
+    Con `?since=<cursor>` devuelve solo lo que cambió desde ese cursor.
+    Responde 304 si nada cambió para el chofer (ver `_con_version`).
+    """
+    return _con_version(_mapa_chofer)
+
+
+def _mapa_chofer():
     camiones = []
+    since = _leer_since()
+    cursor = cursor_actual() if since is not None else None
 
-    # Obtener el camión del chofer actual
-    truck = Truck.query.filter_by(driver_id=current_user.id).first()
+    # Camión del chofer actual (viene con la identidad del usuario, sin consulta)
+    truck = current_user.camion
     if not truck:
-        return jsonify(camiones)
-
-    rutas = Route.query.filter_by(truck_id=truck.id).all()
-
-    ciudades_coords = {
-        "Santiago": [-33.4489, -70.6693],
-        "Valparaíso": [-33.0472, -71.6127],
-        "Concepción": [-36.8201, -73.0444],
-        "Antofagasta": [-23.6509, -70.3975],
-        "La Serena": [-29.9027, -71.2520],
-        "Rancagua": [-34.1701, -70.7447],
-        "Temuco": [-38.7397, -72.5984],
-        "Puerto Montt": [-41.4717, -72.9369],
-        "Valdivia": [-39.8196, -73.2459],
-        "Arica": [-18.4783, -70.3126]
-    }
-
-    for ruta in rutas:
-        status = (ruta.status or '').lower()
-        if status in ["pendiente", "en_progreso", "en curso", "en ruta"]:
-            ciudad = ruta.origin
-            coords = ciudades_coords.get(ciudad)
-            if coords:
-                jitter = [random.uniform(-0.2, 0.2), random.uniform(-0.2, 0.2)]
-                point = [coords[0] + jitter[0], coords[1] + jitter[1]]
-            else:
-                continue
-        elif status in ["completada", "finalizada"]:
-            ciudad = ruta.destination
-            coords = ciudades_coords.get(ciudad)
-            if coords:
-                point = coords
-            else:
-                continue
-        else:
+        # Lo que dejó de ver (p. ej. le quitaron el camión) llega por los Tombstone
+        return _respuesta_mapa(camiones, since, cursor, [], current_user.id)
+
+    vivo = posiciones_al_dia()
+    query = db.session.query(
+        Route.id, Route.origin, Route.destination, Route.status,
+        Route.origin_city_id, Route.destination_city_id
+    ).filter(Route.truck_id == truck.id)
+    if since is not None and since > 0:
+        # Las rutas que dejaron de ser del camión llegan por los Tombstone del chofer
+        query = query.filter(Route.id.in_(_rutas_cambiadas(since)))
+
+    quitados = []
+    for route_id, origin, destination, status, origin_city_id, destination_city_id in query.all():
+        point = _punto_marcador(route_id, status, origin_city_id, destination_city_id, origin, destination, 0.2,
+                                vivo.de_ruta(route_id))
+        if point is None:
+            quitados.append(route_id)
             continue
 
         camiones.append({
             "plate": truck.plate,
-            "status": ruta.status,
+            "status": status,
             "coords": point,
-            "route_id": ruta.id
+            "route_id": route_id
         })
 
-    return jsonify(camiones)
+    return _respuesta_mapa(camiones, since, cursor, quitados, current_user.id)
 
 
 @app.route("/mapa")
@@ -328,59 +1973,58 @@ def mapa():
 @app.route("/mapa_despachador_data")
 @login_required
 def mapa_despachador_data():
-    """Devuelve marcadores para todas las rutas de la flota del despachador actual."""
-    camiones = []
-    if current_user.role != 'despachador':
-        return jsonify(camiones)
+    """Devuelve marcadores para todas las rutas de la flota del despachador actual.
 
-    # Obtener todos los camiones del despachador
-    trucks = Truck.query.filter_by(dispatcher_id=current_user.id).all()
+    Con `?since=<cursor>` devuelve solo lo que cambió desde ese cursor.
+    Responde 304 si nada cambió en la flota (ver `_con_version`).
+    """
+    if current_user.role != 'despachador':
+        return jsonify([])
+    return _con_version(_mapa_flota)
 
-    ciudades_coords = {
-        "Santiago": [-33.4489, -70.6693],
-        "Valparaíso": [-33.0472, -71.6127],
-        "Concepción": [-36.8201, -73.0444],
-        "Antofagasta": [-23.6509, -70.3975],
-        "La Serena": [-29.9027, -71.2520],
-        "Rancagua": [-34.1701, -70.7447],
-        "Temuco": [-38.7397, -72.5984],
-        "Puerto Montt": [-41.4717, -72.9369],
-        "Valdivia": [-39.8196, -73.2459],
-        "Arica": [-18.4783, -70.3126]
-    }
 
-    for truck in trucks:
-        routes = Route.query.filter_by(truck_id=truck.id).all()
-        for ruta in routes:
-            status = (ruta.status or '').lower()
-            if status in ["pendiente", "en_progreso", "en curso", "en ruta"]:
-                ciudad = ruta.origin
-                coords = ciudades_coords.get(ciudad)
-                if coords:
-                    jitter = [random.uniform(-0.2, 0.2), random.uniform(-0.2, 0.2)]
-                    point = [coords[0] + jitter[0], coords[1] + jitter[1]]
-                else:
-                    continue
-            elif status in ["completada", "finalizada"]:
-                ciudad = ruta.destination
-                coords = ciudades_coords.get(ciudad)
-                if coords:
-                    point = coords
-                else:
-                    continue
-            else:
-                continue
+def _mapa_flota():
+    camiones = []
+    since = _leer_since()
+    cursor = cursor_actual() if since is not None else None
+    vivo = posiciones_al_dia()
+
+    # Una sola consulta para toda la flota: rutas + camión + chofer, solo las
+    # columnas que usa el mapa (evita una query por camión y el lazy-load de driver)
+    query = (
+        db.session.query(
+            Route.id, Route.origin, Route.destination, Route.status,
+            Route.origin_city_id, Route.destination_city_id,
+            Truck.plate, Truck.cargo, User.username
+        )
+        .join(Truck, Route.truck_id == Truck.id)
+        .outerjoin(User, Truck.driver_id == User.id)
+        .filter(Truck.dispatcher_id == current_user.id)
+    )
+    if since is not None and since > 0:
+        # Las rutas que salieron de la flota llegan por los Tombstone del despachador
+        query = query.filter(Route.id.in_(_rutas_cambiadas(since)))
+    filas = query.order_by(Truck.id, Route.id).all()
+
+    quitados = []
+    for (route_id, origin, destination, status, origin_city_id, destination_city_id,
+         plate, cargo, driver) in filas:
+        point = _punto_marcador(route_id, status, origin_city_id, destination_city_id, origin, destination, 0.2,
+                                vivo.de_ruta(route_id))
+        if point is None:
+            quitados.append(route_id)
+            continue
 
-            camiones.append({
-                "plate": truck.plate,
-                "driver": truck.driver.username if truck.driver else None,
-                "cargo": truck.cargo,
-                "status": ruta.status,
-                "coords": point,
-                "route_id": ruta.id
-            })
+        camiones.append({
+            "plate": plate,
+            "driver": driver,
+            "cargo": cargo,
+            "status": status,
+            "coords": point,
+            "route_id": route_id
+        })
 
-    return jsonify(camiones)
+    return _respuesta_mapa(camiones, since, cursor, quitados, current_user.id)
 
 
 @app.route("/mapa_despachador")
@@ -397,25 +2041,24 @@ def dashboard_admin():
     if current_user.role != 'admin':
         return "No autorizado", 403
 
-    total_trucks = Truck.query.count()
-    total_drivers = User.query.filter_by(role='chofer').count()
-    total_dispatchers = User.query.filter_by(role='despachador').count()
-    total_routes = Route.query.count()
+    # Todos los KPIs salen de una sola lectura de la tabla Stat
+    stats = leer_stats()
+    total_trucks = stats.get('trucks', 0)
+    total_drivers = stats.get('users:chofer', 0)
+    total_dispatchers = stats.get('users:despachador', 0)
+    total_routes = stats.get('routes', 0)
+    truck_status_data = {
+        k.split(':', 1)[1]: v for k, v in stats.items() if k.startswith('truck_status:') and v
+    }
+    route_status_data = {
+        k.split(':', 1)[1]: v for k, v in stats.items() if k.startswith('route_status:') and v
+    }
 
     recent_trucks = Truck.query.order_by(Truck.id.desc()).limit(5).all()
-    recent_routes = Route.query.order_by(Route.id.desc()).limit(5).all()
-
-    truck_status_counts = (
-        db.session.query(Truck.status, db.func.count(Truck.id))
-        .group_by(Truck.status).all()
-    )
-    truck_status_data = {status: count for status, count in truck_status_counts}
-
-    route_status_counts = (
-        db.session.query(Route.status, db.func.count(Route.id))
-        .group_by(Route.status).all()
+    recent_routes = (
+        Route.query.options(db.joinedload(Route.truck))
+        .order_by(Route.id.desc()).limit(5).all()
     )
-    route_status_data = {status: count for status, count in route_status_counts}
 
     recent_activity = []
     for t in recent_trucks:
@@ -454,68 +2097,332 @@ def mapa_admin():
     return render_template('mapa_admin.html')
 
 
+ZOOM_DETALLE = 9  # desde este zoom se envían marcadores; antes, clusters
+MAX_MARCADORES_VIEWPORT = 5000
+
+
+def _leer_viewport():
+    """(bbox, zoom) desde `?bbox=sur,oeste,norte,este&zoom=z`; None si no vienen."""
+    texto = request.args.get('bbox')
+    if not texto:
+        return None
+    partes = texto.split(',')
+    if len(partes) != 4:
+        raise ValueError('bbox debe ser sur,oeste,norte,este')
+    sur, oeste, norte, este = (float(p) for p in partes)
+    if sur > norte or oeste > este:
+        raise ValueError('bbox invertido')
+    return (sur, oeste, norte, este), request.args.get('zoom', type=int, default=ZOOM_DETALLE)
+
+
+def _filtro_ancla_en(city_ids):
+    """Rutas cuyo marcador cae (por ciudad) en alguna de `city_ids`; usa los índices de city_id."""
+    return db.or_(
+        db.and_(Route.status.in_(ESTADOS_EN_ORIGEN), Route.origin_city_id.in_(city_ids)),
+        db.and_(Route.status.in_(ESTADOS_EN_DESTINO), Route.destination_city_id.in_(city_ids)),
+    )
+
+
+def _clusters_viewport(bbox, zoom):
+    """Conteo de rutas por celda: un GROUP BY por ciudad, sin traer filas."""
+    city_ids = indice_ciudades.en_bbox(bbox)
+    if not city_ids:
+        return []
+    ancla = db.case(
+        (Route.status.in_(ESTADOS_EN_ORIGEN), Route.origin_city_id),
+        else_=Route.destination_city_id,
+    )
+    conteos = (
+        db.session.query(ancla, db.func.count(Route.id))
+        .filter(_filtro_ancla_en(city_ids))
+        .group_by(ancla)
+    )
+    puntos = []
+    for city_id, n in conteos:
+        ciudad = indice_ciudades.por_id.get(city_id)
+        if ciudad:
+            puntos.append((ciudad.lat, ciudad.lon, n))
+    # ~64px por celda en coordenadas de Leaflet
+    return agrupar(puntos, tam=90.0 / (2 ** max(zoom, 0)))
+
+
+def _marcadores_viewport(bbox, vivo):
+    """Marcadores dentro del bbox: por ciudad (grilla de ciudades) o por GPS (grilla en vivo)."""
+    city_ids = indice_ciudades.en_bbox(bbox)
+    vivos = vivo.rutas_en_bbox(bbox)[:MAX_MARCADORES_VIEWPORT]
+    condiciones = []
+    if city_ids:
+        condiciones.append(_filtro_ancla_en(city_ids))
+    if vivos:
+        condiciones.append(Route.id.in_(vivos))
+    if not condiciones:
+        return [], False
+
+    filas = _consulta_admin().filter(db.or_(*condiciones)).order_by(Route.id) \
+        .limit(MAX_MARCADORES_VIEWPORT + 1).all()
+    recortado = len(filas) > MAX_MARCADORES_VIEWPORT
+    marcadores, _ = _marcadores_admin(filas[:MAX_MARCADORES_VIEWPORT], vivo, bbox)
+    return marcadores, recortado
+
+
+def _cambios_viewport(bbox, vivo, since):
+    """(upserts, quitados) del bbox desde el cursor `since`; None si cambiaron más
+    rutas que MAX_MARCADORES_VIEWPORT (sale más barato mandar el viewport entero).
+
+    Las rutas que cambiaron y no quedan dentro del bbox van en quitados: el
+    cliente borra las que tenía dibujadas.
+    """
+    filas = _consulta_admin().filter(Route.id.in_(_rutas_cambiadas(since))) \
+        .limit(MAX_MARCADORES_VIEWPORT + 1).all()
+    if len(filas) > MAX_MARCADORES_VIEWPORT:
+        return None
+    return _marcadores_admin(filas, vivo, bbox)
+
+
+def _consulta_admin():
+    """Columnas de los marcadores del mapa admin (rutas con la patente de su camión)."""
+    return db.session.query(
+        Route.id, Route.origin, Route.destination, Route.status,
+        Route.origin_city_id, Route.destination_city_id, Truck.plate
+    ).outerjoin(Truck, Route.truck_id == Truck.id)
+
+
+def _marcadores_admin(filas, vivo, bbox=None):
+    """(marcadores, ids que no se dibujan o caen fuera de `bbox`) de filas de `_consulta_admin`."""
+    marcadores, fuera = [], []
+    for route_id, origin, destination, status, origin_city_id, destination_city_id, plate in filas:
+        point = _punto_marcador(route_id, status, origin_city_id, destination_city_id, origin, destination, 0.3,
+                                vivo.de_ruta(route_id))
+        if point is None or (bbox is not None and not dentro(bbox, point[0], point[1])):
+            fuera.append(route_id)
+            continue
+        marcadores.append({
+            'route_id': route_id,
+            'origin': origin,
+            'destination': destination,
+            'status': status,
+            'truck_plate': plate,
+            'coords': point
+        })
+    return marcadores, fuera
+
+
 @app.route('/mapa_admin_data')
 @login_required
 def mapa_admin_data():
-    """Devuelve marcadores para todas las rutas en la DB (para el admin)."""
+    """Devuelve marcadores para todas las rutas en la DB (para el admin).
+
+    Con `?since=<cursor>` solo lee y devuelve las rutas que cambiaron desde ese
+    cursor; junto con `bbox` (desde ZOOM_DETALLE), solo las del viewport.
+    Con `?vivo=1` devuelve solo las últimas posiciones GPS en columnas, desde memoria.
+    Con `?bbox=sur,oeste,norte,este&zoom=z` devuelve solo lo visible: clusters
+    (conteo por celda) con zoom bajo y marcadores desde ZOOM_DETALLE.
+    Responde 304 si nada cambió desde el último sondeo (ver `_con_version`).
+    """
     if current_user.role != 'admin':
         return jsonify([])
+    return _con_version(_mapa_admin, ve_todo=True)
 
-    camiones = []
-    ciudades_coords = {
-        "Santiago": [-33.4489, -70.6693],
-        "Valparaíso": [-33.0472, -71.6127],
-        "Concepción": [-36.8201, -73.0444],
-        "Antofagasta": [-23.6509, -70.3975],
-        "La Serena": [-29.9027, -71.2520],
-        "Rancagua": [-34.1701, -70.7447],
-        "Temuco": [-38.7397, -72.5984],
-        "Puerto Montt": [-41.4717, -72.9369],
-        "Valdivia": [-39.8196, -73.2459],
-        "Arica": [-18.4783, -70.3126]
+
+def _mapa_admin():
+    vivo = posiciones_en_vivo()
+    if request.args.get('vivo'):
+        # Solo posiciones GPS, en columnas y directo desde memoria (sin SQL)
+        return jsonify(vivo.columnas())
+
+    try:
+        viewport = _leer_viewport()
+    except ValueError as e:
+        return jsonify({"error": f"bbox inválido: {e}"}), 400
+    since = _leer_since()
+    if viewport is not None:
+        bbox, zoom = viewport
+        cursor = cursor_actual()
+        if zoom < ZOOM_DETALLE:
+            return jsonify({"cursor": cursor, "zoom": zoom, "clusters": _clusters_viewport(bbox, zoom)})
+        if since is not None and since > 0:
+            # Delta dentro del viewport: lo que cambió en él, más lo que salió o se borró
+            cambios = _cambios_viewport(bbox, posiciones_al_dia(), since)
+            if cambios is not None:
+                upserts, quitados = cambios
+                return _respuesta_mapa(upserts, since, cursor, quitados, extra={"zoom": zoom})
+        marcadores, recortado = _marcadores_viewport(bbox, vivo)
+        return jsonify({"cursor": cursor, "zoom": zoom, "markers": marcadores, "truncated": recortado})
+
+    cursor = cursor_actual() if since is not None else None
+    query = _consulta_admin()
+    if since is not None and since > 0:
+        query = query.filter(Route.id.in_(_rutas_cambiadas(since)))
+    camiones, quitados = _marcadores_admin(query.all(), vivo)
+    return _respuesta_mapa(camiones, since, cursor, quitados)
+
+
+# Cada stream abierto ocupa un hilo del worker mientras dure (gthread). Con más
+# de MAPA_STREAM_MAX por proceso se responde 503 y el mapa sondea con ETag; un
+# stream se corta a los MAPA_STREAM_DURACION_S y el navegador se reconecta, así
+# los cupos rotan y un worker no queda tomado para siempre.
+MAX_STREAMS = int(os.environ.get('MAPA_STREAM_MAX', 4))
+DURACION_STREAM_S = float(os.environ.get('MAPA_STREAM_DURACION_S', 300))
+
+
+@app.route('/mapa_stream')
+@login_required
+def mapa_stream():
+    """Server-Sent Events: avisa al mapa cuando cambió algo visible para el usuario.
+
+    El aviso solo trae el nuevo cursor; el cliente pide el delta (`?since=`) a su
+    endpoint de datos. Cada 15s se envía un ping y, si la secuencia de la DB
+    avanzó por escrituras de otro proceso, un aviso igual. Sin cupo responde 503
+    (EventSource no reintenta y el mapa pasa a sondear).
+    """
+    sub = broker.suscribir(current_user.id, ve_todo=current_user.role == 'admin', maximo=MAX_STREAMS)
+    if sub is None:
+        return Response("Sin cupo para avisos en vivo: usar sondeo", status=503, headers={'Retry-After': '60'})
+    engine = db.engine
+    tabla = SyncCounter.__table__
+
+    def leer_cursor():
+        with engine.connect() as conn:
+            return conn.execute(
+                db.select(tabla.c.value).where(tabla.c.name == 'cambios')
+            ).scalar() or 0
+
+    def generar():
+        ultimo = leer_cursor()
+        fin = time.monotonic() + DURACION_STREAM_S
+        try:
+            yield f"retry: 5000\nevent: cursor\ndata: {json.dumps({'seq': ultimo})}\n\n"
+            while time.monotonic() < fin:
+                evento = sub.esperar(timeout=min(15, max(0.0, fin - time.monotonic())))
+                if evento is None:
+                    actual = leer_cursor()
+                    if actual <= ultimo:
+                        yield ": ping\n\n"
+                        continue
+                    evento = {'seq': actual, 'routes': [], 'trucks': []}
+                ultimo = max(ultimo, evento['seq'])
+                datos = {k: evento[k] for k in ('seq', 'routes', 'trucks')}
+                yield f"id: {evento['seq']}\nevent: cambio\ndata: {json.dumps(datos)}\n\n"
+        finally:
+            broker.desuscribir(sub)
+
+    respuesta = Response(generar(), mimetype='text/event-stream',
+                         headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Si el cliente se va antes de la primera lectura el generador nunca corre su finally
+    respuesta.call_on_close(lambda: broker.desuscribir(sub))
+    return respuesta
+
+
+### Admin CRUD: Trucks
+# ======== LISTADOS ADMIN: PAGINACIÓN POR CURSOR ========
+# Paginación keyset sobre el id: `WHERE id < :after ORDER BY id DESC LIMIT n`
+# cuesta lo mismo en la página 1 que en la 5000 (OFFSET recorre todo lo saltado).
+# Cada filtro tiene un índice cuya cola implícita es el id, así que SQLite
+# resuelve filtro + orden + límite con el índice, sin ordenar en memoria.
+POR_PAGINA = 50
+MAX_POR_PAGINA = 500
+
+
+def _entero_arg(nombre, args=None):
+    valor = str((request.args if args is None else args).get(nombre, '')).strip()
+    return int(valor) if valor.isdigit() else None
+
+
+def _paginar(query, columna_id):
+    """Aplica ?after=/?before= (ids), ?orden=desc|asc y ?limit=; devuelve (filas, pagina)."""
+    limite = min(_entero_arg('limit') or POR_PAGINA, MAX_POR_PAGINA)
+    orden = 'asc' if request.args.get('orden') == 'asc' else 'desc'
+    after, before = _entero_arg('after'), _entero_arg('before')
+    # `siguiente(x)`: filas que van después de x en el orden pedido
+    siguiente = (lambda x: columna_id > x) if orden == 'asc' else (lambda x: columna_id < x)
+    anterior = (lambda x: columna_id < x) if orden == 'asc' else (lambda x: columna_id > x)
+    ascendente, descendente = columna_id.asc(), columna_id.desc()
+
+    if before is not None:
+        # Página anterior: se lee hacia atrás y se invierte
+        filas = (query.filter(anterior(before))
+                 .order_by(descendente if orden == 'asc' else ascendente)
+                 .limit(limite + 1).all())
+        hay_mas_atras = len(filas) > limite
+        filas = filas[:limite][::-1]
+        hay_mas_adelante = True
+    else:
+        if after is not None:
+            query = query.filter(siguiente(after))
+        filas = query.order_by(ascendente if orden == 'asc' else descendente).limit(limite + 1).all()
+        hay_mas_adelante = len(filas) > limite
+        filas = filas[:limite]
+        hay_mas_atras = after is not None
+
+    pagina = {
+        'limit': limite,
+        'orden': orden,
+        'next': filas[-1].id if filas and hay_mas_adelante else None,
+        'prev': filas[0].id if filas and hay_mas_atras else None,
     }
+    return filas, pagina
 
-    routes = Route.query.all()
-    for ruta in routes:
-        status = (ruta.status or '').lower()
-        if status in ["pendiente", "en_progreso", "en curso", "en ruta"]:
-            ciudad = ruta.origin
-            coords = ciudades_coords.get(ciudad)
-            if coords:
-                jitter = [random.uniform(-0.3, 0.3), random.uniform(-0.3, 0.3)]
-                point = [coords[0] + jitter[0], coords[1] + jitter[1]]
-            else:
-                continue
-        elif status in ["completada", "finalizada"]:
-            ciudad = ruta.destination
-            coords = ciudades_coords.get(ciudad)
-            if coords:
-                point = coords
-            else:
-                continue
-        else:
-            continue
 
-        camiones.append({
-            'route_id': ruta.id,
-            'origin': ruta.origin,
-            'destination': ruta.destination,
-            'status': ruta.status,
-            'truck_plate': ruta.truck.plate if ruta.truck else None,
-            'coords': point
-        })
+def _filtros_activos(nombres):
+    """Filtros no vacíos de la query string, para repetirlos en los links de página."""
+    return {n: request.args[n] for n in nombres if request.args.get(n, '').strip()}
 
-    return jsonify(camiones)
+
+FILTROS_CAMIONES = ('status', 'dispatcher_id', 'driver_id', 'plate', 'orden', 'limit')
+
+
+def _camiones_filtrados():
+    query = Truck.query.options(db.joinedload(Truck.driver), db.joinedload(Truck.dispatcher))
+    if request.args.get('status'):
+        query = query.filter(Truck.status == request.args['status'])
+    if _entero_arg('dispatcher_id') is not None:
+        query = query.filter(Truck.dispatcher_id == _entero_arg('dispatcher_id'))
+    if _entero_arg('driver_id') is not None:
+        query = query.filter(Truck.driver_id == _entero_arg('driver_id'))
+    if request.args.get('plate', '').strip():
+        query = query.filter(Truck.plate == request.args['plate'].strip().upper())
+    return _paginar(query, Truck.id)
+
+
+def _camion_json(t):
+    return {
+        'id': t.id,
+        'plate': t.plate,
+        'status': t.status,
+        'cargo': t.cargo,
+        'driver_id': t.driver_id,
+        'driver': t.driver.username if t.driver else None,
+        'dispatcher_id': t.dispatcher_id,
+        'dispatcher': t.dispatcher.username if t.dispatcher else None,
+    }
 
 
-### Admin CRUD: Trucks
 @app.route('/admin/trucks')
 @login_required
 def admin_trucks():
     if current_user.role != 'admin':
         return "No autorizado", 403
-    trucks = Truck.query.all()
-    return render_template('admin_trucks.html', trucks=trucks)
+    trucks, pagina = _camiones_filtrados()
+    filtros = _filtros_activos(FILTROS_CAMIONES)
+    total = leer_stats().get(f"truck_status:{filtros['status']}" if 'status' in filtros else 'trucks') \
+        if set(filtros) <= {'status', 'orden', 'limit'} else None
+    despachadores = User.query.filter_by(role='despachador').order_by(User.username).all()
+    return render_template('admin_trucks.html', trucks=trucks, pagina=pagina, filtros=filtros,
+                           total=total, despachadores=despachadores)
+
+
+@app.route('/admin/trucks_data')
+@login_required
+def admin_trucks_data():
+    """Variante JSON de /admin/trucks (mismos filtros y cursores)."""
+    if current_user.role != 'admin':
+        return "No autorizado", 403
+
+    def generar():
+        trucks, pagina = _camiones_filtrados()
+        return jsonify({'items': [_camion_json(t) for t in trucks], **pagina})
+
+    return _con_version(generar, ve_todo=True)
 
 
 @app.route('/admin/trucks/new', methods=['GET', 'POST'])
@@ -596,13 +2503,82 @@ def admin_truck_delete(truck_id):
 
 
 ### Admin CRUD: Routes
+FILTROS_RUTAS = ('status', 'origin', 'destination', 'truck', 'dispatcher_id', 'orden', 'limit')
+
+
+def _filtro_ciudad(columna_id, columna_texto, nombre):
+    """Por ciudad conocida usa el id indexado; si no, compara el texto tal cual."""
+    city_id = indice_ciudades.resolver(nombre)
+    return columna_id == city_id if city_id is not None else columna_texto == nombre
+
+
+def _condiciones_rutas(args):
+    """Condiciones SQL de los filtros de rutas (`args`: query string o dict del JSON)."""
+    condiciones = []
+    if args.get('status'):
+        condiciones.append(Route.status == args['status'])
+    if str(args.get('origin') or '').strip():
+        condiciones.append(_filtro_ciudad(Route.origin_city_id, Route.origin, args['origin'].strip()))
+    if str(args.get('destination') or '').strip():
+        condiciones.append(_filtro_ciudad(Route.destination_city_id, Route.destination,
+                                          args['destination'].strip()))
+    camion = str(args.get('truck') or '').strip()
+    if camion:
+        # Placa o id de camión
+        truck_id = int(camion) if camion.isdigit() else db.session.query(Truck.id).filter(
+            Truck.plate == camion.upper()).scalar()
+        condiciones.append(Route.truck_id == truck_id if truck_id else db.false())
+    dispatcher_id = _entero_arg('dispatcher_id', args)
+    if dispatcher_id is not None:
+        # IN (subconsulta) en vez de JOIN: recorre ix_route_truck_id por cada camión de la flota
+        condiciones.append(Route.truck_id.in_(db.select(Truck.id).where(Truck.dispatcher_id == dispatcher_id)))
+    return condiciones
+
+
+def _rutas_filtradas():
+    query = Route.query.options(db.joinedload(Route.truck)).filter(*_condiciones_rutas(request.args))
+    return _paginar(query, Route.id)
+
+
+def _ruta_json(r):
+    return {
+        'id': r.id,
+        'origin': r.origin,
+        'destination': r.destination,
+        'status': r.status,
+        'truck_id': r.truck_id,
+        'truck': r.truck.plate if r.truck else None,
+        'start_time': r.start_time.isoformat() if r.start_time else None,
+    }
+
+
 @app.route('/admin/routes')
 @login_required
 def admin_routes():
     if current_user.role != 'admin':
         return "No autorizado", 403
-    routes = Route.query.all()
-    return render_template('admin_routes.html', routes=routes)
+    routes, pagina = _rutas_filtradas()
+    filtros = _filtros_activos(FILTROS_RUTAS)
+    # El total solo sale gratis de los contadores cuando no hay más filtros que el estado
+    total = leer_stats().get(f"route_status:{filtros['status']}" if 'status' in filtros else 'routes') \
+        if set(filtros) <= {'status', 'orden', 'limit'} else None
+    despachadores = User.query.filter_by(role='despachador').order_by(User.username).all()
+    return render_template('admin_routes.html', routes=routes, pagina=pagina, filtros=filtros,
+                           total=total, despachadores=despachadores)
+
+
+@app.route('/admin/routes_data')
+@login_required
+def admin_routes_data():
+    """Variante JSON de /admin/routes (mismos filtros y cursores)."""
+    if current_user.role != 'admin':
+        return "No autorizado", 403
+
+    def generar():
+        routes, pagina = _rutas_filtradas()
+        return jsonify({'items': [_ruta_json(r) for r in routes], **pagina})
+
+    return _con_version(generar, ve_todo=True)
 
 
 @app.route('/admin/routes/new', methods=['GET', 'POST'])
@@ -664,13 +2640,1139 @@ def admin_route_delete(route_id):
     db.session.commit()
     return redirect(url_for('admin_routes'))
 
+# ======== EXPORTACIÓN ========
+# Volcados completos para facturación/analítica. Las filas se leen con
+# yield_per (cursor del lado del servidor en PostgreSQL; en SQLite el cursor ya
+# es incremental) y salen por un generador en bloques, así la memoria no crece
+# con el tamaño del export. Se usa una conexión propia y no la sesión del ORM.
+FILAS_POR_BLOQUE = 5000
+
+
+def _fecha_arg(nombre, args=None):
+    """?desde= / ?hasta= en ISO 8601 o epoch; ValueError si no se entiende."""
+    valor = str((request.args if args is None else args).get(nombre) or '').strip()
+    return _parsear_ts_texto(valor) if valor else None
+
+
+def _bloques_exportacion(stmt, columnas, formato, comprimir, al_leer=None):
+    """Genera el CSV/NDJSON de `stmt` en bloques de bytes; `al_leer(n)` tras cada bloque de filas."""
+    engine = db.engine
+
+    def valor_json(v):
+        return v.isoformat() if isinstance(v, datetime) else v
+
+    def bloques():
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer)
+        if formato == 'csv':
+            escritor.writerow(columnas)
+        with engine.connect() as conn:
+            resultado = conn.execution_options(yield_per=FILAS_POR_BLOQUE).execute(stmt)
+            for filas in resultado.partitions():
+                if al_leer is not None:
+                    al_leer(len(filas))
+                if formato == 'csv':
+                    escritor.writerows(filas)
+                else:
+                    for fila in filas:
+                        buffer.write(json.dumps(dict(zip(columnas, map(valor_json, fila))), ensure_ascii=False))
+                        buffer.write('\n')
+                yield buffer.getvalue().encode('utf-8')
+                buffer.seek(0)
+                buffer.truncate()
+        if formato == 'csv' and buffer.tell():
+            yield buffer.getvalue().encode('utf-8')
+
+    def comprimido(partes):
+        # wbits=31: formato gzip (cabecera + crc), lo abre cualquier gunzip
+        compresor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for parte in partes:
+            salida = compresor.compress(parte)
+            if salida:
+                yield salida
+        yield compresor.flush()
+
+    return comprimido(bloques()) if comprimir else bloques()
+
+
+def _nombre_exportacion(nombre, formato, comprimir):
+    extension = 'csv' if formato == 'csv' else 'ndjson'
+    return f"{nombre}-{datetime.utcnow():%Y%m%d-%H%M%S}.{extension}" + ('.gz' if comprimir else '')
+
+
+def _tipo_exportacion(formato, comprimir):
+    if comprimir:
+        return 'application/gzip'
+    return 'text/csv' if formato == 'csv' else 'application/x-ndjson'
+
+
+def _exportar(stmt, columnas, nombre):
+    """Respuesta en streaming de `stmt` como CSV o NDJSON (?formato=), con gzip opcional (?gzip=1)."""
+    formato = request.args.get('formato', 'csv')
+    if formato not in ('csv', 'ndjson'):
+        return "Formato no soportado (csv o ndjson)", 400
+    comprimir = request.args.get('gzip') == '1'
+    archivo = _nombre_exportacion(nombre, formato, comprimir)
+    return Response(_bloques_exportacion(stmt, columnas, formato, comprimir),
+                    mimetype=_tipo_exportacion(formato, comprimir),
+                    headers={'Content-Disposition': f'attachment; filename="{archivo}"',
+                             'X-Accel-Buffering': 'no'})
+
+
+def _consulta_export_rutas(args):
+    """(stmt, columnas) del export de rutas según los filtros de `args`; ValueError si una fecha no se entiende."""
+    desde, hasta = _fecha_arg('desde', args), _fecha_arg('hasta', args)
+    columnas = ['id', 'origin', 'destination', 'origin_city_id', 'destination_city_id',
+                'status', 'truck_id', 'plate', 'start_time', 'completed_at']
+    stmt = (
+        db.select(Route.id, Route.origin, Route.destination, Route.origin_city_id,
+                  Route.destination_city_id, Route.status, Route.truck_id, Truck.plate, Route.start_time,
+                  Route.completed_at)
+        .outerjoin(Truck, Route.truck_id == Truck.id)
+        .order_by(Route.id)
+    )
+    if args.get('status'):
+        stmt = stmt.where(Route.status == args['status'])
+    if desde is not None:
+        stmt = stmt.where(Route.start_time >= desde)
+    if hasta is not None:
+        stmt = stmt.where(Route.start_time < hasta)
+    return stmt, columnas
+
+
+def _consulta_export_tracking(args):
+    """(stmt, columnas) del export de tracking según los filtros de `args`."""
+    desde, hasta = _fecha_arg('desde', args), _fecha_arg('hasta', args)
+    columnas = ['id', 'route_id', 'timestamp', 'lat', 'lon', 'location']
+    stmt = db.select(Tracking.id, Tracking.route_id, Tracking.timestamp,
+                     Tracking.lat, Tracking.lon, Tracking.location)
+    if args.get('status'):
+        stmt = stmt.where(Tracking.route_id.in_(
+            db.select(Route.id).where(Route.status == args['status'])))
+    if _entero_arg('route_id', args) is not None:
+        # ix_tracking_route_ts resuelve ruta + rango de fechas y ya viene ordenado
+        stmt = stmt.where(Tracking.route_id == _entero_arg('route_id', args)).order_by(Tracking.timestamp)
+    else:
+        stmt = stmt.order_by(Tracking.id)
+    if desde is not None:
+        stmt = stmt.where(Tracking.timestamp >= desde)
+    if hasta is not None:
+        stmt = stmt.where(Tracking.timestamp < hasta)
+    return stmt, columnas
+
+
+# nombre en la URL -> (consulta, prefijo del archivo)
+EXPORTACIONES = {
+    'routes': (_consulta_export_rutas, 'rutas'),
+    'tracking': (_consulta_export_tracking, 'tracking'),
+}
+
+
+@app.route('/admin/export/<que>', methods=['GET', 'POST'])
+@login_required
+def admin_export(que):
+    """Export en streaming (GET) o encolado como trabajo (POST, mismos parámetros en la URL).
+
+    routes: rutas con la placa de su camión; filtros ?status=, ?desde=/?hasta= sobre start_time.
+    tracking: historial GPS; filtros ?desde=/?hasta= sobre timestamp, ?route_id=, ?status= (de la ruta).
+    """
+    if current_user.role != 'admin':
+        return "No autorizado", 403
+    if que not in EXPORTACIONES:
+        return "Export desconocido (routes o tracking)", 404
+    consulta, nombre = EXPORTACIONES[que]
+    try:
+        stmt, columnas = consulta(request.args)
+    except ValueError:
+        return "Fecha inválida (usar ISO 8601 o epoch)", 400
+    if request.method == 'POST':
+        if request.args.get('formato', 'csv') not in ('csv', 'ndjson'):
+            return "Formato no soportado (csv o ndjson)", 400
+        return _trabajo_encolado(cola.encolar('exportar', {'que': que, 'args': request.args.to_dict()},
+                                              current_user.id))
+    return _exportar(stmt, columnas, nombre)
+
+
+# ======== TRAZO DE UNA RUTA (replay) ========
+# El camino que siguió el camión, leído por ix_tracking_route_ts (ya viene en
+# orden de timestamp) y codificado con trazos.py: polyline (JSON, por defecto) o
+# columnas int32 delta (binario). Un viaje de 10 h con un ping por segundo son
+# ~36k puntos: ~135 KB (45 KB con gzip) contra ~2 MB (700 KB) como lista JSON
+# de floats. ?desde=/?hasta= cortan una ventana para el replay; si quedan más de
+# MAX_PUNTOS_TRAZO puntos se responde la primera parte y `siguiente` (o la
+# cabecera X-Trazo-Siguiente) es el ?desde= de la que sigue.
+MAX_PUNTOS_TRAZO = 100000
+FORMATOS_TRAZO = ('polyline', 'binario')
+_EPOCH_NAIVE = datetime(1970, 1, 1)
+
+
+def _puede_ver_ruta(route):
+    """Admin ve todas; el despachador, las de su flota; el chofer, las de su camión."""
+    if current_user.role == 'admin':
+        return True
+    if route.truck is None:
+        return False
+    if current_user.role == 'despachador':
+        return route.truck.dispatcher_id == current_user.id
+    return current_user.role == 'chofer' and route.truck.driver_id == current_user.id
+
+
+@app.route('/rutas/<int:route_id>/trazo')
+@login_required
+def ruta_trazo(route_id):
+    """Trazo GPS de la ruta en orden de tiempo, en ?formato=polyline|binario.
+
+    ?desde=/?hasta= (ISO 8601 o epoch; desde incluido, hasta excluido),
+    ?precision=5|6 (decimales de la polyline), ?tolerancia= (metros: simplifica
+    con Douglas–Peucker, para una vista general del viaje).
+    """
+    route = Route.query.get_or_404(route_id)
+    if not _puede_ver_ruta(route):
+        return "No autorizado", 403
+    formato = request.args.get('formato', 'polyline')
+    if formato not in FORMATOS_TRAZO:
+        return "Formato no soportado (polyline o binario)", 400
+    precision = _entero_arg('precision') or 5
+    if precision not in (5, 6):
+        return "Precisión no soportada (5 o 6)", 400
+    try:
+        desde, hasta = _fecha_arg('desde'), _fecha_arg('hasta')
+        tolerancia = float(request.args.get('tolerancia') or 0)
+    except ValueError:
+        return "Parámetro inválido (fechas en ISO 8601 o epoch, tolerancia en metros)", 400
+
+    filtro = [Tracking.route_id == route_id, Tracking.lat.isnot(None), Tracking.lon.isnot(None)]
+    if desde is not None:
+        filtro.append(Tracking.timestamp >= desde)
+    if hasta is not None:
+        filtro.append(Tracking.timestamp < hasta)
+
+    # ETag: cantidad y último id de la ventana (los resuelve el mismo índice). Un
+    # ping nuevo o una compactación los cambian; el query string separa formatos.
+    n, ultimo_id = db.session.execute(
+        db.select(db.func.count(), db.func.max(Tracking.id)).where(*filtro)).one()
+    etag = f'{n}.{ultimo_id or 0}.{zlib.crc32(request.query_string):08x}'
+    if request.if_none_match.contains_weak(etag):
+        respuesta = Response(status=304)
+    else:
+        respuesta = _respuesta_trazo(route_id, filtro, formato, precision, tolerancia)
+    respuesta.set_etag(etag, weak=True)
+    respuesta.headers['Cache-Control'] = 'private, no-cache'
+    return respuesta
+
+
+def _respuesta_trazo(route_id, filtro, formato, precision, tolerancia):
+    # Core y no ORM: con decenas de miles de filas se nota el costo de armar filas del ORM
+    conn = db.session.connection()
+    consulta = db.select(Tracking.timestamp, Tracking.lat, Tracking.lon).where(*filtro) \
+        .order_by(Tracking.timestamp, Tracking.id)
+    filas = conn.execute(consulta.limit(MAX_PUNTOS_TRAZO + 1)).all()
+    siguiente = None
+    if len(filas) > MAX_PUNTOS_TRAZO:
+        # La parte siguiente empieza en un timestamp (?desde= lo incluye): los
+        # pings de ese instante van todos en ella, para no repetirlos
+        siguiente = filas[MAX_PUNTOS_TRAZO][0]
+        corte = next((i for i in range(MAX_PUNTOS_TRAZO - 1, -1, -1) if filas[i][0] < siguiente), -1) + 1
+        filas = filas[:corte]
+        if not filas:
+            # Todo el tope es un único instante: va entero aunque lo pase
+            filas = conn.execute(consulta.where(Tracking.timestamp == siguiente)).all()
+            siguiente = conn.execute(db.select(db.func.min(Tracking.timestamp))
+                                     .where(*filtro, Tracking.timestamp > siguiente)).scalar()
+    marcas, lat, lon = zip(*filas) if filas else ((), (), ())
+    # Como `_epoch`, pero restar un datetime naive es varias veces más barato que replace(tzinfo)
+    epoch = np.fromiter(((ts - _EPOCH_NAIVE).total_seconds() for ts in marcas), float, len(marcas))
+    lat, lon = np.array(lat, dtype=float), np.array(lon, dtype=float)
+    if tolerancia > 0 and len(filas) > 2:
+        x, y = retencion.proyectar(lat, lon)
+        quedan = retencion.douglas_peucker(x, y, [0], [len(filas)], tolerancia) > 0
+        epoch, lat, lon = epoch[quedan], lat[quedan], lon[quedan]
+    t0 = int(round(epoch[0])) if len(epoch) else 0
+
+    if formato == 'binario':
+        respuesta = Response(trazos.binario(epoch, lat, lon, t0), mimetype='application/octet-stream')
+        if siguiente is not None:
+            respuesta.headers['X-Trazo-Siguiente'] = siguiente.isoformat()
+        return respuesta
+    return jsonify({
+        'route_id': route_id,
+        'puntos': len(epoch),
+        't0': t0,
+        'precision': precision,
+        'polyline': trazos.polyline(lat, lon, precision),
+        'tiempos': trazos.tiempos(epoch, t0),
+        'siguiente': siguiente.isoformat() if siguiente is not None else None,
+    })
+
+
+# ======== IMPORTACIÓN Y OPERACIONES MASIVAS ========
+# Manifiestos diarios de miles de rutas: el archivo se lee y valida fila a fila
+# (nunca entero en memoria, salvo un arreglo JSON), las placas se resuelven con
+# un solo diccionario cargado en una consulta y las filas válidas se insertan
+# en lotes, cada uno en su propia transacción. Los cambios de estado masivos
+# son UPDATE por conjunto: uno por estado previo, para que los contadores
+# queden exactos sin cargar las rutas en el ORM.
+LOTE_IMPORTACION = 1000
+MAX_ERRORES_REPORTADOS = 1000
+MAX_IDS_MASIVO = 10000
+ESTADOS_CON_CAMION = ('en_progreso', 'en curso', 'en ruta')  # no tienen sentido sin camión
+
+
+def _estados_validos():
+    return ESTADOS_EN_ORIGEN + ESTADOS_EN_DESTINO
+
+
+def _filas_importacion(stream, formato):
+    """Genera (número de fila, dict) desde un CSV con cabecera, NDJSON o un arreglo JSON."""
+    if formato == 'json':
+        datos = json.load(stream)
+        if not isinstance(datos, list):
+            raise ValueError('se esperaba un arreglo JSON de rutas')
+        yield from enumerate(datos, start=1)
+        return
+    texto = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if formato == 'csv':
+        # Fila 1 es la cabecera: los números coinciden con las líneas del archivo
+        yield from enumerate(csv.DictReader(texto), start=2)
+        return
+    for numero, linea in enumerate(texto, start=1):
+        if linea.strip():
+            try:
+                yield numero, json.loads(linea)
+            except ValueError:
+                yield numero, None
+
+
+def _validar_fila(fila, por_placa, por_id):
+    """Fila del manifiesto -> valores para INSERT; ValueError con el motivo si no es válida.
+
+    El camión se indica con `truck` (placa, se busca en `por_placa`) o `truck_id`.
+    """
+    if not isinstance(fila, dict):
+        raise ValueError('fila mal formada')
+    origin = str(fila.get('origin') or '').strip()
+    destination = str(fila.get('destination') or '').strip()
+    if not origin or not destination:
+        raise ValueError('origin y destination son obligatorios')
+    status = str(fila.get('status') or 'pendiente').strip()
+    if status not in _estados_validos():
+        raise ValueError(f'status desconocido: {status!r}')
+
+    truck_id = None
+    placa = str(fila.get('truck') or '').strip().upper()
+    id_texto = str(fila.get('truck_id') or '').strip()
+    if placa:
+        if placa not in por_placa:
+            raise ValueError(f'camión desconocido: {placa}')
+        truck_id = por_placa[placa]
+    elif id_texto:
+        if not id_texto.isdigit() or int(id_texto) not in por_id:
+            raise ValueError(f'truck_id desconocido: {id_texto}')
+        truck_id = int(id_texto)
+    if truck_id is None and status in ESTADOS_CON_CAMION:
+        raise ValueError(f'una ruta {status} necesita camión')
+
+    tiempos = {}
+    for columna in ('start_time', 'completed_at'):
+        texto = str(fila.get(columna) or '').strip()
+        try:
+            tiempos[columna] = _parsear_ts_texto(texto) if texto else None
+        except ValueError:
+            raise ValueError(f'{columna} inválido: {texto!r}') from None
+    if tiempos['completed_at'] is not None:
+        if status not in ESTADOS_EN_DESTINO:
+            raise ValueError(f'una ruta {status} no puede tener completed_at')
+        if tiempos['start_time'] is not None and tiempos['completed_at'] < tiempos['start_time']:
+            raise ValueError('completed_at es anterior a start_time')
+    return {
+        'origin': origin, 'destination': destination,
+        'origin_city_id': indice_ciudades.resolver(origin),
+        'destination_city_id': indice_ciudades.resolver(destination),
+        'status': status, 'truck_id': truck_id, **tiempos,
+    }
+
+
+def _mapa_camiones():
+    """En una consulta: {placa: id} y {id: (driver_id, dispatcher_id)} de todos los camiones."""
+    por_placa, por_id = {}, {}
+    for truck_id, plate, driver_id, dispatcher_id in db.session.execute(
+            db.select(Truck.id, Truck.plate, Truck.driver_id, Truck.dispatcher_id)):
+        por_placa[plate.upper()] = truck_id
+        por_id[truck_id] = (driver_id, dispatcher_id)
+    return por_placa, por_id
+
+
+def _insertar_lote(filas, por_id):
+    """Inserta un lote de filas validadas en una transacción (secuencia, contadores y aviso incluidos)."""
+    def insertar(evento):
+        rutas = Route.__table__
+        ids = db.session.execute(
+            rutas.insert().returning(rutas.c.id), [{**f, 'change_seq': evento['seq']} for f in filas]
+        ).scalars().all()
+        deltas = Counter(f"route_status:{f['status']}" for f in filas)
+        deltas['routes'] = len(filas)
+        aplicar_deltas_stats(db.session.connection(), deltas)
+        registrar_duraciones(db.session.connection(), [
+            (f['origin_city_id'], f['destination_city_id'], f['start_time'], f['completed_at'])
+            for f in filas if f['status'] in ESTADOS_EN_DESTINO])
+        for f in filas:
+            if f['truck_id'] is not None:
+                evento['audiencia'] |= set(por_id[f['truck_id']]) - {None}
+        evento['routes'].update(ids)
+        return len(ids)
+
+    return ejecutar_con_reintentos(insertar)
+
+
+def importar_rutas(stream, formato, solo_validar=False, avance=None):
+    """Valida e inserta (en lotes de LOTE_IMPORTACION) las rutas de un manifiesto.
+
+    Las filas inválidas se saltan y se reportan con su número; las válidas se
+    insertan aunque haya errores en otras. Con `solo_validar` no se inserta nada.
+    `avance(resumen)` se llama después de cada lote (fuera de su transacción).
+    """
+    t0 = time.perf_counter()
+    por_placa, por_id = _mapa_camiones()
+    resumen = {'filas': 0, 'insertadas': 0, 'con_error': 0, 'lotes': 0, 'errores': []}
+    lote = []
+
+    def vaciar():
+        if lote and not solo_validar:
+            resumen['insertadas'] += _insertar_lote(lote, por_id)
+            resumen['lotes'] += 1
+        lote.clear()
+        if avance is not None:
+            avance(resumen)
+
+    for numero, fila in _filas_importacion(stream, formato):
+        resumen['filas'] += 1
+        try:
+            lote.append(_validar_fila(fila, por_placa, por_id))
+        except ValueError as error:
+            resumen['con_error'] += 1
+            if len(resumen['errores']) < MAX_ERRORES_REPORTADOS:
+                resumen['errores'].append({'fila': numero, 'error': str(error)})
+            continue
+        if len(lote) >= LOTE_IMPORTACION:
+            vaciar()
+    vaciar()
+    resumen['ms'] = round((time.perf_counter() - t0) * 1000.0, 1)
+    return resumen
+
+
+@app.route('/admin/import/routes', methods=['POST'])
+@login_required
+def admin_import_routes():
+    """Importa rutas desde un archivo (campo `archivo`) o el cuerpo del request.
+
+    Formato por ?formato=csv|ndjson|json o por la extensión del archivo.
+    Columnas: origin, destination, status (pendiente por defecto), truck (placa)
+    o truck_id, start_time, completed_at (solo en rutas completadas). ?validar=1 solo valida. Desde el panel (campo
+    `panel`) vuelve al listado con un resumen; si no, responde JSON. Con
+    ?segundo_plano=1 (o el campo del panel) el archivo se guarda y se importa
+    como trabajo: responde 202 con la URL de su estado.
+    """
+    if current_user.role != 'admin':
+        return "No autorizado", 403
+    archivo = request.files.get('archivo')
+    formato = request.args.get('formato') or request.form.get('formato')
+    if not formato:
+        nombre = archivo.filename if archivo else ''
+        formato = nombre.rsplit('.', 1)[-1].lower() if '.' in nombre else \
+            {'application/json': 'json', 'application/x-ndjson': 'ndjson'}.get(request.mimetype, 'csv')
+    if formato not in ('csv', 'ndjson', 'json'):
+        return "Formato no soportado (csv, ndjson o json)", 400
+
+    if request.args.get('segundo_plano') == '1' or request.form.get('segundo_plano'):
+        entrada = f'importacion-{uuid.uuid4().hex}.{formato}'
+        with open(cola.ruta(entrada), 'wb') as destino:
+            shutil.copyfileobj(archivo.stream if archivo else request.stream, destino)
+        job_id = cola.encolar('importar_rutas', {
+            'archivo': entrada, 'formato': formato, 'solo_validar': request.args.get('validar') == '1',
+        }, current_user.id)
+        if request.form.get('panel'):
+            flash(f"Importación encolada como trabajo #{job_id}; su avance está en "
+                  f"{url_for('trabajo_estado', job_id=job_id)}.", 'success')
+            return redirect(url_for('admin_routes'))
+        return _trabajo_encolado(job_id)
+
+    try:
+        resumen = importar_rutas(archivo.stream if archivo else request.stream, formato,
+                                 solo_validar=request.args.get('validar') == '1')
+    except (ValueError, UnicodeDecodeError, csv.Error) as error:
+        return f"Archivo ilegible: {error}", 400
+
+    if request.form.get('panel'):
+        if resumen['insertadas']:
+            flash(f"Se importaron {resumen['insertadas']} rutas.", 'success')
+        if resumen['con_error']:
+            primeras = '; '.join(f"fila {e['fila']}: {e['error']}" for e in resumen['errores'][:5])
+            flash(f"{resumen['con_error']} filas con errores ({primeras}).", 'error')
+        return redirect(url_for('admin_routes'))
+    return jsonify(resumen)
+
+
+def _cambios_masivos(accion, datos):
+    """(nuevo por estado previo, condiciones extra, camión destino) de una operación masiva.
+
+    `nuevo(status_previo)` devuelve los valores a escribir en las rutas que
+    estaban en ese estado.
+    """
+    if accion == 'estado':
+        status = datos.get('status')
+        if status not in _estados_validos():
+            raise ValueError(f'status desconocido: {status!r}')
+        extra = [Route.truck_id.isnot(None)] if status in ESTADOS_CON_CAMION else []
+        # completed_at y LaneStat los ajusta actualizar_rutas_masivo (también al reabrir)
+        return (lambda previo: {'status': status}), extra, None
+    activas = [Route.status.notin_(ESTADOS_EN_DESTINO)]  # las terminadas no se reasignan
+    if accion == 'liberar':
+        return (lambda previo: {'truck_id': None, 'status': 'pendiente', 'start_time': None}), activas, None
+    if accion == 'reasignar':
+        camion = str(datos.get('truck') or '').strip()
+        truck = db.session.get(Truck, int(camion)) if camion.isdigit() else \
+            Truck.query.filter_by(plate=camion.upper()).first() if camion else None
+        if truck is None:
+            raise ValueError(f'camión desconocido: {camion!r}')
+        # Una pendiente que recibe camión queda en curso, como al asignarla a mano
+        return (lambda previo: {'truck_id': truck.id,
+                                **({'status': 'en_progreso'} if previo == 'pendiente' else {})}), activas, truck
+    raise ValueError(f'acción desconocida: {accion!r} (estado, reasignar o liberar)')
+
+
+def actualizar_rutas_masivo(condiciones, nuevo, truck=None):
+    """Aplica `nuevo(status_previo)` a las rutas que cumplen `condiciones` en una transacción.
+
+    Un UPDATE ... RETURNING por estado previo (la condición incluye ese estado,
+    así el delta de los contadores es exacto aunque otro request cambie alguna
+    ruta entre medio). Con `truck`, ese camión queda 'en ruta' si recibió rutas.
+    Devuelve {'seleccionadas', 'actualizadas', 'por_estado_previo'}.
+    """
+    rutas, camiones = Route.__table__, Truck.__table__
+
+    def actualizar(evento):
+        seq = evento['seq']
+        grupos = db.session.execute(
+            db.select(rutas.c.status, rutas.c.truck_id, db.func.count())
+            .where(*condiciones).group_by(rutas.c.status, rutas.c.truck_id)
+        ).all()
+        por_estado = Counter()
+        for status, _, n in grupos:
+            por_estado[status] += n
+        resultado = {'seleccionadas': sum(por_estado.values()), 'actualizadas': 0, 'por_estado_previo': {}}
+        deltas = Counter()
+        completadas, reabiertas, salen = [], [], []
+        for previo in sorted(por_estado):
+            valores = _con_cierre(previo, nuevo(previo))
+            if 'truck_id' in valores:
+                # Rutas que dejan su camión: su chofer y su despachador dejan de verlas
+                dejan = [*condiciones, rutas.c.status == previo, rutas.c.truck_id.isnot(None)]
+                if valores['truck_id'] is not None:
+                    dejan.append(rutas.c.truck_id != valores['truck_id'])
+                salen += db.session.execute(db.select(rutas.c.id, rutas.c.truck_id).where(*dejan)).all()
+            if previo in ESTADOS_EN_DESTINO and valores.get('status', previo) not in ESTADOS_EN_DESTINO:
+                # Se descuentan con los tiempos con que se contaron (el UPDATE borra completed_at)
+                reabiertas += db.session.execute(
+                    db.select(rutas.c.origin_city_id, rutas.c.destination_city_id, rutas.c.start_time,
+                              rutas.c.completed_at).where(*condiciones, rutas.c.status == previo)).all()
+            filas = db.session.execute(
+                rutas.update().where(*condiciones, rutas.c.status == previo)
+                .values(**valores, change_seq=seq)
+                .returning(rutas.c.id, rutas.c.origin_city_id, rutas.c.destination_city_id,
+                           rutas.c.start_time, rutas.c.completed_at)
+            ).all()
+            if not filas:
+                continue
+            ids = [f[0] for f in filas]
+            if valores.get('status', previo) in ESTADOS_EN_DESTINO and previo not in ESTADOS_EN_DESTINO:
+                completadas.extend(f[1:] for f in filas)
+            deltas[f'route_status:{previo}'] -= len(ids)
+            deltas[f"route_status:{valores.get('status', previo)}"] += len(ids)
+            evento['routes'].update(ids)
+            resultado['actualizadas'] += len(ids)
+            resultado['por_estado_previo'][previo] = len(ids)
+        if truck is not None and resultado['actualizadas'] and truck.status != 'en ruta':
+            db.session.execute(camiones.update().where(camiones.c.id == truck.id)
+                               .values(status='en ruta', change_seq=seq))
+            deltas[f'truck_status:{truck.status}'] -= 1
+            deltas['truck_status:en ruta'] += 1
+            evento['trucks'].add(truck.id)
+        if resultado['actualizadas']:
+            aplicar_deltas_stats(db.session.connection(), deltas)
+            registrar_duraciones(db.session.connection(), completadas)
+            descontar_duraciones(db.session.connection(), reabiertas)
+            duenos = _duenos_de_camiones(
+                {t for _, t, _ in grupos} - {None} | ({truck.id} if truck is not None else set()))
+            registrar_salidas(db.session.connection(), seq,
+                              [(route_id, user_id) for route_id, truck_id in salen
+                               for user_id in duenos.get(truck_id, ())])
+            evento['audiencia'] |= set().union(*duenos.values())
+        return resultado
+
+    return ejecutar_con_reintentos(actualizar)
+
+
+@app.route('/admin/routes/bulk', methods=['POST'])
+@login_required
+def admin_routes_bulk():
+    """Cambio masivo de rutas por conjunto (JSON).
+
+    {"accion": "estado", "status": "completada"} | {"accion": "reasignar", "truck": placa o id}
+    | {"accion": "liberar"}, más la selección: "ids": [...] (hasta MAX_IDS_MASIVO)
+    y/o "filtro": {status, origin, destination, truck, dispatcher_id} (los de
+    /admin/routes). "desde": "<estado>" limita a las rutas en ese estado.
+    """
+    if current_user.role != 'admin':
+        return "No autorizado", 403
+    datos = request.get_json(silent=True)
+    if not isinstance(datos, dict):
+        return jsonify({'error': 'Se esperaba un objeto JSON'}), 400
+    filtro = datos.get('filtro') or {}
+    ids = datos.get('ids')
+    if not isinstance(filtro, dict) or (ids is not None and not isinstance(ids, list)):
+        return jsonify({'error': "'filtro' debe ser un objeto e 'ids' una lista"}), 400
+    if ids is None and not filtro:
+        # Sin selección sería "todas las rutas": se exige pedirlo explícito
+        return jsonify({'error': "Falta la selección ('ids' o 'filtro')"}), 400
+    if ids is not None and len(ids) > MAX_IDS_MASIVO:
+        return jsonify({'error': f"Máximo {MAX_IDS_MASIVO} ids; para más, usar 'filtro'"}), 413
+
+    try:
+        condiciones = _condiciones_rutas(filtro)
+        if ids is not None:
+            if not all(isinstance(i, int) or str(i).isdigit() for i in ids):
+                raise ValueError("'ids' debe ser una lista de enteros")
+            condiciones.append(Route.id.in_([int(i) for i in ids]))
+        if datos.get('desde'):
+            condiciones.append(Route.status == datos['desde'])
+        nuevo, extra, truck = _cambios_masivos(datos.get('accion'), datos)
+    except (TypeError, ValueError) as error:
+        return jsonify({'error': str(error)}), 400
+
+    t0 = time.perf_counter()
+    resultado = actualizar_rutas_masivo(condiciones + extra, nuevo, truck)
+    resultado['ms'] = round((time.perf_counter() - t0) * 1000.0, 1)
+    return jsonify(resultado)
+
+
+# ======== RETENCIÓN DEL HISTORIAL GPS ========
+# Tracking crece con cada ping. `compactar_tracking()` (un cron con `flask --app
+# main tracking compactar`, o el trabajo compactar_tracking) toma cada día que
+# ya salió de la ventana cruda, archiva sus pings a un segmento gzip y deja como
+# mucho un ping por ruta y minuto, o uno cada 10 minutos pasado un mes (ver
+# retencion.py). Así cada día ocupa un máximo acotado y el trazo de una ruta
+# vieja se lee en pocas filas. Lo borrado deja páginas libres que SQLite
+# reutiliza; con auto_vacuum=INCREMENTAL además vuelven al disco.
+TRACKING_ARCHIVO_DIR = os.environ.get('TRACKING_ARCHIVO_DIR') or os.path.join(app.instance_path, 'tracking')
+LOTE_BORRADO_TRACKING = 5000
+PAGINAS_VACUUM = 2000  # páginas devueltas al disco por transacción
+
+
+def _inicio_dia(dia):
+    return datetime.combine(dia, datetime.min.time())
+
+
+def _dia_con_pings(desde=None):
+    """Primer día con pings desde `desde` (datetime) en adelante; None si no hay (usa ix_tracking_ts)."""
+    consulta = db.session.query(db.func.min(Tracking.timestamp))
+    if desde is not None:
+        consulta = consulta.filter(Tracking.timestamp >= desde)
+    ts = consulta.scalar()
+    return ts.date() if ts is not None else None
+
+
+def _dias_con_pings_nuevos(desde_id, hasta_id):
+    """Días de los pings con id en (desde_id, hasta_id]: recorre la PK, no todo el historial."""
+    dias = db.session.query(db.func.date(Tracking.timestamp)).filter(
+        Tracking.id > desde_id, Tracking.id <= hasta_id).distinct()
+    return {d if isinstance(d, date) else date.fromisoformat(d) for (d,) in dias if d is not None}
+
+
+def compactar_dia(dia, balde_s, hasta_id):
+    """Archiva los pings de `dia` que no están en un segmento y deja uno por ruta y balde.
+
+    Solo toca pings con id <= `hasta_id`. Devuelve (archivados, borrados, conservados).
+    """
+    inicio = _inicio_dia(dia)
+    fin = inicio + timedelta(days=1)
+    fila = db.session.get(TrackingArchive, dia)
+    desde_id = fila.last_id if fila is not None else 0
+    pings = db.session.execute(
+        db.select(Tracking.id, Tracking.route_id, Tracking.timestamp, Tracking.lat, Tracking.lon)
+        .where(Tracking.timestamp >= inicio, Tracking.timestamp < fin, Tracking.id <= hasta_id)
+        .order_by(Tracking.route_id, Tracking.timestamp, Tracking.id)
+    ).all()
+    db.session.commit()  # no retener la lectura mientras se escribe el segmento
+    if not pings:
+        return 0, 0, 0
+    n = len(pings)
+    ids = np.fromiter((p[0] for p in pings), dtype=np.int64, count=n)
+    archivados = int((ids > desde_id).sum())
+    if archivados:
+        stmt, columnas = _consulta_export_tracking({'desde': inicio.isoformat(), 'hasta': fin.isoformat()})
+        stmt = stmt.where(Tracking.id > desde_id, Tracking.id <= hasta_id)
+        retencion.escribir_segmento(TRACKING_ARCHIVO_DIR, retencion.nombre_segmento(dia, desde_id + 1, hasta_id),
+                                    _bloques_exportacion(stmt, columnas, 'csv', True))
+
+    mascara = retencion.conservar(
+        np.fromiter((-1 if p[1] is None else p[1] for p in pings), dtype=np.int64, count=n),
+        np.fromiter(((p[2] - inicio).total_seconds() for p in pings), dtype=float, count=n),
+        np.array([np.nan if p[3] is None else p[3] for p in pings], dtype=float),
+        np.array([np.nan if p[4] is None else p[4] for p in pings], dtype=float),
+        balde_s,
+    )
+    # SQLite reutiliza el rowid más alto si se borra: conservarlo asegura que un
+    # ping nuevo siempre tenga un id mayor que last_id (y se archive como tardío)
+    mascara[ids == hasta_id] = True
+    borrar = ids[~mascara].tolist()
+    tabla = Tracking.__table__
+    for k in range(0, len(borrar), LOTE_BORRADO_TRACKING):
+        db.session.execute(tabla.delete().where(tabla.c.id.in_(borrar[k:k + LOTE_BORRADO_TRACKING])))
+        db.session.commit()
+
+    fila = db.session.get(TrackingArchive, dia)
+    if fila is None:
+        fila = TrackingArchive(day=dia, raw_pings=0)
+        db.session.add(fila)
+    fila.bucket_s = balde_s
+    fila.raw_pings += archivados
+    fila.kept_pings = n - len(borrar)
+    fila.last_id = hasta_id
+    fila.compacted_at = datetime.utcnow()
+    db.session.commit()
+    return archivados, len(borrar), n - len(borrar)
+
+
+def compactar_tracking(ahora=None, avance=None):
+    """Compacta los días fuera de la ventana cruda que lo necesiten; devuelve un resumen.
+
+    Un día se procesa si nunca se compactó, si ya le toca un balde más ancho o si
+    le llegaron pings después de compactarlo. `avance(hecho, total)` se llama
+    después de cada día, entre transacciones.
+    """
+    ahora = ahora or datetime.utcnow()
+    limite = ahora - timedelta(hours=retencion.CRUDO_H)
+    hasta_id = db.session.query(db.func.max(Tracking.id)).scalar() or 0
+    hechos = dict(db.session.query(TrackingArchive.day, TrackingArchive.bucket_s))
+    revisado = db.session.query(SyncCounter.value).filter_by(name='retencion').scalar() or 0
+    tardios = _dias_con_pings_nuevos(revisado, hasta_id) if hechos else set()
+    resumen = {'dias': 0, 'archivados': 0, 'borrados': 0, 'conservados': 0}
+
+    primero = dia = _dia_con_pings()
+    while dia is not None and _inicio_dia(dia) + timedelta(days=1) <= limite:
+        balde = max(retencion.balde_para(dia, ahora.date()), hechos.get(dia, 0))
+        if dia not in hechos or hechos[dia] < balde or dia in tardios:
+            archivados, borrados, conservados = compactar_dia(dia, balde, hasta_id)
+            resumen['dias'] += 1
+            resumen['archivados'] += archivados
+            resumen['borrados'] += borrados
+            resumen['conservados'] += conservados
+        if avance is not None:
+            avance((dia - primero).days + 1, max((limite.date() - primero).days, 1))
+        dia = _dia_con_pings(_inicio_dia(dia) + timedelta(days=1))
+
+    # Hasta acá se revisaron los pings tardíos (solo si la pasada terminó)
+    tabla = SyncCounter.__table__
+    if db.session.execute(tabla.update().where(tabla.c.name == 'retencion').values(value=hasta_id)).rowcount == 0:
+        db.session.execute(tabla.insert().values(name='retencion', value=hasta_id))
+    db.session.commit()
+    resumen['paginas_liberadas'] = liberar_espacio()
+    return resumen
+
+
+def _modo_vacuum(conn):
+    return conn.exec_driver_sql('PRAGMA auto_vacuum').scalar()  # 0 none, 1 full, 2 incremental
+
+
+def liberar_espacio():
+    """Devuelve al disco las páginas libres de SQLite con auto_vacuum=INCREMENTAL; cuántas liberó.
+
+    De a PAGINAS_VACUUM por transacción, para no retener el lock de escritura.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return 0
+    liberadas = 0
+    with db.engine.connect() as conn:
+        if _modo_vacuum(conn) != 2:
+            return 0
+        libres = conn.exec_driver_sql('PRAGMA freelist_count').scalar()
+        while libres:
+            conn.exec_driver_sql(f'PRAGMA incremental_vacuum({PAGINAS_VACUUM})')
+            conn.commit()
+            quedan = conn.exec_driver_sql('PRAGMA freelist_count').scalar()
+            if quedan >= libres:
+                break
+            liberadas += libres - quedan
+            libres = quedan
+    return liberadas
+
+
+def activar_vacuum_incremental():
+    """Pasa una DB SQLite a auto_vacuum=INCREMENTAL; con tablas ya creadas hace un VACUUM completo."""
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        if _modo_vacuum(conn) == 2:
+            return False
+        conn.exec_driver_sql('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.exec_driver_sql('VACUUM')
+        return True
+
+
+@app.cli.command('tracking')
+@click.argument('accion', type=click.Choice(['compactar', 'estado', 'vacuum']))
+def tracking_command(accion):
+    """Compacta y archiva el historial GPS viejo (compactar), resume lo compactado (estado) o
+    activa auto_vacuum incremental en una DB existente (vacuum: VACUUM completo, bloquea la DB).
+    """
+    if accion == 'compactar':
+        t0 = time.perf_counter()
+        resumen = compactar_tracking()
+        click.echo(f"{resumen['dias']} días compactados: {resumen['archivados']} pings archivados, "
+                   f"{resumen['borrados']} borrados, {resumen['conservados']} conservados, "
+                   f"{resumen['paginas_liberadas']} páginas devueltas al disco "
+                   f"({time.perf_counter() - t0:.1f}s)")
+        return
+    if accion == 'vacuum':
+        if db.engine.dialect.name != 'sqlite':
+            click.echo('Solo aplica a SQLite')
+        elif activar_vacuum_incremental():
+            click.echo('auto_vacuum=INCREMENTAL activado')
+        else:
+            click.echo('auto_vacuum ya era INCREMENTAL')
+        return
+    for balde_s, dias, crudos, quedan in (
+        db.session.query(TrackingArchive.bucket_s, db.func.count(), db.func.sum(TrackingArchive.raw_pings),
+                         db.func.sum(TrackingArchive.kept_pings))
+        .group_by(TrackingArchive.bucket_s).order_by(TrackingArchive.bucket_s)
+    ):
+        click.echo(f'balde {balde_s}s: {dias} días, {crudos} pings archivados, {quedan} en Tracking')
+    ultimo = db.session.query(db.func.max(TrackingArchive.day)).scalar()
+    click.echo(f'último día compactado: {ultimo or "-"}; segmentos en {TRACKING_ARCHIVO_DIR}')
+    if db.engine.dialect.name == 'sqlite':
+        with db.engine.connect() as conn:
+            click.echo(f"auto_vacuum={_modo_vacuum(conn)}, páginas libres: "
+                       f"{conn.exec_driver_sql('PRAGMA freelist_count').scalar()}")
+
+
+# ======== TRABAJOS EN SEGUNDO PLANO ========
+# Importar un manifiesto, exportar el historial, reconstruir agregados o
+# planificar el despacho de una flota grande puede tomar de segundos a minutos.
+# Encolados (ver trabajos.py), el request responde 202 al instante y los hilos
+# web siguen atendiendo los sondeos de los mapas; el cliente sigue el avance en
+# GET /trabajos/<id>.
+MAX_TRABAJOS_LISTADO = 50
+TAREAS_ADMIN = ('reconstruir_stats', 'reconstruir_carriles', 'compactar_tracking')  # POST /admin/trabajos/<tipo>
+
+
+@cola.tarea('importar_rutas', reintentable=False)
+def _tarea_importar(trabajo, archivo, formato, solo_validar=False):
+    """Importa el archivo guardado por /admin/import/routes y lo borra al terminar."""
+    ruta = trabajo.ruta(archivo)
+    try:
+        with open(ruta, 'rb') as stream:
+            total = os.fstat(stream.fileno()).st_size
+
+            def avance(resumen):
+                # Avance por bytes leídos (el lector de texto cierra el archivo al agotarse)
+                leido = total if stream.closed else stream.tell()
+                trabajo.avance(leido, total, f"{resumen['filas']} filas, {resumen['insertadas']} insertadas")
+
+            return importar_rutas(stream, formato, solo_validar, avance=avance)
+    finally:
+        os.remove(ruta)
+
+
+@cola.tarea('exportar')
+def _tarea_exportar(trabajo, que, args):
+    """Escribe el export a un archivo del directorio de la cola (se baja con /trabajos/<id>/archivo)."""
+    consulta, nombre = EXPORTACIONES[que]
+    stmt, columnas = consulta(args)
+    formato, comprimir = args.get('formato', 'csv'), args.get('gzip') == '1'
+    total = db.session.execute(db.select(db.func.count()).select_from(stmt.order_by(None).subquery())).scalar()
+    archivo = f'{trabajo.id}-' + _nombre_exportacion(nombre, formato, comprimir)
+    ruta = trabajo.ruta(archivo)
+    leidas = [0]
+
+    def al_leer(n):
+        leidas[0] += n
+        trabajo.avance(leidas[0], total, f'{leidas[0]} de {total} filas')
+
+    try:
+        with open(ruta, 'wb') as salida:
+            for bloque in _bloques_exportacion(stmt, columnas, formato, comprimir, al_leer):
+                salida.write(bloque)
+    except Exception:
+        os.remove(ruta)
+        raise
+    return {'archivo': archivo, 'filas': leidas[0], 'bytes': os.path.getsize(ruta),
+            'mimetype': _tipo_exportacion(formato, comprimir)}
+
+
+@cola.tarea('reconstruir_stats')
+def _tarea_reconstruir_stats(trabajo):
+    return {'contadores': len(reconstruir_stats())}
+
+
+@cola.tarea('reconstruir_carriles')
+def _tarea_reconstruir_carriles(trabajo):
+    return {'carriles': reconstruir_carriles()}
+
+
+@cola.tarea('compactar_tracking')
+def _tarea_compactar_tracking(trabajo):
+    return compactar_tracking(avance=lambda hecho, total: trabajo.avance(hecho, total, f'día {hecho} de {total}'))
+
+
+@cola.tarea('planificar_despacho')
+def _tarea_planificar_despacho(trabajo, despachador_id, metodo='auto', max_km=None):
+    """El mismo plan que GET /despacho/auto; se aplica con POST /despacho/auto/aplicar."""
+    return planificar_despacho(despachador_id, metodo, max_km)
+
+
+def _trabajo_encolado(job_id):
+    """Respuesta 202 de un trabajo recién encolado, con la URL de su estado."""
+    url = url_for('trabajo_estado', job_id=job_id)
+    return jsonify({'id': job_id, 'estado': 'pendiente', 'url': url}), 202, {'Location': url}
+
+
+def _fecha_json(valor):
+    return valor.isoformat() if valor else None
+
+
+def _trabajo_json(job):
+    datos = {
+        'id': job.id,
+        'tipo': job.kind,
+        'estado': job.status,
+        'avance': round(job.progress, 3),
+        'mensaje': job.message,
+        'cancelacion_pedida': job.cancel_requested,
+        'intentos': job.attempts,
+        'user_id': job.user_id,
+        'creado': _fecha_json(job.created_at),
+        'iniciado': _fecha_json(job.started_at),
+        'terminado': _fecha_json(job.finished_at),
+        'error': job.error,
+        'resultado': json.loads(job.result) if job.result else None,
+    }
+    if job.kind == 'exportar' and job.status == 'completado':
+        datos['descarga'] = url_for('trabajo_archivo', job_id=job.id)
+    return datos
+
+
+def _trabajo_visible(job_id):
+    """El trabajo si es del usuario (o es admin); None si no existe o es de otro."""
+    job = db.session.get(Job, job_id)
+    if job is None or (current_user.role != 'admin' and job.user_id != current_user.id):
+        return None
+    return job
+
+
+@app.route('/trabajos')
+@login_required
+def trabajos_listado():
+    """Trabajos más recientes del usuario (el admin ve todos). Filtros: ?estado=, ?tipo=, ?limit=."""
+    query = Job.query
+    if current_user.role != 'admin':
+        query = query.filter(Job.user_id == current_user.id)
+    if request.args.get('estado'):
+        query = query.filter(Job.status == request.args['estado'])
+    if request.args.get('tipo'):
+        query = query.filter(Job.kind == request.args['tipo'])
+    limite = min(_entero_arg('limit') or MAX_TRABAJOS_LISTADO, MAX_TRABAJOS_LISTADO)
+    return jsonify({'items': [_trabajo_json(j) for j in query.order_by(Job.id.desc()).limit(limite)]})
+
+
+@app.route('/trabajos/<int:job_id>')
+@login_required
+def trabajo_estado(job_id):
+    """Estado, avance y (al terminar) resultado o error de un trabajo."""
+    job = _trabajo_visible(job_id)
+    if job is None:
+        return "Trabajo no encontrado", 404
+    return jsonify(_trabajo_json(job))
+
+
+@app.route('/trabajos/<int:job_id>/cancelar', methods=['POST'])
+@login_required
+def trabajo_cancelar(job_id):
+    """Un pendiente queda cancelado en el acto; uno en curso para en su próximo aviso de avance."""
+    job = _trabajo_visible(job_id)
+    if job is None:
+        return "Trabajo no encontrado", 404
+    if job.status in ESTADOS_ACTIVOS:
+        cola.cancelar(job_id)
+        db.session.refresh(job)
+    return jsonify(_trabajo_json(job))
+
+
+@app.route('/trabajos/<int:job_id>/archivo')
+@login_required
+def trabajo_archivo(job_id):
+    """Descarga el archivo de un export terminado."""
+    job = _trabajo_visible(job_id)
+    if job is None or job.kind != 'exportar' or job.status != 'completado':
+        return "Trabajo no encontrado", 404
+    resultado = json.loads(job.result)
+    ruta = cola.ruta(resultado['archivo'])
+    if not os.path.exists(ruta):
+        return "El archivo ya no está disponible", 410
+    return send_file(ruta, mimetype=resultado.get('mimetype'), as_attachment=True,
+                     download_name=resultado['archivo'].split('-', 1)[1])
+
+
+@app.route('/admin/trabajos/<tipo>', methods=['POST'])
+@login_required
+def admin_trabajo_encolar(tipo):
+    """Encola una tarea de mantenimiento: reconstruir_stats, reconstruir_carriles o compactar_tracking."""
+    if current_user.role != 'admin':
+        return "No autorizado", 403
+    if tipo not in TAREAS_ADMIN:
+        return f"Tarea desconocida ({', '.join(TAREAS_ADMIN)})", 404
+    return _trabajo_encolado(cola.encolar(tipo, user_id=current_user.id))
+
+
+def limpiar_trabajos(dias):
+    """Borra los trabajos terminados hace más de `dias` y los archivos viejos de la cola.
+
+    Devuelve (trabajos, archivos) borrados.
+    """
+    limite = datetime.utcnow() - timedelta(days=dias)
+    borrados = Job.query.filter(Job.status.notin_(ESTADOS_ACTIVOS), Job.finished_at < limite) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+    en_uso = {json.loads(p).get('archivo') for (p,) in
+              db.session.query(Job.params).filter(Job.status.in_(ESTADOS_ACTIVOS))}
+    archivos = 0
+    if os.path.isdir(cola.directorio):
+        for nombre in os.listdir(cola.directorio):
+            ruta = os.path.join(cola.directorio, nombre)
+            if nombre not in en_uso and datetime.utcfromtimestamp(os.path.getmtime(ruta)) < limite:
+                os.remove(ruta)
+                archivos += 1
+    return borrados, archivos
+
+
+@app.cli.command('trabajos')
+@click.argument('accion', type=click.Choice(['procesar', 'limpiar']))
+@click.option('--hilos', type=int, default=None, help='procesar: hilos (0 = vaciar la cola y salir)')
+@click.option('--dias', type=int, default=7, help='limpiar: antigüedad mínima')
+def trabajos_command(accion, hilos, dias):
+    """Corre un worker de trabajos (procesar) o borra trabajos y archivos viejos (limpiar)."""
+    if accion == 'limpiar':
+        borrados, archivos = limpiar_trabajos(dias)
+        click.echo(f'{borrados} trabajos y {archivos} archivos borrados')
+        return
+    if hilos == 0:
+        click.echo(f'{cola.procesar()} trabajos procesados')
+        return
+    cola.iniciar(hilos or cola.hilos)
+    click.echo(f'Procesando trabajos con {hilos or cola.hilos} hilos (Ctrl+C para salir)')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        click.echo('Esperando a que terminen los trabajos en curso...')
+        cola.detener()
+
+
 @app.route("/logout")
 @login_required
 def logout():
     logout_user()
     return redirect(url_for("login"))
 
+# ======== ARRANQUE ========
+# El esquema se crea y migra con `flask --app main init-db`, una vez por
+# despliegue y nunca en el camino de un request. `crear_app()` solo verifica
+# el esquema y precarga cachés; con gunicorn (gunicorn.conf.py, preload_app)
+# corre una vez en el master y los workers heredan lo precargado al hacer fork.
+# Después del fork, `iniciar_worker()` rehace lo que no se puede compartir.
+
+def preparar_db():
+    """Crea las tablas que falten, agrega columnas e índices nuevos y sincroniza las ciudades."""
+    antes = set(inspect(db.engine).get_table_names())
+    if not antes and db.engine.dialect.name == 'sqlite':
+        # En una DB nueva es gratis; después requiere `flask tracking vacuum`
+        activar_vacuum_incremental()
+    db.create_all()
+    return {
+        'tablas': sorted(set(inspect(db.engine).get_table_names()) - antes),
+        'columnas': agregar_columnas(),
+        'indices': crear_indices(),
+        'ciudades': sincronizar_ciudades(),
+    }
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Crea o migra el esquema (idempotente); correrlo antes de levantar el servidor."""
+    cambios = preparar_db()
+    for clave in ('tablas', 'columnas', 'indices'):
+        if cambios[clave]:
+            click.echo(f"{clave}: {', '.join(cambios[clave])}")
+    click.echo(f"ciudades nuevas: {cambios['ciudades']}")
+    click.echo('OK: esquema al día')
+
+
+def verificar_esquema():
+    """RuntimeError si faltan tablas o columnas del modelo (se arregla con `flask init-db`)."""
+    inspector = inspect(db.engine)
+    faltan = []
+    for tabla in db.metadata.sorted_tables:
+        if not inspector.has_table(tabla.name):
+            faltan.append(tabla.name)
+            continue
+        existentes = {c['name'] for c in inspector.get_columns(tabla.name)}
+        faltan += [f'{tabla.name}.{c.name}' for c in tabla.columns if c.name not in existentes]
+    if faltan:
+        raise RuntimeError(f"Esquema desactualizado (falta {', '.join(faltan)}): "
+                           f"ejecutar `flask --app main init-db`")
+
+
+def calentar():
+    """Precarga lo que si no pagaría el primer request de cada worker; devuelve cuánto cargó."""
+    cargado = {'posiciones': calentar_posiciones(), 'stats': len(leer_stats())}
+    # Rutas antiguas sin ciudad resuelta: sus nombres quedan en el LRU del índice
+    sin_resolver = db.session.query(Route.origin).filter(Route.origin_city_id.is_(None)).union(
+        db.session.query(Route.destination).filter(Route.destination_city_id.is_(None))).limit(4096)
+    cargado['nombres'] = sum(1 for (nombre,) in sin_resolver if indice_ciudades.resolver(nombre) is not None)
+    plantillas = app.jinja_env.list_templates(extensions=['html'])
+    for nombre in plantillas:
+        app.jinja_env.get_template(nombre)
+    cargado['plantillas'] = len(plantillas)
+    return cargado
+
+
+def crear_app():
+    """La app lista para servir: esquema verificado y cachés precargadas.
+
+    Al terminar suelta las conexiones abiertas para que ningún fork herede una.
+    """
+    with app.app_context():
+        verificar_esquema()
+        calentar()
+        db.session.remove()
+        db.engine.dispose()
+    return app
+
+
+def iniciar_worker(varios_procesos=True):
+    """Lo que cada worker rehace después del fork (gunicorn post_fork)."""
+    with app.app_context():
+        # El pool copiado del master no se usa ni se cierra: el worker abre sus conexiones
+        db.engine.dispose(close=False)
+    versiones.nueva_instancia()  # un ETag de otro worker nunca debe calzar
+    random.seed()
+    if varios_procesos and POSICIONES_SEGUIMIENTO_S > 0:
+        _seguir_posiciones_en_segundo_plano(POSICIONES_SEGUIMIENTO_S)
+    cola.iniciar()  # los hilos no sobreviven al fork
+
+
 if __name__ == '__main__':
+    # Servidor de desarrollo (debugger y reloader). Producción: ver wsgi.py
     with app.app_context():
-        db.create_all()
+        preparar_db()
+    crear_app()
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        cola.iniciar()  # con el reloader de debug, solo en el proceso que atiende
     app.run(debug=True)
\ No newline at end of file
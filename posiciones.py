@@ -0,0 +1,100 @@
+"""Última posición conocida de cada ruta/camión, en memoria.
+
+Los datos viven en columnas `array` (un slot por ruta) en lugar de un objeto por
+camión: 10k rutas ocupan unos pocos cientos de KB y recorrerlas para armar el
+JSON del mapa no toca SQLite. Se alimenta desde la ingesta GPS y se precarga
+desde `Tracking` al arrancar.
+"""
+import threading
+from array import array
+
+from espacial import Grilla
+
+
+class PosicionesEnVivo:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slot_ruta = {}    # route_id -> slot
+        self._slot_camion = {}  # truck_id -> slot del ping más reciente de ese camión
+        self.route_id = array('q')
+        self.truck_id = array('q')  # 0 = sin camión
+        self.lat = array('d')
+        self.lon = array('d')
+        self.ts = array('d')  # epoch en segundos (UTC)
+        self.grilla = Grilla(tam=0.5)  # route_id por celda, para consultas por viewport
+        self.version = 0  # sube con cada cambio; sirve para saber si algo se movió
+        self.calentado = False
+        self.ultimo_tracking_id = 0  # pings hasta este id ya están (ver seguir_posiciones en main.py)
+
+    def actualizar(self, route_id, truck_id, lat, lon, ts):
+        """Registra un ping; se ignora si es más viejo que lo que ya hay para esa ruta."""
+        with self._lock:
+            self._actualizar(route_id, truck_id, lat, lon, ts)
+
+    def actualizar_lote(self, filas):
+        """Igual que `actualizar` para muchas tuplas (route_id, truck_id, lat, lon, ts)."""
+        with self._lock:
+            for fila in filas:
+                self._actualizar(*fila)
+
+    def _actualizar(self, route_id, truck_id, lat, lon, ts):
+        truck_id = truck_id or 0
+        slot = self._slot_ruta.get(route_id)
+        if slot is None:
+            slot = len(self.route_id)
+            self._slot_ruta[route_id] = slot
+            self.route_id.append(route_id)
+            self.truck_id.append(truck_id)
+            self.lat.append(lat)
+            self.lon.append(lon)
+            self.ts.append(ts)
+        elif ts >= self.ts[slot]:
+            self.truck_id[slot] = truck_id
+            self.lat[slot] = lat
+            self.lon[slot] = lon
+            self.ts[slot] = ts
+        else:
+            return
+        self.grilla.mover(route_id, lat, lon)
+        if truck_id:
+            previo = self._slot_camion.get(truck_id)
+            if previo is None or self.ts[previo] <= ts:
+                self._slot_camion[truck_id] = slot
+        self.version += 1
+
+    def de_ruta(self, route_id):
+        """(lat, lon, ts) de la ruta, o None si nunca reportó."""
+        slot = self._slot_ruta.get(route_id)
+        if slot is None:
+            return None
+        return self.lat[slot], self.lon[slot], self.ts[slot]
+
+    def de_camion(self, truck_id):
+        """(lat, lon, ts) del último ping del camión, o None."""
+        slot = self._slot_camion.get(truck_id)
+        if slot is None:
+            return None
+        return self.lat[slot], self.lon[slot], self.ts[slot]
+
+    def rutas_en_bbox(self, bbox):
+        """route_ids cuya última posición cae dentro de bbox = (sur, oeste, norte, este)."""
+        with self._lock:
+            return self.grilla.consultar(bbox)
+
+    def columnas(self):
+        """Copia consistente de todas las columnas, como listas (lista para JSON)."""
+        with self._lock:
+            return {
+                'route_id': self.route_id.tolist(),
+                'truck_id': self.truck_id.tolist(),
+                'lat': self.lat.tolist(),
+                'lon': self.lon.tolist(),
+                'ts': self.ts.tolist(),
+                'version': self.version,
+            }
+
+    def __len__(self):
+        return len(self.route_id)
+
+
+posiciones = PosicionesEnVivo()
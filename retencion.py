@@ -0,0 +1,199 @@
+"""Retención del historial GPS: submuestreo por día con Douglas–Peucker y baldes de tiempo.
+
+El historial se compacta por día (UTC) y por ruta. Los pings de las últimas
+RETENCION_CRUDO_H horas (24) quedan tal cual; en un día más antiguo se conservan:
+
+- el primer ping de cada balde de RETENCION_BALDE_S segundos (60), para que el
+  trazo mantenga su resolución en el tiempo (replay);
+- los que Douglas–Peucker necesita para que ningún ping descartado quede a más
+  de RETENCION_TOLERANCIA_M metros (15) del trazo: las curvas;
+- como mucho RETENCION_MAX_POR_BALDE (5) por balde, los de mayor desviación:
+  con un GPS muy ruidoso el tamaño sigue acotado;
+- siempre el primero y el último de la ruta en el día (la última posición
+  conocida no cambia).
+
+Pasados RETENCION_VIEJO_D días (30) el día se vuelve a compactar con baldes de
+RETENCION_BALDE_VIEJO_S (600), RETENCION_TOLERANCIA_VIEJO_M (50) y
+RETENCION_MAX_POR_BALDE_VIEJO (10).
+
+Antes de borrar nada, los pings crudos del día se escriben a un segmento gzip
+en TRACKING_ARCHIVO_DIR, con las mismas columnas que el export de tracking:
+`AAAA-MM-DD.<desde id>-<hasta id>.csv.gz`. Los pings que llegan tarde a un día
+ya compactado van a otro segmento del mismo día. Un segmento nunca se
+sobreescribe y todo ping está en algún segmento antes de borrarse: repetir una
+compactación interrumpida puede duplicar pings en el archivo (`leer_dia` los
+descarta por id), pero no perderlos.
+"""
+import csv
+import gzip
+import os
+from datetime import date
+
+import numpy as np
+
+RADIO_TIERRA_M = 6371000.0
+
+CRUDO_H = float(os.environ.get('RETENCION_CRUDO_H', 24))
+VIEJO_D = float(os.environ.get('RETENCION_VIEJO_D', 30))
+BALDE_S = int(os.environ.get('RETENCION_BALDE_S', 60))
+TOLERANCIA_M = float(os.environ.get('RETENCION_TOLERANCIA_M', 15))
+MAX_POR_BALDE = int(os.environ.get('RETENCION_MAX_POR_BALDE', 5))
+BALDE_VIEJO_S = int(os.environ.get('RETENCION_BALDE_VIEJO_S', 600))
+TOLERANCIA_VIEJO_M = float(os.environ.get('RETENCION_TOLERANCIA_VIEJO_M', 50))
+MAX_POR_BALDE_VIEJO = int(os.environ.get('RETENCION_MAX_POR_BALDE_VIEJO', 10))
+
+# balde_s -> (tolerancia_m, pings como máximo por ruta y balde)
+NIVELES = {
+    BALDE_S: (TOLERANCIA_M, MAX_POR_BALDE),
+    BALDE_VIEJO_S: (TOLERANCIA_VIEJO_M, MAX_POR_BALDE_VIEJO),
+}
+
+
+def proyectar(lat, lon):
+    """(x, y) en metros, equirectangular local: basta para distancias de unos pocos km."""
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    return RADIO_TIERRA_M * lon * np.cos(lat), RADIO_TIERRA_M * lat
+
+
+def distancia_a_segmento(x, y, x0, y0, x1, y1):
+    """Distancia de cada punto (x, y) a su segmento (x0, y0)-(x1, y1) (arreglos alineados)."""
+    dx, dy = x1 - x0, y1 - y0
+    largo2 = dx * dx + dy * dy
+    # Segmento degenerado (extremos iguales): t = 0, distancia al punto
+    t = np.clip(((x - x0) * dx + (y - y0) * dy) / np.where(largo2 > 0, largo2, 1.0), 0.0, 1.0)
+    return np.hypot(x - (x0 + t * dx), y - (y0 + t * dy))
+
+
+def douglas_peucker(x, y, inicios, fines, tolerancia):
+    """Desviación con la que Douglas–Peucker elige cada punto de cada tramo [inicio, fin).
+
+    inf en los extremos de cada tramo, la distancia al segmento que lo eligió en
+    los puntos elegidos y 0 en los descartados (los que quedan a `tolerancia` o
+    menos). Todos los tramos avanzan juntos, un nivel de la recursión por vuelta,
+    así que el costo es de arreglos y no de un bucle por punto.
+    """
+    n = len(x)
+    desviacion = np.zeros(n)
+    inicios = np.asarray(inicios, dtype=np.int64)
+    fines = np.asarray(fines, dtype=np.int64)
+    desviacion[inicios] = desviacion[fines - 1] = np.inf
+    i, j = inicios, fines - 1
+    while True:
+        partir = j - i >= 2
+        i, j = i[partir], j[partir]
+        if not len(i):
+            return desviacion
+        largos = j - i - 1
+        segmento = np.repeat(np.arange(len(i)), largos)
+        comienzos = np.cumsum(largos) - largos
+        punto = np.arange(largos.sum()) - comienzos[segmento] + i[segmento] + 1
+        a, b = i[segmento], j[segmento]
+        d = distancia_a_segmento(x[punto], y[punto], x[a], y[a], x[b], y[b])
+        maximo = np.maximum.reduceat(d, comienzos)
+        # El primer punto que alcanza el máximo de su segmento
+        es_max = np.flatnonzero(d == maximo[segmento])
+        _, primero = np.unique(segmento[es_max], return_index=True)
+        m = punto[es_max[primero]]
+        elegidos = maximo > tolerancia
+        i, j, m = i[elegidos], j[elegidos], m[elegidos]
+        desviacion[m] = maximo[elegidos]
+        i, j = np.concatenate((i, m)), np.concatenate((m, j))
+
+
+def conservar(rutas, epoch, lat, lon, balde_s, tolerancia=None, maximo=None):
+    """Máscara de los pings que se conservan (ver el docstring del módulo).
+
+    Arreglos alineados y ordenados por (ruta, epoch); `lat`/`lon` pueden ser NaN
+    (pings legados sin coordenadas: solo cuentan como primero de su balde).
+    `tolerancia` y `maximo` salen de NIVELES si no se indican.
+    """
+    por_defecto = NIVELES.get(balde_s, (TOLERANCIA_M, MAX_POR_BALDE))
+    tolerancia = por_defecto[0] if tolerancia is None else tolerancia
+    maximo = por_defecto[1] if maximo is None else maximo
+    rutas = np.asarray(rutas, dtype=np.int64)
+    epoch = np.asarray(epoch, dtype=float)
+    n = len(rutas)
+    if n == 0:
+        return np.zeros(0, dtype=bool)
+    x, y = proyectar(lat, lon)
+    importancia = np.zeros(n)
+    validos = np.flatnonzero(~(np.isnan(x) | np.isnan(y)))
+    if len(validos):
+        inicios = np.flatnonzero(np.diff(rutas[validos], prepend=-1))
+        fines = np.append(inicios[1:], len(validos))
+        importancia[validos] = douglas_peucker(x[validos], y[validos], inicios, fines, tolerancia)
+    extremos = np.flatnonzero(np.diff(rutas, prepend=-1))
+    importancia[extremos] = importancia[np.append(extremos[1:], n) - 1] = np.inf
+
+    # Dentro de cada (ruta, balde): el primero siempre; los elegidos por
+    # Douglas–Peucker, de mayor a menor desviación, hasta `maximo`
+    balde = np.floor(epoch / balde_s).astype(np.int64)
+    primero_del_balde = np.ones(n, dtype=bool)
+    primero_del_balde[1:] = (rutas[1:] != rutas[:-1]) | (balde[1:] != balde[:-1])
+    clave = np.where(primero_del_balde, np.inf, importancia)
+    orden = np.lexsort((np.arange(n), -clave, balde, rutas))
+    nuevo = np.ones(n, dtype=bool)
+    nuevo[1:] = (rutas[orden][1:] != rutas[orden][:-1]) | (balde[orden][1:] != balde[orden][:-1])
+    posicion = np.arange(n)
+    puesto = posicion - np.maximum.accumulate(np.where(nuevo, posicion, 0))
+    elegido = (puesto == 0) | ((puesto < maximo) & (clave[orden] > 0))
+    mascara = np.zeros(n, dtype=bool)
+    mascara[orden[elegido]] = True
+    mascara[importancia == np.inf] = True
+    return mascara
+
+
+def balde_para(dia, hoy):
+    """Ancho de balde (clave de NIVELES) que le corresponde a `dia` (date) visto desde `hoy`."""
+    return BALDE_VIEJO_S if (hoy - dia).days > VIEJO_D else BALDE_S
+
+
+# ---- segmentos de archivo ----
+
+def nombre_segmento(dia, desde_id, hasta_id):
+    return f'{dia.isoformat()}.{desde_id}-{hasta_id}.csv.gz'
+
+
+def escribir_segmento(directorio, nombre, bloques):
+    """Escribe los bloques (ya en gzip) a `nombre` de forma atómica; False si el segmento ya existía."""
+    os.makedirs(directorio, exist_ok=True)
+    ruta = os.path.join(directorio, nombre)
+    if os.path.exists(ruta):
+        return False
+    temporal = ruta + '.tmp'
+    with open(temporal, 'wb') as f:
+        for bloque in bloques:
+            f.write(bloque)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporal, ruta)
+    return True
+
+
+def segmentos(directorio, dia):
+    """Rutas de los segmentos de `dia`, en orden de ids."""
+    if not os.path.isdir(directorio):
+        return []
+    prefijo = dia.isoformat() + '.'
+    nombres = [n for n in os.listdir(directorio) if n.startswith(prefijo) and n.endswith('.csv.gz')]
+    return [os.path.join(directorio, n) for n in
+            sorted(nombres, key=lambda n: int(n[len(prefijo):].split('-', 1)[0]))]
+
+
+def leer_dia(directorio, dia):
+    """Genera los pings crudos archivados de `dia` como dicts (columnas del export, en texto), sin repetir ids."""
+    vistos = set()
+    for ruta in segmentos(directorio, dia):
+        with gzip.open(ruta, 'rt', encoding='utf-8', newline='') as f:
+            for fila in csv.DictReader(f):
+                if fila['id'] not in vistos:
+                    vistos.add(fila['id'])
+                    yield fila
+
+
+def dias_archivados(directorio):
+    """Días (date) con al menos un segmento en `directorio`."""
+    if not os.path.isdir(directorio):
+        return []
+    return sorted({date.fromisoformat(n[:10]) for n in os.listdir(directorio) if n.endswith('.csv.gz')})
@@ -1,97 +1,257 @@
-from main import app, db, User, Truck, Route
-from werkzeug.security import generate_password_hash
-from faker import Faker
+"""Genera datos de prueba, desde la demo chica hasta DBs del tamaño de producción.
+
+    python seed.py                                   # demo: 15 usuarios, 10 camiones, 30 rutas
+    python seed.py --users 5000 --trucks 20000 --routes 1_000_000 --pings 50M --db /tmp/grande.db
+
+Inserta con executemany en transacciones por lotes, reutiliza un único hash de
+contraseña y crea los índices secundarios al final (más rápido que mantenerlos
+durante la carga). Deja consistentes los datos derivados: ciudades, secuencia
+de cambios, contadores de KPIs y agregados de duración por carril.
+"""
+import argparse
+import os
 import random
+import time
+from datetime import datetime, timedelta
+
+
+def cantidad(texto):
+    """'1_000_000' / '50M' / '20k' -> int."""
+    texto = texto.replace('_', '').strip().lower()
+    multiplicador = {'k': 1_000, 'm': 1_000_000}.get(texto[-1:], 1)
+    if multiplicador > 1:
+        texto = texto[:-1]
+    return int(float(texto) * multiplicador)
+
+
+def parsear_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=cantidad, default=15, help='usuarios en total (1 admin + despachadores + choferes)')
+    parser.add_argument('--dispatchers', type=cantidad, default=None, help='por defecto 4, o users/50 en escala')
+    parser.add_argument('--trucks', type=cantidad, default=10)
+    parser.add_argument('--routes', type=cantidad, default=30)
+    parser.add_argument('--pings', type=cantidad, default=0, help='filas de Tracking (historial GPS)')
+    parser.add_argument('--chunk', type=cantidad, default=50_000, help='filas por transacción')
+    parser.add_argument('--db', help='archivo SQLite destino (por defecto, el de DATABASE_URL)')
+    parser.add_argument('--password', default='1234')
+    parser.add_argument('--random-seed', type=int, default=None)
+    return parser.parse_args(argv)
+
+
+args = parsear_args()
+if args.db:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.abspath(args.db)
+
+from sqlalchemy import event, text  # noqa: E402
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+from ciudades import indice as indice_ciudades  # noqa: E402
+from main import (  # noqa: E402
+    app, db, User, Truck, Route, Tracking, SyncCounter,
+    sincronizar_ciudades, crear_indices, reconstruir_stats, reconstruir_carriles,
+)
+from analitica import distancia_km  # noqa: E402
+
+CARGAS = ["Madera", "Juguetes", "Electrónica", "Ropa", "Alimentos"]
+# Más tráfico donde hay más gente: Santiago pesa 8, las capitales regionales 2
+PESO_CIUDAD = {"Santiago": 8, "Valparaíso": 3, "Concepción": 3, "Antofagasta": 2, "La Serena": 2,
+               "Rancagua": 2, "Temuco": 2, "Puerto Montt": 2, "Valdivia": 2, "Arica": 2,
+               "Iquique": 2, "Talca": 2, "Chillán": 2, "Copiapó": 2, "Osorno": 2}
+
+
+def en_lotes(total, tam):
+    for inicio in range(0, total, tam):
+        yield inicio, min(total, inicio + tam)
+
+
+def insertar(tabla, filas_de, total, tam, etiqueta):
+    """Inserta `total` filas generadas por `filas_de(inicio, fin)` en transacciones de `tam`."""
+    t0 = time.perf_counter()
+    for inicio, fin in en_lotes(total, tam):
+        with db.engine.begin() as conn:
+            conn.execute(tabla.insert(), filas_de(inicio, fin))
+        if total > tam:
+            print(f"  {etiqueta}: {fin:,}/{total:,}", end='\r', flush=True)
+    if total:
+        print(f"  {etiqueta}: {total:,} en {time.perf_counter() - t0:.1f}s" + ' ' * 20)
+
+
+def placa(i):
+    """Placas únicas estilo chileno: 4 letras + 2 dígitos."""
+    letras = ''
+    n = i // 100
+    for _ in range(4):
+        n, r = divmod(n, 26)
+        letras += chr(ord('A') + r)
+    return f"{letras}{i % 100:02d}"
+
+
+def main():
+    if args.random_seed is not None:
+        random.seed(args.random_seed)
+    ahora = datetime.utcnow()
+
+    n_users = max(args.users, 3)
+    n_desp = args.dispatchers or (4 if n_users <= 200 else n_users // 50)
+    n_choferes = n_users - 1 - n_desp
+    if n_choferes < 1:
+        raise SystemExit('--users debe dejar al menos un chofer')
+    n_trucks, n_routes, n_pings = args.trucks, args.routes, args.pings
+
+    ciudades = list(indice_ciudades)
+    pesos = [PESO_CIUDAD.get(c.nombre, 1) for c in ciudades]
+
+    with app.app_context():
+        # ========================
+        # RECREAR BASE DE DATOS (aplica cambios de esquema)
+        # ========================
+        db.drop_all()
+        db.create_all()
+        sincronizar_ciudades()
+        with db.engine.begin() as conn:
+            for tabla in db.metadata.sorted_tables:
+                for indice in tabla.indexes:
+                    conn.execute(text(f'DROP INDEX IF EXISTS {indice.name}'))
+        if db.engine.dialect.name == 'sqlite':
+            # Carga masiva: sin fsync por transacción (la DB se regenera si falla)
+            @event.listens_for(db.engine, 'connect')
+            def _sin_sync(dbapi_connection, connection_record):
+                dbapi_connection.execute('PRAGMA synchronous=OFF')
+            db.engine.dispose()
+
+        t_total = time.perf_counter()
+        print(f"Sembrando {n_users:,} usuarios ({n_desp:,} despachadores), {n_trucks:,} camiones, "
+              f"{n_routes:,} rutas, {n_pings:,} pings")
+
+        # ========================
+        # USUARIOS: ids 1 = admin, 2..n_desp+1 = despachadores, resto choferes
+        # ========================
+        hash_unico = generate_password_hash(args.password)
+
+        def usuarios(inicio, fin):
+            filas = []
+            for i in range(inicio, fin):
+                if i == 0:
+                    nombre, rol = "admin", "admin"
+                elif i <= n_desp:
+                    nombre, rol = f"despachador{i}", "despachador"
+                else:
+                    nombre, rol = f"chofer{i - n_desp}", "chofer"
+                filas.append({"id": i + 1, "username": nombre, "role": rol, "password": hash_unico})
+            return filas
+
+        insertar(User.__table__, usuarios, n_users, args.chunk, 'usuarios')
+
+        # ========================
+        # CAMIONES: uno por chofer mientras alcancen; despachador en ciclo
+        # ========================
+        primer_chofer = n_desp + 2
+        con_chofer = list(range(1, min(n_trucks, n_choferes) + 1))
+        en_ruta = set(random.sample(con_chofer, len(con_chofer) // 3))
+
+        def camiones(inicio, fin):
+            return [{
+                "id": i + 1,
+                "plate": placa(i),
+                "status": "en ruta" if i + 1 in en_ruta else "disponible",
+                "cargo": random.choice(CARGAS),
+                "driver_id": primer_chofer + i if i < n_choferes else None,
+                "dispatcher_id": 2 + i % n_desp,
+                "change_seq": 1,
+            } for i in range(inicio, fin)]
+
+        insertar(Truck.__table__, camiones, n_trucks, args.chunk, 'camiones')
+
+        # ========================
+        # RUTAS: una en progreso por camión "en ruta", ~78% del resto completadas y el
+        # resto pendientes (la mitad sin camión). Las más recientes tienen ids más altos.
+        # Las completadas duran distancia / ~60 km/h más detenciones, para el ETA por carril.
+        # ========================
+        km_carril = {}
+
+        def duracion(origen, destino):
+            clave = (origen.id, destino.id)
+            if clave not in km_carril:
+                km_carril[clave] = float(distancia_km(origen.coords, destino.coords)[0])
+            velocidad = max(30.0, random.gauss(62, 8))
+            return timedelta(hours=km_carril[clave] / velocidad, minutes=random.expovariate(1 / 20))
+
+        en_progreso = sorted(en_ruta)
+        id_en_progreso = set(random.sample(range(1, n_routes + 1), min(len(en_progreso), n_routes)))
+        cola_en_progreso = iter(en_progreso)
+        rutas_con_gps = []  # (route_id, origen, destino, inicio) para el historial de Tracking
+
+        def rutas(inicio, fin):
+            filas = []
+            for i in range(inicio, fin):
+                route_id = i + 1
+                origen, destino = random.choices(ciudades, weights=pesos, k=2)
+                while destino is origen:
+                    destino = random.choices(ciudades, weights=pesos)[0]
+                start_time = completed_at = None
+                if route_id in id_en_progreso:
+                    status, truck_id = "en_progreso", next(cola_en_progreso)
+                    start_time = ahora - timedelta(minutes=random.randint(5, 12 * 60))
+                elif random.random() < 0.78 and con_chofer:
+                    status, truck_id = "completada", random.choice(con_chofer)
+                else:
+                    status = "pendiente"
+                    truck_id = random.choice(con_chofer) if con_chofer and random.random() < 0.5 else None
+                if status != "pendiente":
+                    # Antigüedad proporcional al id: las rutas viejas terminaron hace más
+                    inicio_gps = start_time or ahora - timedelta(days=365 * (1 - route_id / n_routes), hours=random.random() * 12)
+                    rutas_con_gps.append((route_id, origen, destino, inicio_gps))
+                if status == "completada":
+                    start_time = inicio_gps
+                    completed_at = min(ahora, inicio_gps + duracion(origen, destino))
+                filas.append({
+                    "id": route_id, "origin": origen.nombre, "destination": destino.nombre,
+                    "origin_city_id": origen.id, "destination_city_id": destino.id,
+                    "status": status, "truck_id": truck_id, "start_time": start_time,
+                    "completed_at": completed_at, "change_seq": 1,
+                })
+            return filas
+
+        insertar(Route.__table__, rutas, n_routes, args.chunk, 'rutas')
+
+        # ========================
+        # TRACKING: pings cada 30s sobre la recta origen→destino, con ruido
+        # ========================
+        if n_pings and rutas_con_gps:
+            por_ruta, sobran = divmod(n_pings, len(rutas_con_gps))
+
+            def pings_de(inicio, fin):
+                filas = []
+                for j, (route_id, origen, destino, t0) in enumerate(rutas_con_gps[inicio:fin], start=inicio):
+                    n = por_ruta + (1 if j < sobran else 0)
+                    for k in range(n):
+                        f = k / max(1, n - 1)
+                        filas.append({
+                            "route_id": route_id,
+                            "lat": origen.lat + (destino.lat - origen.lat) * f + random.uniform(-0.002, 0.002),
+                            "lon": origen.lon + (destino.lon - origen.lon) * f + random.uniform(-0.002, 0.002),
+                            "timestamp": t0 + timedelta(seconds=30 * k),
+                        })
+                return filas
+
+            rutas_por_lote = max(1, args.chunk // max(1, por_ruta))
+            insertar(Tracking.__table__, pings_de, len(rutas_con_gps), rutas_por_lote, 'rutas con GPS')
+
+        # ========================
+        # DERIVADOS E ÍNDICES
+        # ========================
+        db.session.add(SyncCounter(name='cambios', value=1))
+        db.session.commit()
+        t0 = time.perf_counter()
+        crear_indices()
+        print(f"  índices en {time.perf_counter() - t0:.1f}s")
+        reconstruir_stats()
+        t0 = time.perf_counter()
+        n_carriles = reconstruir_carriles()
+        print(f"  ETA: {n_carriles:,} carriles en {time.perf_counter() - t0:.1f}s")
+
+    print(f"✅ Datos de prueba generados correctamente en {time.perf_counter() - t_total:.1f}s")
+
 
-fake = Faker()
-
-with app.app_context():
-    # ========================
-    # RECREAR BASE DE DATOS (aplica cambios de esquema)
-    # ========================
-    db.drop_all()
-    db.create_all()
-
-    # ========================
-    # CREAR USUARIOS
-    # ========================
-    users = []
-
-    # Admin
-    admin = User(username="admin", role="admin", password=generate_password_hash("1234"))
-    db.session.add(admin)
-    users.append(admin)
-
-    # Despachadores 
-    despachadores = []
-    for i in range(4):
-        desp = User(username=f"despachador{i+1}", role="despachador", password=generate_password_hash("1234"))
-        db.session.add(desp)
-        despachadores.append(desp)
-        users.append(desp)
-
-    # Choferes
-    choferes = []
-    for i in range(10):  # 10 choferes
-        chofer = User(username=fake.user_name(), role="chofer", password=generate_password_hash("1234"))
-        db.session.add(chofer)
-        choferes.append(chofer)
-        users.append(chofer)
-
-    db.session.commit()
-
-    # ========================
-    # CREAR CAMIONES
-    # ========================
-    trucks = []
-    # asignar camiones a choferes y también a un despachador en ciclo
-    for idx, chofer in enumerate(choferes):
-        dispatcher = despachadores[idx % len(despachadores)]
-        truck = Truck(
-            plate=fake.bothify(text='???###'),
-            status=random.choice(["disponible", "en ruta"]),
-            cargo=random.choice(["Madera", "Juguetes", "Electrónica", "Ropa", "Alimentos"]),
-            driver=chofer,
-            dispatcher=dispatcher
-        )
-        db.session.add(truck)
-        trucks.append(truck)
-
-    db.session.commit()
-
-    # Asegurar que cada despachador controle (aprox.) 3 choferes: comunicar en console
-    # (la asignación ya se hizo al crear los trucks con dispatcher)
-
-    # ========================
-    # CREAR RUTAS
-    # ========================
-    ciudades = ["Santiago", "Valparaíso", "Concepción", "Antofagasta", "La Serena", 
-                "Rancagua", "Temuco", "Puerto Montt", "Valdivia", "Arica"]
-
-    # Crear algunas rutas asignadas y otras disponibles (sin camión)
-    for i in range(20):  # 20 rutas asignadas a camiones
-        origin = random.choice(ciudades)
-        destination = random.choice([c for c in ciudades if c != origin])
-        route = Route(
-            origin=origin,
-            destination=destination,
-            status=random.choice(["pendiente", "en_progreso", "completada"]),
-            truck=random.choice(trucks)
-        )
-        db.session.add(route)
-
-    # Rutas disponibles (sin camión) en estado 'pendiente'
-    for i in range(10):  # 10 rutas sin camión
-        origin = random.choice(ciudades)
-        destination = random.choice([c for c in ciudades if c != origin])
-        route = Route(
-            origin=origin,
-            destination=destination,
-            status="pendiente",
-            truck=None
-        )
-        db.session.add(route)
-
-    db.session.commit()
-
-    print("✅ Datos de prueba generados correctamente")
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+"""Cola de trabajos en segundo plano: importaciones, exportaciones, reconstrucciones y despacho.
+
+La cola es una tabla de la misma base de datos (`Job` en main.py): no hay
+broker externo. Encolar es un INSERT; un hilo del pool toma el pendiente más
+antiguo con un UPDATE condicional (`WHERE status = 'pendiente'`), así dos hilos
+—o dos procesos: varios workers de gunicorn o `flask trabajos procesar`— nunca
+corren el mismo trabajo. Cada trabajo corre en su propio app context, con su
+sesión, y reporta su avance con `trabajo.avance(hecho, total)`; ahí mismo se
+entera de si lo cancelaron (cancelación cooperativa: lanza `Cancelado`).
+
+Un hilo de latido marca los trabajos en curso del proceso. Un trabajo deja de
+latir recién cuando su estado final quedó escrito (con la DB ocupada se
+reintenta con backoff y, después, en cada latido). Los que llevan más de
+TRABAJOS_VENCIMIENTO_S sin latido (el proceso murió) vuelven a la cola si la
+tarea es reintentable y no agotaron TRABAJOS_INTENTOS; si no, quedan fallidos.
+
+- TRABAJOS_HILOS: hilos por proceso (por defecto 2; 0 = este proceso solo encola).
+- TRABAJOS_SONDEO_S: cada cuánto un hilo libre revisa la tabla sin aviso (2).
+- TRABAJOS_LATIDO_S / TRABAJOS_VENCIMIENTO_S: latido y vencimiento (15 / 120).
+- TRABAJOS_INTENTOS: ejecuciones como máximo de un trabajo reintentable (3).
+"""
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update
+from sqlalchemy.exc import OperationalError
+
+ESTADOS_ACTIVOS = ('pendiente', 'en_curso')
+ESTADOS_FINALES = ('completado', 'fallido', 'cancelado')
+INTERVALO_AVANCE = 0.5  # segundos entre escrituras de avance de un mismo trabajo
+REINTENTOS_OCUPADA = 6  # como en main.ejecutar_con_reintentos
+ESPERA_BASE = 0.02  # segundos; se duplica en cada reintento (con jitter)
+
+log = logging.getLogger(__name__)
+
+
+class Cancelado(Exception):
+    """Se pidió cancelar el trabajo; la lanza `Trabajo.avance`."""
+
+
+class Tarea:
+    __slots__ = ('tipo', 'funcion', 'reintentable')
+
+    def __init__(self, tipo, funcion, reintentable):
+        self.tipo = tipo
+        self.funcion = funcion
+        self.reintentable = reintentable
+
+
+class Trabajo:
+    """Lo que recibe la función de una tarea: id, parámetros, avance y cancelación."""
+
+    def __init__(self, cola, id, params):
+        self.cola = cola
+        self.id = id
+        self.params = params
+        self._ultimo = 0.0
+
+    def avance(self, hecho, total=None, mensaje=None):
+        """Guarda el avance (como mucho cada INTERVALO_AVANCE) y lanza `Cancelado` si lo pidieron.
+
+        Llamarlo entre transacciones: en SQLite, si el hilo tiene una escritura
+        abierta, la escritura del avance esperaría a su propio lock.
+        """
+        ahora = time.monotonic()
+        final = total is not None and hecho >= total
+        if ahora - self._ultimo < INTERVALO_AVANCE and not final:
+            return
+        self._ultimo = ahora
+        fraccion = min(max(hecho / total, 0.0), 1.0) if total else None
+        if self.cola.guardar_avance(self.id, fraccion, mensaje):
+            raise Cancelado()
+
+    def ruta(self, nombre):
+        """Ruta de un archivo del trabajo (entrada o salida) en el directorio de la cola."""
+        return self.cola.ruta(nombre)
+
+
+class Cola:
+    def __init__(self):
+        self._tareas = {}
+        self._app = None
+        self._engine = None
+        self._tabla = None
+        self.directorio = None
+        self.hilos = int(os.environ.get('TRABAJOS_HILOS', 2))
+        self.sondeo = float(os.environ.get('TRABAJOS_SONDEO_S', 2))
+        self.latido = float(os.environ.get('TRABAJOS_LATIDO_S', 15))
+        self.vencimiento = float(os.environ.get('TRABAJOS_VENCIMIENTO_S', 120))
+        self.intentos = int(os.environ.get('TRABAJOS_INTENTOS', 3))
+        self.nombre = f'{socket.gethostname()}:{os.getpid()}'
+        self._lock = threading.Lock()
+        self._aviso = threading.Event()
+        self._parar = threading.Event()
+        self._hilos = []
+        self._en_curso = set()
+        self._finales = {}  # job_id -> (estado, valores) que no se pudieron escribir aún
+
+    def init_app(self, app, engine, tabla, directorio=None):
+        """Asocia la cola a la app, su engine y la tabla de trabajos (no arranca hilos)."""
+        self._app = app
+        self._engine = engine
+        self._tabla = tabla
+        self.directorio = directorio or os.environ.get('TRABAJOS_DIR') or \
+            os.path.join(app.instance_path, 'trabajos')
+
+    def tarea(self, tipo, reintentable=True):
+        """Decorador: registra `funcion(trabajo, **params)` como la tarea `tipo`.
+
+        Lo que devuelva (serializable a JSON) queda como resultado del trabajo.
+        Una tarea no reintentable (p. ej. una importación, que deja lotes ya
+        insertados) queda fallida si su proceso muere, en vez de volver a correr.
+        """
+        def registrar(funcion):
+            self._tareas[tipo] = Tarea(tipo, funcion, reintentable)
+            return funcion
+        return registrar
+
+    def ruta(self, nombre):
+        os.makedirs(self.directorio, exist_ok=True)
+        return os.path.join(self.directorio, os.path.basename(nombre))
+
+    # ---- encolar y controlar ----
+
+    def encolar(self, tipo, params=None, user_id=None):
+        """Inserta un trabajo pendiente y despierta a un hilo; devuelve su id."""
+        if tipo not in self._tareas:
+            raise ValueError(f'tarea desconocida: {tipo!r}')
+        t = self._tabla
+        with self._engine.begin() as conn:
+            job_id = conn.execute(t.insert().values(
+                kind=tipo, status='pendiente', params=json.dumps(params or {}), user_id=user_id,
+                created_at=datetime.utcnow(), progress=0.0, attempts=0, cancel_requested=False,
+            )).inserted_primary_key[0]
+        self.iniciar()
+        self._aviso.set()
+        return job_id
+
+    def cancelar(self, job_id):
+        """Cancela un pendiente en el acto; a uno en curso le pide que pare. Devuelve el estado."""
+        t = self._tabla
+        with self._engine.begin() as conn:
+            conn.execute(update(t).where(t.c.id == job_id, t.c.status == 'pendiente')
+                         .values(status='cancelado', finished_at=datetime.utcnow()))
+            conn.execute(update(t).where(t.c.id == job_id, t.c.status == 'en_curso')
+                         .values(cancel_requested=True))
+            return conn.execute(select(t.c.status).where(t.c.id == job_id)).scalar()
+
+    def guardar_avance(self, job_id, fraccion, mensaje):
+        """Escribe avance y latido; devuelve True si se pidió cancelar el trabajo."""
+        t = self._tabla
+        valores = {'heartbeat_at': datetime.utcnow()}
+        if fraccion is not None:
+            valores['progress'] = fraccion
+        if mensaje is not None:
+            valores['message'] = str(mensaje)[:200]
+        try:
+            with self._engine.begin() as conn:
+                return bool(conn.execute(update(t).where(t.c.id == job_id).values(**valores)
+                                         .returning(t.c.cancel_requested)).scalar())
+        except OperationalError:
+            return False  # DB ocupada: el avance se escribe en la próxima llamada
+
+    # ---- pool de hilos ----
+
+    def iniciar(self, hilos=None):
+        """Arranca los hilos de este proceso (una vez) y el de latido; no bloquea."""
+        hilos = self.hilos if hilos is None else hilos
+        with self._lock:
+            if self._hilos or hilos <= 0 or self._app is None:
+                return
+            self.nombre = f'{socket.gethostname()}:{os.getpid()}'  # tras un fork cambia el pid
+            self._parar.clear()
+            for i in range(hilos):
+                hilo = threading.Thread(target=self._bucle, name=f'trabajos-{i}', daemon=True)
+                hilo.start()
+                self._hilos.append(hilo)
+            hilo = threading.Thread(target=self._latir, name='trabajos-latido', daemon=True)
+            hilo.start()
+            self._hilos.append(hilo)
+
+    def detener(self, timeout=None):
+        """Pide a los hilos que terminen (cada uno termina su trabajo actual) y los espera."""
+        self._parar.set()
+        self._aviso.set()
+        with self._lock:
+            hilos, self._hilos = self._hilos, []
+        for hilo in hilos:
+            hilo.join(timeout)
+
+    def procesar(self, maximo=None):
+        """Corre pendientes en el hilo actual hasta vaciar la cola (o `maximo`); devuelve cuántos."""
+        corridos = 0
+        while maximo is None or corridos < maximo:
+            fila = self._reclamar()
+            if fila is None:
+                break
+            self._correr(*fila)
+            corridos += 1
+        return corridos
+
+    def _bucle(self):
+        while not self._parar.is_set():
+            try:
+                fila = self._reclamar()
+                if fila is not None:
+                    self._correr(*fila)
+                    continue
+            except OperationalError:
+                pass  # DB ocupada: se reintenta en el próximo sondeo
+            except Exception:
+                # Un error inesperado no debe achicar el pool: se registra y el hilo sigue
+                log.exception('error en el hilo de trabajos')
+            self._aviso.wait(self.sondeo)
+            self._aviso.clear()
+
+    def _latir(self):
+        while not self._parar.wait(self.latido):
+            try:
+                self._escribir_finales()
+                self._marcar_en_curso()
+                self.reencolar_vencidos()
+            except OperationalError:
+                pass
+            except Exception:
+                log.exception('error en el latido de trabajos')
+
+    def _reclamar(self):
+        """(id, tipo, params) del pendiente más antiguo, ya marcado en curso por este proceso; o None."""
+        t = self._tabla
+        ahora = datetime.utcnow()
+        candidato = select(t.c.id).where(t.c.status == 'pendiente').order_by(t.c.id).limit(1).scalar_subquery()
+        with self._engine.begin() as conn:
+            fila = conn.execute(
+                update(t).where(t.c.id == candidato, t.c.status == 'pendiente')
+                .values(status='en_curso', started_at=ahora, heartbeat_at=ahora,
+                        worker=self.nombre, attempts=t.c.attempts + 1)
+                .returning(t.c.id, t.c.kind, t.c.params)
+            ).first()
+        if fila is None:
+            return None
+        with self._lock:
+            self._en_curso.add(fila.id)
+        return fila.id, fila.kind, json.loads(fila.params or '{}')
+
+    def _correr(self, job_id, tipo, params):
+        tarea = self._tareas.get(tipo)
+        valores = {}
+        try:
+            if tarea is None:
+                raise LookupError(f'tarea desconocida: {tipo!r}')
+            with self._app.app_context():
+                resultado = tarea.funcion(Trabajo(self, job_id, params), **params)
+            estado = 'completado'
+            valores = {'result': json.dumps(resultado, default=str), 'progress': 1.0}
+        except Cancelado:
+            estado = 'cancelado'
+        except Exception as error:
+            log.exception('trabajo %s (%s) falló', job_id, tipo)
+            estado = 'fallido'
+            valores = {'error': f'{type(error).__name__}: {error}'[:2000]}
+        with self._lock:
+            self._finales[job_id] = (estado, {'finished_at': datetime.utcnow(), **valores})
+        for intento in range(REINTENTOS_OCUPADA + 1):
+            if intento:
+                time.sleep(ESPERA_BASE * 2 ** intento * (0.5 + random.random()))
+            try:
+                self._escribir_final(job_id)
+                return
+            except OperationalError:
+                pass
+        # Sigue en curso (con latido, así no se reencola): el hilo de latido lo reintenta
+        log.warning('trabajo %s: no se pudo guardar su estado final, se reintenta con el latido', job_id)
+
+    def _escribir_final(self, job_id):
+        """Guarda el estado final pendiente de `job_id`; solo entonces deja de latir."""
+        with self._lock:
+            estado, valores = self._finales[job_id]
+        t = self._tabla
+        with self._engine.begin() as conn:
+            conn.execute(update(t).where(t.c.id == job_id).values(status=estado, **valores))
+        with self._lock:
+            self._finales.pop(job_id, None)
+            self._en_curso.discard(job_id)
+
+    def _escribir_finales(self):
+        with self._lock:
+            ids = list(self._finales)
+        for job_id in ids:
+            self._escribir_final(job_id)
+
+    def _marcar_en_curso(self):
+        with self._lock:
+            ids = list(self._en_curso)
+        if ids:
+            t = self._tabla
+            with self._engine.begin() as conn:
+                conn.execute(update(t).where(t.c.id.in_(ids)).values(heartbeat_at=datetime.utcnow()))
+
+    def reencolar_vencidos(self):
+        """Trabajos en curso sin latido reciente (su proceso murió): a la cola, o fallidos.
+
+        Devuelve (reencolados, fallidos).
+        """
+        t = self._tabla
+        ahora = datetime.utcnow()
+        limite = ahora - timedelta(seconds=self.vencimiento)
+        reintentables = [tipo for tipo, tarea in self._tareas.items() if tarea.reintentable]
+        vencido = (t.c.status == 'en_curso') & (t.c.heartbeat_at < limite)
+        with self._engine.begin() as conn:
+            reencolados = conn.execute(
+                update(t).where(vencido, t.c.kind.in_(reintentables), t.c.attempts < self.intentos,
+                                t.c.cancel_requested.is_(False))
+                .values(status='pendiente', worker=None, started_at=None)
+            ).rowcount
+            conn.execute(update(t).where(vencido, t.c.cancel_requested.is_(True))
+                         .values(status='cancelado', finished_at=ahora))
+            fallidos = conn.execute(
+                update(t).where(vencido).values(
+                    status='fallido', finished_at=ahora,
+                    error=f'interrumpido: sin latido por más de {self.vencimiento:.0f}s')
+            ).rowcount
+        if reencolados:
+            self._aviso.set()
+        return reencolados, fallidos
+
+
+cola = Cola()
@@ -0,0 +1,100 @@
+"""Codificación compacta del trazo de una ruta: Google encoded polyline y binario columnar.
+
+Un trazo son tres columnas alineadas: tiempo (segundos epoch), lat y lon.
+
+- Polyline: las coordenadas, redondeadas a `precision` decimales (5 ≈ 1 m),
+  van como deltas en el formato de Google encoded polyline (lo decodifica
+  cualquier librería de mapas). Los tiempos van aparte con el mismo esquema de
+  enteros, un valor por punto: el primero es 0 (relativo a `t0`) y el resto el
+  delta en segundos con el anterior; a un ping cada pocos segundos, 1 carácter.
+- Binario (`application/octet-stream`): una cabecera CABECERA (little endian:
+  magia b'LTRZ', versión, n, t0, escala) y tres arreglos int32 de n valores,
+  uno detrás de otro: tiempos, lat * escala, lon * escala, cada uno con el
+  primer valor absoluto (el tiempo relativo a t0) y luego deltas. Se decodifica
+  con un cumsum por columna.
+
+Todo es numpy: codificar 36k puntos toma ~20 ms.
+"""
+import struct
+
+import numpy as np
+
+MAGIA = b'LTRZ'
+VERSION_BINARIO = 1
+ESCALA_BINARIO = 1_000_000  # 1e-6 grados ≈ 0,1 m
+CABECERA = struct.Struct('<4sBxxxIqI')  # magia, versión, n, t0, escala
+_TROZOS = 7  # 7 trozos de 5 bits alcanzan para cualquier int32 en zigzag
+
+
+def codificar_enteros(valores):
+    """Enteros con signo -> texto en el formato de Google encoded polyline, uno tras otro."""
+    v = np.asarray(valores, dtype=np.int64)
+    if not len(v):
+        return ''
+    zigzag = ((v << 1) ^ (v >> 63)).astype(np.uint64)
+    desplazamientos = np.arange(_TROZOS, dtype=np.uint64) * np.uint64(5)
+    trozos = (zigzag[:, None] >> desplazamientos) & np.uint64(31)
+    largos = 1 + ((zigzag[:, None] >> desplazamientos[1:]) > 0).sum(axis=1)
+    indice = np.arange(_TROZOS)
+    # Todos los trozos menos el último de cada valor llevan el bit de continuación
+    trozos |= np.where(indice < largos[:, None] - 1, np.uint64(0x20), np.uint64(0))
+    return (trozos + np.uint64(63)).astype(np.uint8)[indice < largos[:, None]].tobytes().decode('ascii')
+
+
+def decodificar_enteros(texto):
+    """Inverso de `codificar_enteros` (para clientes Python y verificación)."""
+    valores, actual, desplazamiento = [], 0, 0
+    for caracter in texto.encode('ascii'):
+        trozo = caracter - 63
+        actual |= (trozo & 0x1F) << desplazamiento
+        desplazamiento += 5
+        if trozo < 0x20:
+            valores.append(~(actual >> 1) if actual & 1 else actual >> 1)
+            actual, desplazamiento = 0, 0
+    return valores
+
+
+def _deltas(columna):
+    return np.diff(columna, prepend=np.int64(0))
+
+
+def polyline(lat, lon, precision=5):
+    """Google encoded polyline de las coordenadas (lat, lon alternados por punto)."""
+    escala = 10 ** precision
+    lat = np.round(np.asarray(lat, dtype=float) * escala).astype(np.int64)
+    lon = np.round(np.asarray(lon, dtype=float) * escala).astype(np.int64)
+    return codificar_enteros(np.column_stack((_deltas(lat), _deltas(lon))).ravel())
+
+
+def tiempos(epoch, t0):
+    """Los tiempos (segundos, redondeados) como deltas codificados; el primero relativo a `t0`."""
+    segundos = np.round(np.asarray(epoch, dtype=float)).astype(np.int64) - t0
+    return codificar_enteros(np.diff(segundos, prepend=np.int64(0)))
+
+
+def decodificar_polyline(texto, precision=5):
+    """(lat, lon) como arreglos desde una polyline."""
+    valores = np.cumsum(np.array(decodificar_enteros(texto), dtype=np.int64).reshape(-1, 2), axis=0)
+    return valores[:, 0] / 10 ** precision, valores[:, 1] / 10 ** precision
+
+
+def binario(epoch, lat, lon, t0):
+    """Cabecera + columnas int32 delta (ver el docstring del módulo)."""
+    segundos = np.round(np.asarray(epoch, dtype=float)).astype(np.int64) - t0
+    columnas = [
+        segundos,
+        np.round(np.asarray(lat, dtype=float) * ESCALA_BINARIO).astype(np.int64),
+        np.round(np.asarray(lon, dtype=float) * ESCALA_BINARIO).astype(np.int64),
+    ]
+    cuerpo = b''.join(_deltas(c).astype('<i4').tobytes() for c in columnas)
+    return CABECERA.pack(MAGIA, VERSION_BINARIO, len(segundos), t0, ESCALA_BINARIO) + cuerpo
+
+
+def leer_binario(datos):
+    """(epoch, lat, lon) como arreglos desde el formato binario; ValueError si no es un trazo."""
+    magia, version, n, t0, escala = CABECERA.unpack_from(datos)
+    if magia != MAGIA or version != VERSION_BINARIO:
+        raise ValueError('no es un trazo binario de LogiTrack')
+    columnas = np.frombuffer(datos, dtype='<i4', count=3 * n, offset=CABECERA.size).reshape(3, n)
+    acumuladas = np.cumsum(columnas.astype(np.int64), axis=1)
+    return acumuladas[0] + t0, acumuladas[1] / escala, acumuladas[2] / escala
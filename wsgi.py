@@ -0,0 +1,20 @@
+"""Punto de entrada de producción.
+
+    flask --app main init-db               # esquema y migraciones: una vez por despliegue
+    gunicorn -c gunicorn.conf.py wsgi:app  # varios workers con hilos (Linux/macOS)
+    python wsgi.py                         # un proceso con hilos, sin debugger (también en Windows)
+
+`python main.py` queda como servidor de desarrollo. HOST y PORT (127.0.0.1:8000)
+fijan dónde escucha `python wsgi.py`.
+"""
+import os
+
+from main import crear_app, iniciar_worker
+
+app = crear_app()
+
+if __name__ == '__main__':
+    from werkzeug.serving import run_simple
+
+    iniciar_worker(varios_procesos=False)
+    run_simple(os.environ.get('HOST', '127.0.0.1'), int(os.environ.get('PORT', 8000)), app, threaded=True)